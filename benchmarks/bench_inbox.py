@@ -0,0 +1,159 @@
+"""Benchmark for the received messages metadata (inbox) query.
+
+Compares the number of SQL statements and the latency of the previous
+per-message sender lookup with the joined, keyset paginated query,
+for inboxes of 100, 10k and 100k messages.
+
+Usage: python benchmarks/bench_inbox.py
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from flask import Flask
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from monolith.database import BlackList, Message, User, db  # noqa: E402
+from monolith.message_query import get_received_messages_metadata  # noqa: E402
+
+SIZES = [100, 10000, 100000]
+# the legacy implementation is too slow to be run on the biggest inbox
+LEGACY_MAX_SIZE = 10000
+SENDERS = 50
+PAGE_SIZE = 50
+
+
+def legacy_received_messages_metadata(user_id):
+    """Previous implementation, one sender query per received message"""
+
+    q = db.session.query(Message).filter(
+        Message.recipient == user_id,
+        Message.is_draft == False,
+        Message.is_delivered == True,
+        Message.is_deleted == False,
+        Message.sender.not_in(
+            db.session.query(BlackList.member).filter(BlackList.owner == user_id)
+        ),
+    )
+    result = []
+    for msg in q:
+        sender = (
+            db.session.query(User)
+            .filter(User.id == msg.sender, User.reports < 3)
+            .first()
+        )
+        if sender is not None:
+            result.append(
+                json.dumps(
+                    {
+                        "sender_id": sender.id,
+                        "firstname": sender.firstname,
+                        "lastname": sender.lastname,
+                        "id_message": msg.message_id,
+                        "email": sender.email,
+                        "media": msg.media,
+                    }
+                )
+            )
+    return result
+
+
+def populate(size):
+    """Creates a recipient (id 1), SENDERS senders and an inbox of size messages"""
+
+    db.drop_all()
+    db.create_all()
+    db.session.execute(
+        User.__table__.insert(),
+        [
+            {
+                "id": i,
+                "email": "user%d@bench.com" % i,
+                "firstname": "user%d" % i,
+                "lastname": "bench",
+                "reports": 0,
+                "is_active": True,
+                "points": 0,
+            }
+            for i in range(1, SENDERS + 2)
+        ],
+    )
+    now = datetime.now()
+    db.session.execute(
+        Message.__table__.insert(),
+        [
+            {
+                "text": "benchmark message",
+                "delivery_date": now,
+                "sender": 2 + i % SENDERS,
+                "recipient": 1,
+                "media": "",
+                "is_draft": False,
+                "is_delivered": True,
+                "is_read": False,
+                "is_deleted": False,
+            }
+            for i in range(size)
+        ],
+    )
+    db.session.commit()
+
+
+def measure(fn, *args):
+    """Runs fn counting the executed statements
+
+    :returns: statement count, elapsed milliseconds and result size
+    :rtype: tuple(int, float, int)
+    """
+
+    counter = {"queries": 0}
+
+    def count(*_):
+        counter["queries"] += 1
+
+    engine = db.engine
+    event.listen(engine, "before_cursor_execute", count)
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = (time.perf_counter() - start) * 1000
+    event.remove(engine, "before_cursor_execute", count)
+    db.session.expire_all()
+    return counter["queries"], elapsed, len(result)
+
+
+def main():
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + path
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
+
+    row = "{:>8} {:<28} {:>8} {:>12} {:>8}"
+    print(row.format("inbox", "strategy", "queries", "latency ms", "rows"))
+    with app.app_context():
+        for size in SIZES:
+            populate(size)
+            runs = []
+            if size <= LEGACY_MAX_SIZE:
+                runs.append(("legacy (query per sender)", legacy_received_messages_metadata, (1,)))
+            runs.append(("joined, whole inbox", get_received_messages_metadata, (1,)))
+            runs.append(("joined, first page", get_received_messages_metadata, (1, None, PAGE_SIZE)))
+            runs.append(
+                (
+                    "joined, last page",
+                    get_received_messages_metadata,
+                    (1, size - PAGE_SIZE, PAGE_SIZE),
+                )
+            )
+            for name, fn, args in runs:
+                queries, elapsed, rows = measure(fn, *args)
+                print(row.format(size, name, queries, "%.2f" % elapsed, rows))
+
+
+if __name__ == "__main__":
+    main()
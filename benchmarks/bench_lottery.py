@@ -0,0 +1,100 @@
+"""Benchmark for the monthly lottery draw.
+
+Compares the latency and the peak memory of the previous draw, loading every
+active user, with the unweighted and weighted draws of draw_lottery_winners,
+for 10k and 200k users.
+
+Usage: python benchmarks/bench_lottery.py
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from flask import Flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from monolith.database import User, db  # noqa: E402
+from monolith.user_query import draw_lottery_winners  # noqa: E402
+
+SIZES = [10000, 200000]
+WINNERS = 3
+
+
+def legacy_draw():
+    """Previous implementation, every active user is loaded"""
+
+    participants = db.session.query(User).filter(User.is_active).all()
+    winner = participants[random.randint(0, len(participants) - 1)]
+    return [(winner.id, winner.email)]
+
+
+def populate(size):
+    """Creates size active users with random points"""
+
+    db.drop_all()
+    db.create_all()
+    db.session.execute(
+        User.__table__.insert(),
+        [
+            {
+                "email": "user%d@bench.com" % i,
+                "firstname": "user%d" % i,
+                "lastname": "bench",
+                "reports": 0,
+                "is_active": True,
+                "points": random.randint(0, 100),
+            }
+            for i in range(size)
+        ],
+    )
+    db.session.commit()
+
+
+def measure(fn, *args):
+    """Runs fn twice, once timed and once tracing the memory it allocates
+
+    :returns: elapsed milliseconds and peak allocated KiB
+    :rtype: tuple(float, float)
+    """
+
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = (time.perf_counter() - start) * 1000
+    db.session.expunge_all()
+
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1] / 1024
+    tracemalloc.stop()
+    db.session.expunge_all()
+    return elapsed, peak
+
+
+def main():
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + path
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
+
+    row = "{:>8} {:<28} {:>12} {:>12}"
+    print(row.format("users", "strategy", "latency ms", "peak KiB"))
+    with app.app_context():
+        for size in SIZES:
+            populate(size)
+            runs = [
+                ("legacy (load all users)", legacy_draw, ()),
+                ("count and offset", draw_lottery_winners, (WINNERS,)),
+                ("weighted reservoir", draw_lottery_winners, (WINNERS, True)),
+            ]
+            for name, fn, args in runs:
+                elapsed, peak = measure(fn, *args)
+                print(row.format(size, name, "%.2f" % elapsed, "%.0f" % peak))
+
+
+if __name__ == "__main__":
+    main()
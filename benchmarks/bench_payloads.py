@@ -0,0 +1,62 @@
+"""Benchmark for the size of the notification tasks in the broker.
+
+Compares the bytes of the task arguments of the previous payload, a JSON
+string with both emails and the body, with the versioned payloads of ids
+built by build_payload, serialized with JSON and msgpack, for one
+notification and for a batch of 500.
+
+Usage: python benchmarks/bench_payloads.py
+"""
+import json
+import os
+import sys
+
+from kombu.serialization import dumps
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from monolith.background import MESSAGE_RECEIVED, build_payload  # noqa: E402
+
+BATCH = 500
+
+
+def legacy_payload(i):
+    """Previous payload, a task per notification"""
+
+    return json.dumps(
+        {
+            "id": 1000000 + i,
+            "TESTING": False,
+            "body": "You have just received a massage",
+            "recipient": "recipient%d@example.com" % i,
+            "sender": "sender%d@example.com" % i,
+        }
+    )
+
+
+def size(payload, serializer):
+    """Bytes of the arguments of a task with payload as its only argument"""
+
+    return len(dumps(((payload,), {}, {}), serializer)[2])
+
+
+def main():
+    row = "{:<28} {:>14} {:>16}"
+    print(row.format("payload", "bytes (1)", "bytes (%d)" % BATCH))
+    legacy = [size(legacy_payload(i), "json") for i in range(BATCH)]
+    print(row.format("legacy JSON string", legacy[0], sum(legacy)))
+    for serializer in ["json", "msgpack"]:
+        one = build_payload([(MESSAGE_RECEIVED, 1000000, 2000000)], False)
+        batch = build_payload(
+            [(MESSAGE_RECEIVED, 1000000 + i, 2000000 + i) for i in range(BATCH)],
+            False,
+        )
+        print(
+            row.format(
+                "ids, " + serializer, size(one, serializer), size(batch, serializer)
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
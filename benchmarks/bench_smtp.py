@@ -0,0 +1,93 @@
+"""Benchmark for the delivery of the notification emails.
+
+Compares the emails per second of the previous implementation, opening a
+new SMTP session per email, with the pooled sessions of send_notification.
+The relay is a local stand-in SMTP server accepting every email; it waits
+HANDSHAKE_DELAY before its greeting, standing in for the TCP and TLS
+handshakes of a remote relay.
+
+Usage: python benchmarks/bench_smtp.py
+"""
+
+import os
+import smtplib
+import socketserver
+import sys
+import threading
+import time
+from email.message import EmailMessage
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from monolith.notifications import EmailConfig, send_notification  # noqa: E402
+
+EMAILS = 500
+HANDSHAKE_DELAY = 0.005
+
+
+class StandInSMTPHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP server session, accepting and discarding every email"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        time.sleep(HANDSHAKE_DELAY)
+        self.reply("220 stand-in ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in (b"EHLO", b"HELO"):
+                self.reply("250 stand-in")
+            elif command == b"DATA":
+                self.reply("354 end with <CRLF>.<CRLF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                self.reply("250 queued")
+            elif command == b"QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                # MAIL, RCPT, RSET, NOOP
+                self.reply("250 ok")
+
+
+class StandInSMTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def legacy_send_notification(msg_sender, receiver, msg_body, config):
+    """Previous implementation, a new SMTP session for every email"""
+
+    with smtplib.SMTP(config.server, config.port, timeout=10) as server:
+        mail = EmailMessage()
+        mail["Subject"] = "MMIAB - Message from " + msg_sender
+        mail.set_content(msg_body)
+        server.sendmail(config.email, receiver, mail.as_string())
+
+
+def main():
+    server = StandInSMTPServer(("127.0.0.1", 0), StandInSMTPHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config = EmailConfig("127.0.0.1", server.server_address[1], "bench@mmiab", "")
+
+    row = "{:<28} {:>8} {:>12}"
+    print(row.format("strategy", "emails", "emails/s"))
+    for name, send in [
+        ("session per email", legacy_send_notification),
+        ("pooled sessions", send_notification),
+    ]:
+        start = time.perf_counter()
+        for i in range(EMAILS):
+            send("bench", "user%d@bench.com" % i, "benchmark email", config)
+        elapsed = time.perf_counter() - start
+        print(row.format(name, EMAILS, "%.0f" % (EMAILS / elapsed)))
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Benchmark for the SQLite engine profile under concurrency.
+
+Runs reader threads listing inboxes alongside writer threads saving and
+delivering messages, as the waitress threads and the Celery workers do,
+on the previous engine (a new connection per session, rollback journal)
+and on the profile of create_app (pooled connections, WAL and the
+pragmas of SQLITE_PRAGMAS). Reports the operations per second and how
+many of them failed with "database is locked".
+
+Usage: python benchmarks/bench_sqlite.py
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from flask import Flask
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool, QueuePool
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from monolith.database import Message, User, db, set_sqlite_pragmas  # noqa: E402
+from monolith.message_query import get_received_messages_metadata  # noqa: E402
+
+USERS = 100
+MESSAGES = 20000
+READERS = 8
+WRITERS = 3
+DURATION = 5
+
+
+def create_bench_app(path, tuned):
+    """Creates an app on the database file, with or without the profile"""
+
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + path
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    if tuned:
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+            "poolclass": QueuePool,
+            "pool_size": READERS + WRITERS,
+            "connect_args": {"check_same_thread": False},
+        }
+    else:
+        # previous engine, as chosen by Flask-SQLAlchemy for a file
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"poolclass": NullPool}
+    db.init_app(app)
+    if tuned:
+        set_sqlite_pragmas(db.get_engine(app))
+    return app
+
+
+def populate():
+    db.create_all()
+    db.session.execute(
+        User.__table__.insert(),
+        [
+            {
+                "email": "user%d@bench.com" % i,
+                "firstname": "user%d" % i,
+                "lastname": "bench",
+                "reports": 0,
+                "is_active": True,
+                "points": 0,
+            }
+            for i in range(USERS)
+        ],
+    )
+    db.session.execute(
+        Message.__table__.insert(),
+        [
+            {
+                "text": "message %d" % i,
+                "sender": random.randint(1, USERS),
+                "recipient": random.randint(1, USERS),
+                "delivery_date": datetime.now(),
+                "is_draft": False,
+                "is_delivered": True,
+                "is_read": False,
+                "is_deleted": False,
+            }
+            for i in range(MESSAGES)
+        ],
+    )
+    db.session.commit()
+
+
+def read(stats):
+    get_received_messages_metadata(random.randint(1, USERS), limit=50)
+    db.session.commit()
+    stats["reads"] += 1
+
+
+def write(stats):
+    msg = Message(
+        text="delivered",
+        sender=random.randint(1, USERS),
+        recipient=random.randint(1, USERS),
+        delivery_date=datetime.now(),
+        is_draft=False,
+        is_delivered=False,
+    )
+    db.session.add(msg)
+    db.session.commit()
+    db.session.query(Message).filter(Message.message_id == msg.message_id).update(
+        {Message.is_delivered: True}, synchronize_session=False
+    )
+    db.session.commit()
+    stats["writes"] += 1
+
+
+def worker(app, operation, stats, stop):
+    with app.app_context():
+        while not stop.is_set():
+            try:
+                operation(stats)
+            except OperationalError:
+                db.session.rollback()
+                stats["locked"] += 1
+        db.session.remove()
+
+
+def run(tuned):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    app = create_bench_app(path, tuned)
+    with app.app_context():
+        populate()
+
+    stats = {"reads": 0, "writes": 0, "locked": 0}
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=worker, args=(app, read, stats, stop))
+        for _ in range(READERS)
+    ] + [
+        threading.Thread(target=worker, args=(app, write, stats, stop))
+        for _ in range(WRITERS)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(DURATION)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return stats
+
+
+def main():
+    row = "{:<24} {:>10} {:>10} {:>10}"
+    print(row.format("profile", "reads/s", "writes/s", "locked"))
+    for name, tuned in [("previous", False), ("WAL, pooled, pragmas", True)]:
+        stats = run(tuned)
+        print(
+            row.format(
+                name,
+                "%.0f" % (stats["reads"] / DURATION),
+                "%.0f" % (stats["writes"] / DURATION),
+                stats["locked"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Benchmark for the overhead of the Celery tasks.
+
+Compares the latency of a task body creating a Flask app for every task,
+as the tasks did before, with the app reused by the worker process.
+The body is the user lookup of send_notification_task.
+
+Usage: python benchmarks/bench_tasks.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import monolith.background  # noqa: E402
+from monolith.app import create_app  # noqa: E402
+from monolith.user_query import get_users_notification_settings  # noqa: E402
+
+TASKS = 200
+
+
+def legacy_task():
+    """Previous lazy init, a new app for each task"""
+
+    app = create_app(True)
+    with app.app_context():
+        return get_users_notification_settings([1])
+
+
+def worker_task():
+    """App of the worker process, created by the first task"""
+
+    app = monolith.background._get_app(True)
+    with app.app_context():
+        return get_users_notification_settings([1])
+
+
+def main():
+    row = "{:<28} {:>8} {:>14} {:>10}"
+    print(row.format("strategy", "tasks", "ms per task", "tasks/s"))
+    for name, task in [("app per task", legacy_task), ("app per worker", worker_task)]:
+        start = time.perf_counter()
+        for _ in range(TASKS):
+            task()
+        elapsed = time.perf_counter() - start
+        print(
+            row.format(
+                name,
+                TASKS,
+                "%.2f" % (elapsed * 1000 / TASKS),
+                "%.0f" % (TASKS / elapsed),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
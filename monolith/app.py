@@ -3,9 +3,26 @@ import os
 
 from flask import Flask
 from flask_ckeditor import CKEditor
-
-from monolith.auth import login_manager
-from monolith.database import User, db
+from sqlalchemy.pool import QueuePool
+
+import monolith.user_query
+from monolith.attachments import (
+    FILE_MODE,
+    UploadRequest,
+    backfill_refcounts,
+    move_uploads,
+)
+from monolith.auth import login_manager, user_cache
+from monolith.cache import RedisBackend, log_stats
+from monolith.database import (
+    REPLICA_BIND,
+    SQLITE_PRAGMAS,
+    User,
+    db,
+    init_replica,
+    set_sqlite_pragmas,
+    upgrade_schema,
+)
 from monolith.views import blueprints
 from monolith.views.home import to_error_page
 from jinja2.exceptions import TemplateError
@@ -21,11 +38,12 @@ def create_test_app():
     return create_app(True)
 
 
-def create_app(test_mode=False):
+def create_app(test_mode=False, worker=False):
     """Creates an instance of the application.
 
     Args:
         test_mode (bool, optional): creates an application instance for testing. Defaults to False.
+        worker (bool, optional): creates the application of a Celery worker process, sizing its connection pool accordingly. Defaults to False.
 
     Returns:
         Flask: application instance
@@ -36,34 +54,175 @@ def create_app(test_mode=False):
     if test_mode:
         app.config["TESTING"] = True
         app.config["WTF_CSRF_ENABLED"] = False
-        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///../mmiab-test.db"
     else:
-        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///../mmiab.db"
         app.config["WTF_CSRF_SECRET_KEY"] = "A SECRET KEY"
+    # primary database and optional read replica, of their own in testing
+    prefix = "TEST_" if test_mode else ""
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+        prefix + "DATABASE_URL",
+        "sqlite:///../mmiab-test.db" if test_mode else "sqlite:///../mmiab.db",
+    )
+    replica = os.environ.get(prefix + "DATABASE_REPLICA_URL", "")
+    if replica != "":
+        app.config["SQLALCHEMY_BINDS"] = {REPLICA_BIND: replica}
+    # seconds a client reads the primary after writing to it, as the replica
+    # may not have caught up yet
+    app.config["DATABASE_REPLICA_LAG"] = int(
+        os.environ.get("DATABASE_REPLICA_LAG", "5")
+    )
     app.config["SECRET_KEY"] = "ANOTHER ONE"
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # SQLite pragmas, each one can be overridden by SQLITE_<NAME>
+    app.config["SQLITE_PRAGMAS"] = {
+        name: os.environ.get("SQLITE_" + name.upper(), str(value))
+        for name, value in SQLITE_PRAGMAS.items()
+    }
+    # pooled connections keep their pragmas and page cache: a web process
+    # serves several threads, a worker process runs a task at a time
+    role = "WORKER" if worker else "WEB"
+    app.config["DB_POOL_SIZE"] = int(
+        os.environ.get("DB_%s_POOL_SIZE" % role, "2" if worker else "8")
+    )
+    app.config["DB_MAX_OVERFLOW"] = int(
+        os.environ.get("DB_%s_MAX_OVERFLOW" % role, "2" if worker else "8")
+    )
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "poolclass": QueuePool,
+        "pool_size": app.config["DB_POOL_SIZE"],
+        "max_overflow": app.config["DB_MAX_OVERFLOW"],
+    }
+    if all(
+        uri.startswith("sqlite")
+        for uri in [app.config["SQLALCHEMY_DATABASE_URI"], replica or "sqlite"]
+    ):
+        # a pooled connection is used by a thread at a time
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"]["connect_args"] = {
+            "check_same_thread": False
+        }
+    # delivery scheduler: how many seconds ahead messages are kept in memory,
+    # how often they are read again, how many at most and per UPDATE
+    app.config["SCHEDULER_HORIZON"] = int(os.environ.get("SCHEDULER_HORIZON", "300"))
+    app.config["SCHEDULER_REFILL_INTERVAL"] = int(
+        os.environ.get("SCHEDULER_REFILL_INTERVAL", "60")
+    )
+    app.config["SCHEDULER_CAPACITY"] = int(
+        os.environ.get("SCHEDULER_CAPACITY", "10000")
+    )
+    app.config["SCHEDULER_BATCH_SIZE"] = int(
+        os.environ.get("SCHEDULER_BATCH_SIZE", "500")
+    )
+    # outbox relay: tasks sent per transaction, maximum seconds between
+    # attempts when the broker is unreachable
+    app.config["OUTBOX_BATCH_SIZE"] = int(os.environ.get("OUTBOX_BATCH_SIZE", "100"))
+    app.config["OUTBOX_MAX_BACKOFF"] = int(os.environ.get("OUTBOX_MAX_BACKOFF", "300"))
+    # blacklist cache, optionally shared among processes through Redis
+    app.config["BLACKLIST_CACHE_SIZE"] = int(
+        os.environ.get("BLACKLIST_CACHE_SIZE", "4096")
+    )
+    app.config["BLACKLIST_CACHE_TTL"] = int(
+        os.environ.get("BLACKLIST_CACHE_TTL", "300")
+    )
+    app.config["BLACKLIST_CACHE_URL"] = os.environ.get("BLACKLIST_CACHE_URL", "")
+    # seconds a process keeps a blacklist in memory when they are shared,
+    # as it does not see the changes made by the other processes
+    app.config["BLACKLIST_CACHE_LOCAL_TTL"] = float(
+        os.environ.get("BLACKLIST_CACHE_LOCAL_TTL", "1")
+    )
+    # seconds between two logs of the usage of the caches, to size them,
+    # 0 to disable them
+    app.config["CACHE_STATS_INTERVAL"] = int(
+        os.environ.get("CACHE_STATS_INTERVAL", "3600")
+    )
+    # monthly lottery: how many winners, drawn with a chance proportional to
+    # their points if weighted
+    app.config["LOTTERY_WINNERS"] = int(os.environ.get("LOTTERY_WINNERS", "1"))
+    app.config["LOTTERY_WEIGHTED"] = os.environ.get("LOTTERY_WEIGHTED", "") == "1"
+    # notifications of the users in digest mode are buffered, and emailed
+    # once no new one arrived for the window, or after the maximum latency
+    app.config["NOTIFICATION_DIGEST_WINDOW"] = int(
+        os.environ.get("NOTIFICATION_DIGEST_WINDOW", "300")
+    )
+    app.config["NOTIFICATION_MAX_LATENCY"] = int(
+        os.environ.get("NOTIFICATION_MAX_LATENCY", "3600")
+    )
+    # logged in users, cached for a short time to save a query per request
+    app.config["USER_CACHE_SIZE"] = int(os.environ.get("USER_CACHE_SIZE", "4096"))
+    app.config["USER_CACHE_TTL"] = int(os.environ.get("USER_CACHE_TTL", "30"))
+    # attachments are streamed to UPLOAD_FOLDER, up to this many bytes
+    app.config["MAX_ATTACHMENT_SIZE"] = int(
+        os.environ.get("MAX_ATTACHMENT_SIZE", str(10 * 1024 * 1024))
+    )
+    app.request_class = UploadRequest
+    # attachments can be sent by the web server, with X-Sendfile (Apache,
+    # lighttpd) or with X-Accel-Redirect to this internal location (nginx)
+    app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE", "") == "1"
+    app.config["MEDIA_ACCEL_REDIRECT"] = os.environ.get("MEDIA_ACCEL_REDIRECT", "")
     # show error page
     app.register_error_handler(500, to_error_page)
     app.register_error_handler(TemplateError, to_error_page)
 
-    app.config["UPLOAD_FOLDER"] = os.path.join(app.root_path, "static", "user_uploads")
+    # attachments are stored out of the static folder, and sent only to the
+    # users who wrote or received them by /api/media or the web server
+    app.config["UPLOAD_FOLDER"] = os.environ.get(
+        "UPLOAD_FOLDER", os.path.join(app.instance_path, "user_uploads")
+    )
+    # mode of the stored files, in octal
+    app.config["UPLOAD_FILE_MODE"] = int(
+        os.environ.get("UPLOAD_FILE_MODE", oct(FILE_MODE)), 8
+    )
     try:
         os.makedirs(app.config["UPLOAD_FOLDER"])
     except OSError as e:
         pass
+    # where a previous version stored them
+    move_uploads(
+        os.path.join(app.root_path, "static", "user_uploads"),
+        app.config["UPLOAD_FOLDER"],
+        app.config["UPLOAD_FILE_MODE"],
+    )
 
     for bp in blueprints:
         app.register_blueprint(bp)
         bp.app = app
 
+    backend = None
+    if app.config["BLACKLIST_CACHE_URL"] != "":
+        backend = RedisBackend(
+            app.config["BLACKLIST_CACHE_URL"],
+            "mmiab:blacklist:",
+            monolith.user_query.dump_blacklist,
+            monolith.user_query.load_blacklist,
+        )
+    monolith.user_query.blacklist_cache.configure(
+        app.config["BLACKLIST_CACHE_SIZE"],
+        app.config["BLACKLIST_CACHE_TTL"],
+        backend,
+        app.config["BLACKLIST_CACHE_LOCAL_TTL"],
+    )
+
+    user_cache.configure(app.config["USER_CACHE_SIZE"], app.config["USER_CACHE_TTL"])
+    if app.config["CACHE_STATS_INTERVAL"] > 0:
+
+        @app.after_request
+        def log_cache_stats(response):
+            log_stats(app.config["CACHE_STATS_INTERVAL"])
+            return response
+
     db.init_app(app)
+    # before the first connection is opened
+    set_sqlite_pragmas(db.get_engine(app), app.config["SQLITE_PRAGMAS"])
+    init_replica(app)
     login_manager.init_app(app)
     db.create_all(app=app)
 
     _ = CKEditor(app)
 
-    # create a first admin user
     with app.app_context():
+        # add the missing indexes to a database created by a previous version
+        upgrade_schema()
+        backfill_refcounts()
+
+        # create a first admin user
         q = db.session.query(User).filter(User.email == "example@example.com")
         user = q.first()
         if user is None:
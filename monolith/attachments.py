@@ -0,0 +1,363 @@
+import hashlib
+import mimetypes
+import os
+import pathlib
+import shutil
+import tempfile
+
+from flask import Request, request, send_file
+from flask.globals import current_app
+from sqlalchemy import func
+from werkzeug.exceptions import (
+    NotFound,
+    RequestedRangeNotSatisfiable,
+    RequestEntityTooLarge,
+)
+from werkzeug.security import safe_join
+
+from monolith.database import Attachment, Message, db
+
+# size of the chunks an upload is copied in, bounds the memory used
+CHUNK_SIZE = 65536
+# stored files never change, browsers can keep them for a year
+MAX_AGE = 365 * 24 * 60 * 60
+# default mode of the stored files: mkstemp makes them private,
+# and a front-end server running as another user sends them
+FILE_MODE = 0o644
+
+
+class UploadFile:
+    """Temporary file in UPLOAD_FOLDER receiving an upload while it is parsed.
+    The contents are hashed and measured while they are written, so that the
+    upload is read exactly once and then renamed into place by store.
+    The file is removed when closed, unless it was stored.
+    """
+
+    def __init__(self, folder, max_size=None):
+        """Creates an empty temporary file
+
+        :param folder: the folder of the stored files
+        :type folder: str
+        :param max_size: maximum size in bytes, defaults to None (unlimited)
+        :type max_size: int, optional
+        """
+
+        fd, self.path = tempfile.mkstemp(dir=folder, prefix=".upload-")
+        self.file = os.fdopen(fd, "w+b")
+        self.max_size = max_size
+        self.size = 0
+        self.sha1 = hashlib.sha1()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            # stop as soon as the limit is exceeded, without keeping the rest
+            self.close()
+            raise RequestEntityTooLarge("Attachment too large")
+        self.sha1.update(data)
+        return self.file.write(data)
+
+    def name(self, suffix):
+        """Returns the name of the file once stored, after the hash of its
+        contents
+
+        :param suffix: the extension of the file
+        :type suffix: str
+        :returns: the name of the stored file
+        :rtype: str
+        """
+
+        return self.sha1.hexdigest() + suffix
+
+    def store(self, folder, suffix, mode=FILE_MODE):
+        """Renames the file after the hash of its contents
+
+        :param folder: the folder of the stored files
+        :type folder: str
+        :param suffix: the extension of the file
+        :type suffix: str
+        :param mode: the mode of the stored file, defaults to FILE_MODE
+        :type mode: int, optional
+        :returns: the name of the stored file
+        :rtype: str
+        """
+
+        self.file.close()
+        filename = self.name(suffix)
+        path = os.path.join(folder, filename)
+        if os.path.exists(path):
+            # the same contents are already stored
+            os.unlink(self.path)
+        else:
+            os.chmod(self.path, mode)
+            os.replace(self.path, path)
+        self.path = None
+        return filename
+
+    def close(self):
+        self.file.close()
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:  # pragma: no cover
+                pass
+            self.path = None
+
+    def __getattr__(self, name):
+        # read, seek, tell, ... are those of the underlying file
+        return getattr(self.file, name)
+
+
+class UploadRequest(Request):
+    """Request streaming the uploaded files straight to UPLOAD_FOLDER"""
+
+    def _get_file_stream(
+        self, total_content_length, content_type, filename=None, content_length=None
+    ):
+        return UploadFile(
+            current_app.config["UPLOAD_FOLDER"],
+            current_app.config["MAX_ATTACHMENT_SIZE"],
+        )
+
+
+def store(file, count=1):
+    """Stores an uploaded file under UPLOAD_FOLDER, named after the hash of its
+    contents, so that the same contents are stored only once.
+    The references to the file are added in the current transaction before
+    the file is put in place, so that collect cannot delete it meanwhile.
+
+    :param file: file handle
+    :type file: FileStorage
+    :param count: how many references to add, defaults to 1
+    :type count: int, optional
+    :raises RequestEntityTooLarge: if the file exceeds MAX_ATTACHMENT_SIZE
+    :returns: the name of the stored file
+    :rtype: str
+    """
+
+    folder = current_app.config["UPLOAD_FOLDER"]
+    suffix = pathlib.Path(file.filename).suffix.lower()
+
+    upload = file.stream
+    if not isinstance(upload, UploadFile):
+        # not received through UploadRequest, copy it once in chunks
+        upload = UploadFile(folder, current_app.config["MAX_ATTACHMENT_SIZE"])
+        try:
+            for data in iter(lambda: file.stream.read(CHUNK_SIZE), b""):
+                upload.write(data)
+        except Exception:
+            upload.close()
+            raise
+
+    # a concurrent collect either waits for the transaction, and then finds
+    # the file referenced, or has already deleted the previous copy
+    acquire(upload.name(suffix), count)
+    return upload.store(folder, suffix, current_app.config["UPLOAD_FILE_MODE"])
+
+
+def acquire(filename, count=1):
+    """Adds references to a stored file, in the current transaction
+
+    :param filename: the name of the stored file
+    :type filename: str
+    :param count: how many references to add, defaults to 1
+    :type count: int, optional
+    """
+
+    if not filename or count <= 0:
+        return
+
+    # two first references to a file must not both insert it
+    db.session.execute(_insert_ignore(Attachment, filename=filename, refcount=0))
+    db.session.query(Attachment).filter(Attachment.filename == filename).update(
+        {Attachment.refcount: Attachment.refcount + count},
+        synchronize_session=False,
+    )
+
+
+def release(filename, count=1):
+    """Removes references to a stored file, in the current transaction.
+    Once committed, collect removes the files that are no longer referenced
+
+    :param filename: the name of the stored file
+    :type filename: str
+    :param count: how many references to remove, defaults to 1
+    :type count: int, optional
+    """
+
+    if not filename or count <= 0:
+        return
+
+    db.session.query(Attachment).filter(Attachment.filename == filename).update(
+        {Attachment.refcount: Attachment.refcount - count},
+        synchronize_session=False,
+    )
+
+
+def collect(*filenames):
+    """Deletes the stored files that are no longer referenced
+
+    :param filenames: the names of the files to check
+    :type filenames: str
+    :returns: the names of the deleted files
+    :rtype: list[str]
+    """
+
+    deleted = []
+    for filename in filenames:
+        if not filename:
+            continue
+
+        # the file is deleted before the row, so that a store waiting for
+        # the transaction puts it back once it has referenced it
+        removed = (
+            db.session.query(Attachment)
+            .filter(Attachment.filename == filename, Attachment.refcount <= 0)
+            .delete(synchronize_session=False)
+        )
+        if removed != 0:
+            try:
+                os.unlink(_path(filename))
+                deleted.append(filename)
+            except FileNotFoundError:  # pragma: no cover
+                # This will only happen in case of a FS issue
+                pass
+        db.session.commit()
+
+    return deleted
+
+
+def send(filename):
+    """Sends a stored file. Since a name is the hash of the contents, the hash
+    is a strong ETag and the file can be cached forever by the browser.
+    Conditional and Range requests are answered, and the transfer can be
+    handed off to the web server with USE_X_SENDFILE or MEDIA_ACCEL_REDIRECT
+
+    :param filename: the name of the stored file
+    :type filename: str
+    :raises NotFound: if the file is not stored
+    :returns: the response with the contents of the file
+    :rtype: Response
+    """
+
+    path = safe_join(current_app.config["UPLOAD_FOLDER"], filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+
+    accel_redirect = current_app.config["MEDIA_ACCEL_REDIRECT"]
+    if accel_redirect != "":
+        # nginx serves the file from its internal location, ranges included
+        response = current_app.response_class(
+            mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        )
+        response.headers["X-Accel-Redirect"] = accel_redirect + filename
+        size = None
+    else:
+        # expires with the max-age of the Cache-Control header set below
+        response = send_file(
+            path, add_etags=False, cache_timeout=MAX_AGE, conditional=False
+        )
+        # with X-Sendfile the body is empty, ranges are left to the web server
+        size = None if current_app.use_x_sendfile else os.path.getsize(path)
+
+    response.set_etag(filename.split(".")[0])
+    response.headers["Cache-Control"] = "private, max-age=%d, immutable" % MAX_AGE
+
+    try:
+        response = response.make_conditional(
+            request, accept_ranges=size is not None, complete_length=size
+        )
+    except RequestedRangeNotSatisfiable:
+        response.close()
+        raise
+    if response.status_code == 304:
+        # some servers ignore the status code when handing the file off
+        response.headers.pop("X-Sendfile", None)
+        response.headers.pop("X-Accel-Redirect", None)
+
+    return response
+
+
+def backfill_refcounts():
+    """Computes the reference counts of the files stored before reference
+    counting was introduced. Does nothing if any count is already stored
+
+    :returns: the number of stored files found
+    :rtype: int
+    """
+
+    if db.session.query(Attachment.filename).first() is not None:
+        return 0
+
+    q = (
+        db.session.query(Message.media, func.count(Message.message_id))
+        .filter(Message.media.isnot(None), Message.media != "")
+        .group_by(Message.media)
+    )
+    attachments = [Attachment(filename=media, refcount=count) for media, count in q]
+    db.session.add_all(attachments)
+    db.session.commit()
+    return len(attachments)
+
+
+def move_uploads(source, folder, mode=FILE_MODE):
+    """Moves the files stored by a previous version under the static folder,
+    where anyone could download them, to the folder of the stored files,
+    then removes the source folder. Does nothing if it does not exist
+
+    :param source: the folder the files were stored in
+    :type source: str
+    :param folder: the folder of the stored files
+    :type folder: str
+    :param mode: the mode of the stored files, defaults to FILE_MODE
+    :type mode: int, optional
+    :returns: the names of the moved files
+    :rtype: list[str]
+    """
+
+    if not os.path.isdir(source) or os.path.samefile(source, folder):
+        return []
+
+    moved = []
+    for entry in os.scandir(source):
+        if not entry.is_file():
+            continue
+        if entry.name.startswith(".upload-"):
+            # left behind by an interrupted upload
+            os.unlink(entry.path)
+            continue
+        path = os.path.join(folder, entry.name)
+        if os.path.exists(path):
+            # the same contents are already stored
+            os.unlink(entry.path)
+        else:
+            shutil.move(entry.path, path)
+            # stored by mkstemp with a private mode
+            os.chmod(path, mode)
+        moved.append(entry.name)
+
+    try:
+        os.rmdir(source)
+    except OSError as e:
+        print("Exception in move_uploads:", e)
+    return moved
+
+
+def _insert_ignore(model, **values):
+    """Builds an INSERT of a row that does nothing if its key already exists"""
+
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+
+        return insert(model).values(**values).on_conflict_do_nothing()
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+
+        return insert(model).values(**values).on_conflict_do_nothing()
+    # MySQL
+    return db.insert(model).values(**values).prefix_with("IGNORE")
+
+
+def _path(filename):
+    return os.path.join(current_app.config["UPLOAD_FOLDER"], filename)
@@ -1,10 +1,40 @@
+from dataclasses import dataclass
+from datetime import datetime
+
 from flask import abort
 from flask_login import LoginManager, current_user
 
-from monolith.database import User
+from monolith.cache import LRUCache
+from monolith.database import User, db
 
 login_manager = LoginManager()
 
+# snapshots of the logged in users, dropped by invalidate_user when they change
+user_cache = LRUCache("user", maxsize=4096, ttl=30)
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """Read-only copy of the profile of a logged in user, detached from the
+    database session so that it can be cached between requests
+    """
+
+    id: int
+    email: str
+    firstname: str
+    lastname: str
+    dateofbirth: datetime
+    is_active: bool
+    content_filter: bool
+    notification_mode: str
+
+    # a loaded user is always logged in
+    is_authenticated = True
+    is_anonymous = False
+
+    def get_id(self):
+        return str(self.id)
+
 
 def check_authenticated():
     if current_user is None or not hasattr(current_user, 'id'):
@@ -13,7 +43,35 @@ def check_authenticated():
 
 @login_manager.user_loader
 def load_user(user_id):
-    user = User.query.get(user_id)
-    if user is not None:
-        user._authenticated = True
+    user_id = int(user_id)
+    user = user_cache.get(user_id)
+    if user is None:
+        row = (
+            db.session.query(
+                User.id,
+                User.email,
+                User.firstname,
+                User.lastname,
+                User.dateofbirth,
+                User.is_active,
+                User.content_filter,
+                User.notification_mode,
+            )
+            .filter(User.id == user_id)
+            .first()
+        )
+        if row is None:
+            return None
+        user = UserSnapshot(**row._asdict())
+        user_cache.set(user_id, user)
     return user
+
+
+def invalidate_user(user_id):
+    """Drops the cached snapshot of a user, to be called when the user changes
+
+    :param user_id: the id of the changed user
+    :type user_id: int
+    """
+
+    user_cache.delete(int(user_id))
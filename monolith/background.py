@@ -1,30 +1,52 @@
 import json
-import random
+import os
 from datetime import timedelta
 
 from celery import Celery
 from celery.schedules import crontab  # cronetab for lottery
+from celery.signals import worker_process_init, worker_process_shutdown
 from celery.utils.log import get_logger
+from flask import current_app, has_app_context
 
+from monolith import outbox
 from monolith.database import db
-from monolith.message_query import check_message_to_send, update_message_state
-from monolith.notifications import send_notification
+from monolith.digest import (
+    buffer_notification,
+    build_digest,
+    claim_pending_notifications,
+    get_due_recipients,
+    release_notifications,
+)
+from monolith.message_query import update_message_state
+from monolith.notifications import close_pools, send_notification
+from monolith.scheduler import DeliveryScheduler
 from monolith.user_query import (
     add_points,
-    get_user_mail,
-    get_lottery_participants,
+    draw_lottery_winners,
     get_user_by_email,
+    get_users_notification_settings,
 )
 
+try:
+    import msgpack  # noqa: F401
+
+    TASK_SERIALIZER = "msgpack"
+except ImportError:  # pragma: no cover
+    TASK_SERIALIZER = "json"
+
 
 logger = get_logger(__name__)
+# operating mode of the periodic tasks and of the app created when a worker
+# process starts, tasks of the other mode get an app of their own
+TEST_MODE = os.environ.get("CELERY_TEST_MODE", "") == "1"
 # broker's url and storing results
 BACKEND = BROKER = "redis://localhost:6379"
 # create celery instance
 celery = Celery(__name__, backend=BACKEND, broker=BROKER)
 # route tasks on their queue
-celery.conf.task_route = {
+celery.conf.task_routes = {
     "monolith.background.send_message": {"queue": "message"},  # key message
+    "monolith.background.run_scheduler": {"queue": "message"},
     "monolith.background.send_notification_task": {
         "queue": "notification"
     },  # key notification
@@ -32,22 +54,97 @@ celery.conf.task_route = {
 
 # set up period task
 celery.conf.beat_schedule = {
-    # for coping with faults during message delivery
-    "check_message": {
-        "task": "monolith.background.check_messages",
-        "schedule": timedelta(minutes=15),  # every 15 minutes
-        "args": [False],  # test mode
+    # delivery of the scheduled messages
+    "run_scheduler": {
+        "task": "monolith.background.run_scheduler",
+        "schedule": timedelta(seconds=float(os.environ.get("SCHEDULER_INTERVAL", "1"))),
+        "args": [TEST_MODE],
+    },
+    # tasks of the outbox
+    "relay_outbox": {
+        "task": "monolith.background.relay_outbox",
+        "schedule": timedelta(
+            seconds=float(os.environ.get("OUTBOX_RELAY_INTERVAL", "1"))
+        ),
+        "args": [TEST_MODE],
+    },
+    # notification digests
+    "flush_notifications": {
+        "task": "monolith.background.flush_notifications",
+        "schedule": timedelta(
+            seconds=int(os.environ.get("NOTIFICATION_FLUSH_INTERVAL", "60"))
+        ),
+        "args": [TEST_MODE],
     },
     # lottery game
     "lottery": {
         "task": "monolith.background.lottery",
         "schedule": crontab(0, 0, day_of_month="1"),  # every 1st
-        "args": [False],  # test mode
+        "args": [TEST_MODE],
     },
 }
 # set timezone
 celery.conf.timezone = "UTC"
-_APP = None
+# compact binary payloads, JSON ones are still accepted from older producers
+celery.conf.task_serializer = os.environ.get("CELERY_TASK_SERIALIZER", TASK_SERIALIZER)
+celery.conf.accept_content = ["json", "msgpack"]
+# version of the payloads of send_notification_task, see build_payload
+PAYLOAD_VERSION = 2
+# kinds of notifications
+MESSAGE_RECEIVED, MESSAGE_READ, LOTTERY_WON = 1, 2, 3
+# body of each kind of notification, formatted with the sender
+NOTIFICATION_BODIES = {
+    MESSAGE_RECEIVED: "You have just received a message",
+    MESSAGE_READ: "{sender} has just read the message",
+    LOTTERY_WON: "You have just won 20 points!",
+}
+# sender of the notifications not sent by an user
+SYSTEM_SENDER = "Message in a bottle"
+# the Flask apps of the worker process by test mode, see _get_app
+_APPS = {}
+# the delivery schedulers of the worker process by test mode, see run_scheduler
+_SCHEDULERS = {}
+
+
+def _get_app(test_mode):
+    """Returns the Flask app to run a task in: the current one if the task
+    runs in an app context (e.g. called directly), otherwise the app of the
+    worker process for the operating mode, created by the first task of that
+    mode and reused with its connection pool by the next ones
+
+    :param test_mode: the operating mode
+    :type test_mode: bool
+    :returns: the app
+    :rtype: Flask
+    """
+
+    if has_app_context():
+        return current_app._get_current_object()
+    test_mode = bool(test_mode)
+    if test_mode not in _APPS:
+        from monolith.app import create_app
+
+        _APPS[test_mode] = create_app(test_mode, worker=True)
+    return _APPS[test_mode]
+
+
+@worker_process_init.connect
+def init_worker_app(**kwargs):  # pragma: no cover
+    """Creates the app of a worker process before it runs any task"""
+
+    _get_app(TEST_MODE)
+
+
+@worker_process_shutdown.connect
+def shutdown_worker_app(**kwargs):  # pragma: no cover
+    """Closes the database and SMTP connections of a worker process"""
+
+    close_pools()
+    _SCHEDULERS.clear()
+    for app in _APPS.values():
+        with app.app_context():
+            db.engine.dispose()
+    _APPS.clear()
 
 
 @celery.task
@@ -61,16 +158,8 @@ def send_message(json_message):  # pragma: no cover
     :rtype: bool
     """
     logger.info("Start send_message json_message: " + json_message)
-    global _APP
     tmp = json.loads(json_message)
-    # lazy init
-    if _APP is None:
-        from monolith.app import create_app
-
-        app = create_app(tmp["TESTING"])
-        db.init_app(app)
-    else:
-        app = _APP
+    app = _get_app(tmp["TESTING"])
     # update message state
     try:
         with app.app_context():
@@ -90,83 +179,108 @@ def send_message(json_message):  # pragma: no cover
 
 
 @celery.task
-def check_messages(test_mode):
-    """Check that messages have been sent correctly
-    
+def run_scheduler(test_mode):
+    """deliver the messages that are due and notify their recipients,
+    with the delivery scheduler of the worker process
     :param test_mode: determine the operating mode
     :type test_mode: bool
-    :raises Exception: if an error occurs
-    :returns: state of execution and number of messages sent
-    :rtype: couple (bool,int)
+    :returns: the number of delivered messages
+    :rtype: int
     """
-    global _APP
-    # lazy init
-    if _APP is None:
-        from monolith.app import create_app
+    app = _get_app(test_mode)
+    with app.app_context():
+        scheduler = _SCHEDULERS.get(bool(test_mode))
+        if scheduler is None:
+            scheduler = _SCHEDULERS[bool(test_mode)] = DeliveryScheduler(
+                horizon=timedelta(seconds=app.config["SCHEDULER_HORIZON"]),
+                refill_interval=timedelta(
+                    seconds=app.config["SCHEDULER_REFILL_INTERVAL"]
+                ),
+                capacity=app.config["SCHEDULER_CAPACITY"],
+                batch_size=app.config["SCHEDULER_BATCH_SIZE"],
+                on_delivered=_notify_delivered,
+            )
+        delivered = scheduler.tick()
+    if delivered:
+        logger.info("run_scheduler delivered: " + str(len(delivered)))
+    return len(delivered)
 
-        app = create_app(test_mode)
-        db.init_app(app)
-    else:
-        app = _APP
-    logger.info("Start check_message test_mode: " + str(test_mode))
-    result = False
+
+def _notify_delivered(messages):
+    """add to the outbox the task notifying the recipients of a batch of
+    messages, in the transaction delivering them
+    :param messages: the delivered messages
+    :type messages: list[Row]
+    """
+    payload = build_payload(
+        [(MESSAGE_RECEIVED, msg.recipient, msg.sender) for msg in messages],
+        current_app.config["TESTING"],
+    )
+    outbox.add(send_notification_task, [payload], "notification")
+
+
+@celery.task
+def relay_outbox(test_mode):
+    """send the tasks of the outbox to the broker, retrying the ones it
+    refuses with backoff
+    :param test_mode: determine the operating mode
+    :type test_mode: bool
+    :returns: the number of tasks sent
+    :rtype: int
+    """
+    app = _get_app(test_mode)
     with app.app_context():
-        try:
-            ids = check_message_to_send()
-            # for each message has been found as undelivered send notification
-            for id in ids:
-                email_s = get_user_mail(id[0])
-                email_r = get_user_mail(id[1])
-                json_message = build_json(
-                    email_s,
-                    email_r,
-                    "You have just received a message",
-                    app.config["TESTING"],
-                )
-                # send notification via celery
-                send_notification_task.apply_async(
-                    args=[json_message],
-                    routing_key="notification",
-                    queue="notification",
-                )
-            result = True
-        except Exception as e:
-            logger.exception("check_messages raises ", e)
-            raise e
-    # state and number of sent messages
-    couple = (result, len(ids))
-    logger.info("End check_message couple: " + str(couple))
-    return couple
+        sent = outbox.relay(
+            _publish,
+            app.config["OUTBOX_BATCH_SIZE"],
+            max_backoff=timedelta(seconds=app.config["OUTBOX_MAX_BACKOFF"]),
+        )
+    if sent:
+        logger.info("relay_outbox sent: " + str(sent))
+    return sent
+
+
+def _publish(name, args, queue):
+    celery.send_task(name, args=args, queue=queue, routing_key=queue)
 
 
 @celery.task
-def send_notification_task(json_message):
-    """send email via celery on notification queue
-    :param json_message: data to execute the task
-    :type json_message: json string
+def send_notification_task(payload):
+    """send emails via celery on notification queue, or keep them for the
+    next digest, according to the notification mode of each recipient
+    :param payload: notifications built by build_payload, or a JSON string
+        with the emails and the body of a notification (version 1)
+    :type payload: list or json string
     :raises Exception: if an error occurs
-    :returns : True if email is sent correctly otherwise False
-    :rtype: bool
+    :returns : the number of notifications sent or kept for a digest
+    :rtype: int
     """
-    logger.info("Start send_notification_task json_message: " + json_message)
-    global _APP
-    result = False
-    tmp = json.loads(json_message)
-    # lazy init
-    if _APP is None:
-        from monolith.app import create_app
-
-        app = create_app(tmp["TESTING"])
-        db.init_app(app)
+    logger.info("Start send_notification_task payload: " + str(payload))
+    result = 0
+    if isinstance(payload, str):
+        # enqueued before version 2
+        tmp = json.loads(payload)
+        testing = tmp["TESTING"]
     else:
-        app = _APP
+        version, testing, notifications = payload
+        if version != PAYLOAD_VERSION:
+            raise ValueError("Unsupported payload version %r" % version)
+    app = _get_app(testing)
     try:
         with app.app_context():
-            recipient = get_user_by_email(tmp["recipient"])
-            # Banned/deleted users shouldn't receive any notifications
-            if recipient is not None and recipient.is_active:
-                send_notification(tmp["sender"], tmp["recipient"], tmp["body"])
-                result = True
+            if isinstance(payload, str):
+                recipient = get_user_by_email(tmp["recipient"])
+                result += _notify(recipient, tmp["sender"], tmp["body"])
+            else:
+                # one lookup for all the recipients and senders
+                users = get_users_notification_settings(
+                    [n[1] for n in notifications]
+                    + [n[2] for n in notifications if n[2] is not None]
+                )
+                for kind, recipient, sender in notifications:
+                    sender = users[sender].email if sender in users else SYSTEM_SENDER
+                    body = NOTIFICATION_BODIES[kind].format(sender=sender)
+                    result += _notify(users.get(recipient), sender, body)
     except Exception as e:
         logger.exception("send_notification_task raises ", e)
         raise e
@@ -174,68 +288,110 @@ def send_notification_task(json_message):
     return result
 
 
+def _notify(recipient, sender, body):
+    """send a notification or keep it for the next digest of its recipient
+    :param recipient: the recipient, None if not found
+    :type recipient: User or Row
+    :param sender: sender of the notification
+    :type sender: string
+    :param body: content of the notification
+    :type body: string
+    :returns: True if sent or kept, False if the recipient is not notified
+    :rtype: bool
+    """
+    # Banned/deleted users shouldn't receive any notifications
+    if recipient is None or not recipient.is_active:
+        return False
+    mode = recipient.notification_mode or "digest"
+    if mode == "immediate":
+        send_notification(sender, recipient.email, body)
+    elif mode == "digest":
+        # sent by flush_notifications, with the next ones
+        buffer_notification(recipient.email, sender, body)
+    return mode != "off"
+
+
+@celery.task
+def flush_notifications(test_mode):
+    """send one digest email to each recipient whose digest is due
+    :param test_mode: determine the operating mode
+    :type test_mode: bool
+    :returns: the number of digests sent
+    :rtype: int
+    """
+    logger.info("Start flush_notifications test_mode: " + str(test_mode))
+    sent = 0
+    app = _get_app(test_mode)
+    with app.app_context():
+        window = timedelta(seconds=app.config["NOTIFICATION_DIGEST_WINDOW"])
+        max_latency = timedelta(seconds=app.config["NOTIFICATION_MAX_LATENCY"])
+        for email in get_due_recipients(window, max_latency):
+            notifications = claim_pending_notifications(email)
+            if notifications == []:
+                # flushed by a concurrent task
+                continue
+            recipient = get_user_by_email(email)
+            # the user could have been banned or opted out in the meanwhile
+            if (
+                recipient is not None
+                and recipient.is_active
+                and recipient.notification_mode != "off"
+            ):
+                sender, body = build_digest(notifications)
+                try:
+                    send_notification(sender, email, body)
+                except Exception as e:
+                    # kept for the next flush
+                    logger.exception("flush_notifications raises ", e)
+                    release_notifications(email, notifications)
+                    continue
+                sent += 1
+    logger.info("End flush_notifications sent: " + str(sent))
+    return sent
+
+
 @celery.task
 def lottery(test_mode):
-    """implement lottery game
+    """implement lottery game, LOTTERY_WINNERS users win 20 points each,
+    drawn with a chance proportional to their points if LOTTERY_WEIGHTED
     :param test_mode : determine the operating mode
     :type test_mode: bool
-    :returns: False in case errors occur otherwise True
-    :rtype: bool
+    :returns: False in case errors occur otherwise True, and the winners ids
+    :rtype: tuple(bool, list[int])
     """
     logger.info("Lottery game start")
-    global _APP
     result = False
-    id_winner = -1
-    # lazy init
-    if _APP is None:
-        from monolith.app import create_app
-
-        app = create_app(test_mode)
-        db.init_app(app)
-    else:
-        app = _APP
+    id_winners = []
+    app = _get_app(test_mode)
 
     with app.app_context():
-        # get all participants
-        participants = get_lottery_participants()
-        # extract the winner randomly
-        winner = random.randint(0, len(participants) - 1)
-        email_r = participants[winner].email
-        sender = "Message in a bottle"
-        json_message = build_json(
-            sender, email_r, "You have just won 20 points!", app.config["TESTING"]
+        # extract the winners randomly
+        winners = draw_lottery_winners(
+            app.config["LOTTERY_WINNERS"], app.config["LOTTERY_WEIGHTED"]
         )
-        if add_points(20, participants[winner].id):
-            # send mail to winner
-            send_notification_task.apply_async(
-                args=[json_message],
-                routing_key="notification",
-                queue="notification",
-            )
-            id_winner = participants[winner].id
-            result = True
-    logger.info("Lottery game end winner id: " + str(id_winner))
-    return (result, id_winner)
+        for id_winner, _ in winners:
+            if add_points(20, id_winner, commit=False) is not None:
+                # mail to the winner, sent once the points are committed
+                payload = build_payload(
+                    [(LOTTERY_WON, id_winner, None)], app.config["TESTING"]
+                )
+                outbox.add(send_notification_task, [payload], "notification")
+                db.session.commit()
+                id_winners.append(id_winner)
+        result = id_winners != []
+    logger.info("Lottery game end winners ids: " + str(id_winners))
+    return (result, id_winners)
 
 
-def build_json(sender, email_r, body, testing):
-    """build up json message to pass parameter via celery
-    :param sender : sender of the message
-    :type sender: string
-    :param email_r: receiver's email address
-    :type email_r: string
-    :param body: content of the message
-    :type body: string
+def build_payload(notifications, testing):
+    """build up the payload of send_notification_task: only the ids of the
+    users are sent, the workers look the rest up
+    :param notifications: kind, recipient id and sender id (None if sent
+        by the system) of each notification
+    :type notifications: list[tuple(int, int, int)]
     :param testing: test mode
     :type testing: bool
-    :returns: False in case errors occur otherwise True
-    :rtype: bool
+    :returns: the payload, versioned
+    :rtype: list
     """
-    return json.dumps(
-        {
-            "sender": sender,
-            "recipient": email_r,
-            "body": body,
-            "TESTING": testing,
-        }
-    )
+    return [PAYLOAD_VERSION, testing, [list(n) for n in notifications]]
@@ -0,0 +1,301 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# every named cache, to report their usage
+caches = {}
+# seconds the in-process entries of a cache with a shared backend are kept,
+# how long another process can serve an entry after it is invalidated
+LOCAL_TTL = 1
+# seconds an invalidated key cannot be cached again in a shared backend,
+# longer than a load, so that a value loaded before the invalidation is dropped
+INVALIDATION_TTL = 5
+# value of an invalidated key in a shared backend
+INVALIDATED = b""
+# when log_stats last logged the counters, by time.monotonic
+_logged = None
+_logged_lock = threading.Lock()
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache whose entries expire after ttl seconds.
+    An optional shared backend (e.g. RedisBackend) is used as a second level,
+    so that processes can share the entries they load. The in-process entries
+    then expire after local_ttl seconds, since the other processes do not see
+    the invalidations.
+    """
+
+    def __init__(self, name, maxsize=1024, ttl=60, backend=None, local_ttl=LOCAL_TTL):
+        """Creates an empty cache
+
+        :param name: name of the cache, used to report its usage
+        :type name: str
+        :param maxsize: maximum number of entries kept in memory, defaults to 1024
+        :type maxsize: int, optional
+        :param ttl: seconds after which an entry expires, defaults to 60
+        :type ttl: float, optional
+        :param backend: shared second level cache, defaults to None
+        :type backend: RedisBackend, optional
+        :param local_ttl: seconds after which an entry expires in memory if
+            there is a backend, defaults to LOCAL_TTL
+        :type local_ttl: float, optional
+        """
+
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = backend
+        self.local_ttl = local_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # bumped by every invalidation, see get_or_load
+        self._invalidations = 0
+        self._lock = threading.Lock()
+        caches[name] = self
+
+    def configure(self, maxsize=None, ttl=None, backend=None, local_ttl=None):
+        """Changes the settings of the cache, dropping all its entries
+
+        :param maxsize: maximum number of entries kept in memory
+        :type maxsize: int, optional
+        :param ttl: seconds after which an entry expires
+        :type ttl: float, optional
+        :param backend: shared second level cache
+        :type backend: RedisBackend, optional
+        :param local_ttl: seconds after which an entry expires in memory if
+            there is a backend
+        :type local_ttl: float, optional
+        """
+
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if ttl is not None:
+                self.ttl = ttl
+            if local_ttl is not None:
+                self.local_ttl = local_ttl
+            self.backend = backend
+            self._entries.clear()
+            self._invalidations += 1
+
+    def get(self, key, default=None):
+        """Returns the value cached for a key
+
+        :param key: the key to look up
+        :param default: value returned on a miss, defaults to None
+        :returns: the cached value, default if missing or expired
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+        if self.backend is not None:
+            value = self.backend.get(key)
+            if value is not None:
+                self._store(key, value, now)
+                with self._lock:
+                    self.hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def set(self, key, value):
+        """Caches a value, writing it through to the shared backend
+
+        :param key: the key of the entry
+        :param value: the value to cache, must not be None
+        """
+
+        self._store(key, value, time.monotonic())
+        if self.backend is not None:
+            self.backend.set(key, value, self.ttl)
+
+    def get_or_load(self, key, loader):
+        """Returns the value cached for a key, loading and caching it on a miss.
+        A value is not cached if the key is invalidated while it is loaded,
+        in this process or through the shared backend, as it may be stale
+
+        :param key: the key to look up
+        :param loader: function computing the value of the key
+        :type loader: Callable[[], Any]
+        :returns: the cached or loaded value
+        """
+
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            invalidations = self._invalidations
+        value = loader()
+        if self._invalidations != invalidations:
+            return value
+        if self.backend is not None and not self.backend.add(key, value, self.ttl):
+            # invalidated by another process, or loaded by it meanwhile
+            return value
+        with self._lock:
+            if self._invalidations == invalidations:
+                self._store_locked(key, value, time.monotonic())
+        return value
+
+    def delete(self, key):
+        """Invalidates an entry, also in the shared backend
+
+        :param key: the key of the entry
+        """
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._invalidations += 1
+        if self.backend is not None:
+            self.backend.delete(key)
+
+    def clear(self):
+        """Drops all the in-process entries and resets the counters"""
+
+        with self._lock:
+            self._entries.clear()
+            self._invalidations += 1
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """Returns the usage counters of the cache, to size it
+
+        :returns: hits, misses, current and maximum size
+        :rtype: dict
+        """
+
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+            }
+
+    def _store(self, key, value, now):
+        with self._lock:
+            self._store_locked(key, value, now)
+
+    def _store_locked(self, key, value, now):
+        ttl = self.ttl if self.backend is None else min(self.ttl, self.local_ttl)
+        self._entries[key] = (now + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+def get_stats():
+    """Returns the usage counters of every named cache
+
+    :returns: the stats of each cache, by name
+    :rtype: dict[str, dict]
+    """
+
+    return {name: cache.stats() for name, cache in caches.items()}
+
+
+def log_stats(interval):
+    """Prints the usage counters of every named cache, at most once every
+    interval seconds, e.g. after every request
+
+    :param interval: minimum seconds between two logs
+    :type interval: float
+    :returns: True if they have been logged, False otherwise
+    :rtype: bool
+    """
+
+    global _logged
+
+    now = time.monotonic()
+    with _logged_lock:
+        if _logged is not None and now - _logged < interval:
+            return False
+        _logged = now
+    for name, stats in get_stats().items():
+        print("Stats of cache %s:" % name, stats)
+    return True
+
+
+class RedisBackend:
+    """Shared cache level stored in Redis. An invalidated key is replaced by
+    a marker for INVALIDATION_TTL seconds, during which add does not store it
+    """
+
+    def __init__(self, url, prefix, dumps=json.dumps, loads=json.loads):
+        """Connects to a Redis server
+
+        :param url: url of the Redis server
+        :type url: str
+        :param prefix: prefix of the keys, to share a server among caches
+        :type prefix: str
+        :param dumps: serializes a value, defaults to json.dumps
+        :type dumps: Callable[[Any], str], optional
+        :param loads: deserializes a value, defaults to json.loads
+        :type loads: Callable[[bytes], Any], optional
+        """
+
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.dumps = dumps
+        self.loads = loads
+
+    def get(self, key):
+        try:
+            data = self.client.get(self.prefix + str(key))
+        except Exception as e:
+            # the cache must not break the service, fall back to the database
+            print("Exception in RedisBackend.get:", e)
+            return None
+        if data is None or data == INVALIDATED:
+            return None
+        return self.loads(data)
+
+    def set(self, key, value, ttl):
+        try:
+            self.client.set(
+                self.prefix + str(key), self.dumps(value), ex=max(1, int(ttl))
+            )
+        except Exception as e:
+            print("Exception in RedisBackend.set:", e)
+
+    def add(self, key, value, ttl):
+        """Stores a value unless the key is cached or invalidated
+
+        :returns: True if the value was stored
+        :rtype: bool
+        """
+
+        try:
+            return bool(
+                self.client.set(
+                    self.prefix + str(key),
+                    self.dumps(value),
+                    ex=max(1, int(ttl)),
+                    nx=True,
+                )
+            )
+        except Exception as e:
+            print("Exception in RedisBackend.add:", e)
+            # cache it in the process for local_ttl seconds
+            return True
+
+    def delete(self, key):
+        try:
+            self.client.set(self.prefix + str(key), INVALIDATED, ex=INVALIDATION_TTL)
+        except Exception as e:
+            print("Exception in RedisBackend.delete:", e)
@@ -0,0 +1,32 @@
+from monolith.database import BlackList, Message, User, db
+
+
+def last_user_id():
+    """Returns the id of the last user, to delete the ones created after it
+
+    :returns: the id of the last user, 0 if there are none
+    :rtype: int
+    """
+
+    return db.session.query(db.func.max(User.id)).scalar() or 0
+
+
+def delete_users_after(user_id):
+    """Deletes the users created by a test, with what they sent, received
+    and blacklisted, so that the test can create them again on the same
+    database: their emails are unique
+
+    :param user_id: the id of the last user before the test
+    :type user_id: int
+    """
+
+    db.session.rollback()
+    users = [id for id, in db.session.query(User.id).filter(User.id > user_id)]
+    db.session.query(Message).filter(
+        Message.sender.in_(users) | Message.recipient.in_(users)
+    ).delete(synchronize_session=False)
+    db.session.query(BlackList).filter(
+        BlackList.owner.in_(users) | BlackList.member.in_(users)
+    ).delete(synchronize_session=False)
+    db.session.query(User).filter(User.id.in_(users)).delete(synchronize_session=False)
+    db.session.commit()
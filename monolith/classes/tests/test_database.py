@@ -0,0 +1,130 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from sqlalchemy import inspect
+
+import monolith.user_query
+from monolith.app import create_app, create_test_app
+from monolith.database import REPLICA_BIND, User, db, read_session, upgrade_schema
+
+
+class TestDatabase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_test_app()
+        self.client = self.app.test_client()
+        self._ctx = self.app.test_request_context()
+        self._ctx.push()
+
+    def tearDown(self):
+        self._ctx.pop()
+
+    def _indexes(self, table):
+        return {i["name"]: i for i in inspect(db.engine).get_indexes(table)}
+
+    def test_indexes(self):
+        indexes = self._indexes("message")
+        assert indexes["ix_message_inbox"]["column_names"] == [
+            "recipient",
+            "is_delivered",
+            "is_draft",
+            "is_deleted",
+        ]
+        assert indexes["ix_message_outbox"]["column_names"] == [
+            "sender",
+            "is_draft",
+            "delivery_date",
+        ]
+        assert "ix_message_pending" in indexes
+        assert self._indexes("user")["ix_user_email"]["unique"]
+
+    def test_upgrade_schema(self):
+        # nothing to do on an up to date database
+        assert upgrade_schema() == []
+
+        # simulate a database created before the indexes were introduced
+        db.session.execute("DROP INDEX ix_message_pending")
+        db.session.execute("DROP INDEX ix_user_email")
+        db.session.commit()
+        assert "ix_message_pending" not in self._indexes("message")
+
+        assert sorted(upgrade_schema()) == ["ix_message_pending", "ix_user_email"]
+        assert "ix_message_pending" in self._indexes("message")
+        assert "ix_user_email" in self._indexes("user")
+        assert upgrade_schema() == []
+
+        # and before a column was introduced
+        db.session.execute("ALTER TABLE user DROP COLUMN notification_mode")
+        db.session.commit()
+        assert upgrade_schema() == ["user.notification_mode"]
+        mode = db.session.execute("SELECT notification_mode FROM user").scalar()
+        assert mode == "digest"
+        assert upgrade_schema() == []
+
+    def test_sqlite_profile(self):
+        # every connection is tuned when opened
+        pragmas = {
+            "journal_mode": "wal",
+            "synchronous": 1,
+            "busy_timeout": 5000,
+            "mmap_size": 256 * 1024 * 1024,
+            "cache_size": -64 * 1024,
+            "temp_store": 2,
+        }
+        connections = [db.engine.connect() for _ in range(2)]
+        for connection in connections:
+            for name, value in pragmas.items():
+                assert connection.execute("PRAGMA " + name).scalar() == value
+            connection.close()
+
+        # and kept open in a pool sized for the process
+        assert db.engine.pool.size() == self.app.config["DB_POOL_SIZE"] == 8
+        worker = create_app(True, worker=True)
+        assert worker.config["DB_POOL_SIZE"] == 2
+        with worker.app_context():
+            assert db.engine.pool.size() == 2
+
+    def test_read_replica(self):
+        # two files, the replica has the schema but not the rows yet
+        directory = tempfile.mkdtemp()
+        urls = {
+            "TEST_DATABASE_URL": "sqlite:///" + os.path.join(directory, "primary.db"),
+            "TEST_DATABASE_REPLICA_URL": "sqlite:///"
+            + os.path.join(directory, "replica.db"),
+        }
+        with mock.patch.dict(os.environ, urls):
+            app = create_app(True)
+        app.config["DATABASE_REPLICA_LAG"] = 0
+        db.metadata.create_all(bind=db.get_engine(app, REPLICA_BIND))
+
+        with app.app_context(), app.test_request_context():
+            # the read-only queries are served by the replica
+            assert read_session() is not db.session
+            assert monolith.user_query.get_blacklist_candidates(999) == []
+            assert db.session.query(User).count() == 1
+            assert read_session() is not db.session
+
+            # until the request writes to the primary
+            db.session.query(User).filter(User.id == 1).update(
+                {User.content_filter: True}
+            )
+            db.session.commit()
+            assert read_session() is db.session
+            assert monolith.user_query.get_blacklist_candidates(999) == [
+                (1, "example@example.com")
+            ]
+
+        # the client reads the primary for a while after writing to it
+        client = app.test_client()
+        reply = client.post(
+            "/login", data=dict(email="example@example.com", password="admin")
+        )
+        assert reply.status_code == 302
+        assert client.get("/api/user/1").status_code == 404
+        client.post("/api/content_filter/", data=dict(filter="0"))
+        assert client.get("/api/user/1").status_code == 404
+
+        app.config["DATABASE_REPLICA_LAG"] = 60
+        client.post("/api/content_filter/", data=dict(filter="1"))
+        assert client.get("/api/user/1").get_json()["firstname"] == "Admin"
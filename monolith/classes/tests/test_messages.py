@@ -1,22 +1,46 @@
 import io
+import os
+import stat
+import tempfile
 import time
 import unittest
 import time
 import json
 from datetime import datetime, timedelta
 
+from werkzeug.datastructures import FileStorage
 from werkzeug.test import Client
 
-from monolith.database import Message, User, db
+from monolith.database import Attachment, BlackList, Message, User, db
 from monolith.app import create_test_app
+from monolith.attachments import (
+    FILE_MODE,
+    acquire,
+    collect,
+    move_uploads,
+    release,
+    store,
+)
+from monolith.background import _SCHEDULERS, run_scheduler
+from monolith.classes.tests import delete_users_after, last_user_id
+from monolith.user_query import add_points
 from monolith.message_query import (
+    censor_cache,
+    claim_messages,
+    delete_user_message,
     get_day_message,
+    get_pending_messages,
     get_received_message,
+    get_received_messages_metadata,
+    get_sent_messages_metadata,
+    save_message,
     get_sent_message,
+    reschedule_message,
     set_message_is_deleted_lottery,
     unmark_draft,
     update_message_state,
 )
+from monolith.scheduler import DeliveryScheduler, TimingWheel
 
 
 class TestApp(unittest.TestCase):
@@ -25,6 +49,11 @@ class TestApp(unittest.TestCase):
         self.client = self.app.test_client()
         self._ctx = self.app.test_request_context()
         self._ctx.push()
+        self._last_user = last_user_id()
+
+    def tearDown(self):
+        delete_users_after(self._last_user)
+        self._ctx.pop()
 
     def test_unauthorised_access(self):
         reply = self.client.post("/api/message/draft", data=dict(text=""))
@@ -78,7 +107,7 @@ class TestApp(unittest.TestCase):
         )
         data = reply.get_json()
         assert reply.status_code == 200
-        assert data["message_id"] == 1
+        draft_id = data["message_id"]
 
         reply = self.client.get("/api/message/draft/all")
         data = reply.get_json()
@@ -102,12 +131,12 @@ class TestApp(unittest.TestCase):
         assert data[0]["text"] == "Lorem ipsum dolor..."
         assert data[0]["media"] == ""
 
-        reply = self.client.delete("/api/message/draft/1")
+        reply = self.client.delete("/api/message/draft/" + str(draft_id))
         data = reply.get_json()
         assert reply.status_code == 200
-        assert int(data["message_id"]) == 1
+        assert int(data["message_id"]) == draft_id
 
-        reply = self.client.delete("/api/message/draft/1")
+        reply = self.client.delete("/api/message/draft/" + str(draft_id))
         data = reply.get_json()
         assert reply.status_code == 404
 
@@ -174,8 +203,14 @@ class TestApp(unittest.TestCase):
         reply = self.client.get("/api/message/sent/metadata", follow_redirects=True)
         assert len(reply.get_json()) == 0
 
-        print("Waiting for the message delivery...", end=" ", flush=True)
-        time.sleep(10)
+        # deliver it as the periodic task of the workers does once it is due,
+        # the scheduler has a resolution of a second
+        time.sleep(max((delivery_date - datetime.now()).total_seconds() + 1, 0))
+        try:
+            # unless the beat of a test mode worker already did
+            run_scheduler(True)
+        finally:
+            _SCHEDULERS.pop(True, None)
 
         # get sent message
         reply = self.client.get("/api/message/sent/metadata", follow_redirects=True)
@@ -425,3 +460,700 @@ class TestApp(unittest.TestCase):
         
         reply = self.client.get("/api/calendar/1/1/2222")
         assert reply.get_json() == []
+
+    def test_received_metadata_pagination(self):
+        # a recipient, a regular sender, a banned sender and a blacklisted one
+        users = []
+        for name in ["inbox_rcv", "inbox_snd", "inbox_ban", "inbox_blk"]:
+            user = User()
+            user.firstname = name
+            user.lastname = name
+            user.email = name + "@test.com"
+            user.set_password(name)
+            user.reports = 3 if name == "inbox_ban" else 0
+            db.session.add(user)
+            users.append(user)
+        db.session.commit()
+        recipient, sender, banned, blocked = [u.id for u in users]
+        db.session.add(BlackList(owner=recipient, member=blocked))
+
+        for snd in [sender] * 5 + [banned, blocked]:
+            msg = Message()
+            msg.sender = snd
+            msg.recipient = recipient
+            msg.text = "inbox"
+            msg.is_draft = False
+            msg.is_delivered = True
+            msg.delivery_date = datetime.now()
+            db.session.add(msg)
+        db.session.commit()
+
+        # only the messages of the regular sender are listed, in order
+        data = [json.loads(m) for m in get_received_messages_metadata(recipient)]
+        assert len(data) == 5
+        assert all(m["sender_id"] == sender for m in data)
+        ids = [m["id_message"] for m in data]
+        assert ids == sorted(ids)
+
+        # walk the inbox two messages at a time
+        pages, cursor = [], None
+        while True:
+            page = get_received_messages_metadata(recipient, cursor, 2)
+            if page == []:
+                break
+            pages.append([json.loads(m)["id_message"] for m in page])
+            cursor = pages[-1][-1]
+        assert pages == [ids[0:2], ids[2:4], ids[4:5]]
+
+        # the endpoint honours the cursor as well
+        reply = self.client.post(
+            "/login",
+            data=dict(email="inbox_rcv@test.com", password="inbox_rcv"),
+            follow_redirects=True,
+        )
+        assert reply.status_code == 200
+        reply = self.client.get(
+            "/api/message/received/metadata?after=" + str(ids[2]) + "&limit=10"
+        )
+        assert [json.loads(m)["id_message"] for m in reply.get_json()] == ids[3:]
+        self.client.get("/logout")
+
+        db.session.query(Message).filter(Message.recipient == recipient).delete()
+        db.session.query(BlackList).filter(BlackList.owner == recipient).delete()
+        db.session.commit()
+
+    def test_sent_metadata_pagination(self):
+        users = []
+        for name in ["outbox_snd", "outbox_rcv"]:
+            user = User()
+            user.firstname = name
+            user.lastname = name
+            user.email = name + "@test.com"
+            user.set_password(name)
+            db.session.add(user)
+            users.append(user)
+        db.session.commit()
+        sender, recipient = [u.id for u in users]
+
+        # one message delivered per day, plus a pending one
+        base = datetime(2021, 11, 1)
+        for i in range(6):
+            msg = Message()
+            msg.sender = sender
+            msg.recipient = recipient
+            msg.text = "outbox"
+            msg.is_draft = False
+            msg.is_delivered = i < 5
+            msg.delivery_date = base + timedelta(days=i)
+            db.session.add(msg)
+        db.session.commit()
+
+        data = get_sent_messages_metadata(sender)
+        assert len(data) == 5
+        assert all(m["recipient_id"] == recipient for m in data)
+        assert all(m["email"] == "outbox_rcv@test.com" for m in data)
+        ids = [m["id_message"] for m in data]
+
+        page = get_sent_messages_metadata(sender, ids[1], 2)
+        assert [m["id_message"] for m in page] == ids[2:4]
+
+        since = get_sent_messages_metadata(sender, since=base + timedelta(days=3))
+        assert [m["id_message"] for m in since] == ids[3:]
+
+        reply = self.client.post(
+            "/login",
+            data=dict(email="outbox_snd@test.com", password="outbox_snd"),
+            follow_redirects=True,
+        )
+        assert reply.status_code == 200
+        reply = self.client.get(
+            "/api/message/sent/metadata?limit=1&since="
+            + (base + timedelta(days=1)).isoformat()
+        )
+        assert [m["id_message"] for m in reply.get_json()] == ids[1:2]
+        reply = self.client.get("/api/message/sent/metadata?since=yesterday")
+        assert reply.status_code == 400
+        self.client.get("/logout")
+
+        db.session.query(Message).filter(Message.sender == sender).delete()
+        db.session.commit()
+
+    def test_monthly_summary(self):
+        recipient = User()
+        recipient.firstname = "summary"
+        recipient.lastname = "summary"
+        recipient.email = "summary@test.com"
+        recipient.set_password("summary")
+        db.session.add(recipient)
+        db.session.commit()
+        recipient_id = recipient.id
+
+        # two messages on the 3rd, one on the 20th, one the next month and a draft
+        dates = [
+            datetime(2021, 6, 3, 10),
+            datetime(2021, 6, 3, 18),
+            datetime(2021, 6, 20),
+            datetime(2021, 7, 1),
+        ]
+        for delivery_date in dates + [datetime(2021, 6, 4)]:
+            msg = Message()
+            msg.sender = recipient_id
+            msg.recipient = 1
+            msg.text = "summary"
+            msg.is_draft = delivery_date not in dates
+            msg.is_delivered = True
+            msg.delivery_date = delivery_date
+            db.session.add(msg)
+        db.session.commit()
+
+        reply = self.client.post(
+            "/login",
+            data=dict(email="summary@test.com", password="summary"),
+            follow_redirects=True,
+        )
+        assert reply.status_code == 200
+
+        reply = self.client.get("/api/calendar/5/2021/summary")
+        assert reply.status_code == 200
+        assert reply.get_json() == [{"day": 3, "count": 2}, {"day": 20, "count": 1}]
+
+        reply = self.client.get("/api/calendar/11/2021/summary")
+        assert reply.get_json() == []
+
+        for month, year in [(12, 2021), (0, 0), (11, 9999), (0, 10000)]:
+            reply = self.client.get("/api/calendar/%d/%d/summary" % (month, year))
+            assert reply.status_code == 400
+
+        # the day view lists the messages of that day in order
+        reply = self.client.get("/api/calendar/3/5/2021")
+        data = reply.get_json()
+        assert [m["email"] for m in data] == ["example@example.com"] * 2
+        assert not any(m["future"] or m["candelete"] for m in data)
+        self.client.get("/logout")
+
+        db.session.query(Message).filter(Message.sender == recipient_id).delete()
+        db.session.commit()
+
+    def test_timing_wheel(self):
+        start = datetime(2021, 12, 1, 10, 0, 0)
+        wheel = TimingWheel(start)
+        # due in a second, in a minute and a half and in the past
+        wheel.add("a", start + timedelta(seconds=1))
+        wheel.add("b", start + timedelta(seconds=90, milliseconds=500))
+        wheel.add("c", start - timedelta(days=1))
+        assert len(wheel) == 3
+
+        assert wheel.advance(start) == ["c"]
+        assert wheel.advance(start + timedelta(seconds=1)) == ["a"]
+        # never returned before its due time
+        assert wheel.advance(start + timedelta(seconds=90)) == []
+        assert wheel.advance(start + timedelta(seconds=91)) == ["b"]
+        assert len(wheel) == 0
+
+        # beyond the span of the wheel
+        wheel.add("d", start + timedelta(hours=5))
+        assert wheel.advance(start + timedelta(hours=4)) == []
+        assert wheel.advance(start + timedelta(hours=5)) == ["d"]
+
+    def test_delivery_scheduler(self):
+        now = datetime.now().replace(microsecond=0)
+        # deliver whatever the previous tests left behind
+        DeliveryScheduler(horizon=timedelta(0), now=now).tick(now)
+
+        ids = []
+        for delay in [-60, 10, 20, 30, 24 * 60 * 60]:
+            msg = Message()
+            msg.sender = 1
+            msg.recipient = 1
+            msg.text = "scheduled in " + str(delay)
+            msg.is_draft = False
+            msg.delivery_date = now + timedelta(seconds=delay)
+            db.session.add(msg)
+            db.session.commit()
+            ids.append(msg.message_id)
+
+        def delivered():
+            q = db.session.query(Message.message_id).filter(
+                Message.message_id.in_(ids), Message.is_delivered == True
+            )
+            return sorted(id for id, in q)
+
+        scheduler = DeliveryScheduler(
+            horizon=timedelta(seconds=15), capacity=2, batch_size=1, now=now
+        )
+        # the overdue message is delivered at once, the one in a day never read
+        assert [msg.message_id for msg in scheduler.tick(now)] == ids[:1]
+        assert len(scheduler) == 1
+
+        # the message in 20 seconds is rescheduled later
+        msg = db.session.query(Message).get(ids[2])
+        msg.delivery_date = now + timedelta(seconds=25)
+        db.session.commit()
+        assert scheduler.tick(now + timedelta(seconds=9)) == []
+        rows = scheduler.tick(now + timedelta(seconds=10))
+        assert [(msg.message_id, msg.recipient) for msg in rows] == [(ids[1], 1)]
+
+        # a message saved in the meanwhile is read before the next full refill
+        msg = Message(sender=1, recipient=1, text="late", is_draft=False)
+        msg.delivery_date = now + timedelta(seconds=12)
+        db.session.add(msg)
+        db.session.commit()
+        ids.append(msg.message_id)
+        # only the messages changed since the last read are read again
+        changed = get_pending_messages(
+            now + timedelta(days=2), changed_since=msg.updated
+        )
+        assert [row.message_id for row in changed] == [ids[5]]
+        rows = scheduler.tick(now + timedelta(seconds=13))
+        assert [msg.message_id for msg in rows] == [ids[5]]
+
+        # and so is the message in a day, rescheduled earlier
+        changed = datetime.now()
+        assert reschedule_message(1, ids[4], now + timedelta(seconds=14))
+        rows = get_pending_messages(now + timedelta(days=2), changed_since=changed)
+        assert [row.message_id for row in rows] == [ids[4]]
+        rows = scheduler.tick(now + timedelta(seconds=14))
+        assert [msg.message_id for msg in rows] == [ids[4]]
+
+        rows = scheduler.tick(now + timedelta(seconds=60))
+        assert sorted(msg.message_id for msg in rows) == [ids[2], ids[3]]
+        assert delivered() == sorted(ids)
+        # a message is claimed only once
+        assert claim_messages(ids, now + timedelta(days=2)) == []
+
+        # a message already in the wheel is delivered on time once moved earlier
+        start = now + timedelta(seconds=100)
+        msg = Message(sender=1, recipient=1, text="moved", is_draft=False)
+        msg.delivery_date = start + timedelta(seconds=200)
+        db.session.add(msg)
+        db.session.commit()
+        ids.append(msg.message_id)
+        scheduler = DeliveryScheduler(now=start)
+        assert scheduler.tick(start) == []
+        assert len(scheduler) == 1
+        assert reschedule_message(1, ids[6], start + timedelta(seconds=10))
+        rows = scheduler.tick(start + timedelta(seconds=10))
+        assert [msg.message_id for msg in rows] == [ids[6]]
+        assert len(scheduler) == 0
+        # and its previous entry is skipped
+        assert ids[6] not in [
+            msg.message_id for msg in scheduler.tick(start + timedelta(seconds=200))
+        ]
+
+        db.session.query(Message).filter(Message.message_id.in_(ids)).delete(
+            synchronize_session=False
+        )
+        db.session.commit()
+
+    def test_reschedule_message(self):
+        reply = self.client.post(
+            "/login",
+            data=dict(email="example@example.com", password="admin"),
+            follow_redirects=True,
+        )
+        assert reply.status_code == 200
+
+        ids = []
+        for sender, is_delivered in [(1, False), (1, True), (2, False)]:
+            msg = Message(sender=sender, recipient=1, text="reschedule me")
+            msg.is_draft = False
+            msg.is_delivered = is_delivered
+            msg.delivery_date = datetime.now() + timedelta(days=1)
+            db.session.add(msg)
+            db.session.commit()
+            ids.append(msg.message_id)
+
+        # the pending message is moved, without a new one
+        count = db.session.query(Message).count()
+        date = datetime.now() + timedelta(days=2)
+        reply = self.client.patch(
+            "/api/message/%d/delivery_date" % ids[0],
+            data={"delivery_date": date.isoformat()},
+        )
+        assert reply.status_code == 200
+        assert reply.get_json() == {
+            "message_id": ids[0],
+            "delivery_date": date.isoformat(),
+        }
+        db.session.expire_all()
+        assert db.session.query(Message).get(ids[0]).delivery_date == date
+        assert db.session.query(Message).count() == count
+
+        # the date must be valid and in the future
+        for value in ["", "tomorrow", (datetime.now() - timedelta(1)).isoformat()]:
+            reply = self.client.patch(
+                "/api/message/%d/delivery_date" % ids[0], data={"delivery_date": value}
+            )
+            assert reply.status_code == 400
+        # delivered messages and the ones of other users cannot be moved
+        for id in ids[1:]:
+            reply = self.client.patch(
+                "/api/message/%d/delivery_date" % id,
+                data={"delivery_date": date.isoformat()},
+            )
+            assert reply.status_code == 404
+        self.client.get("/logout")
+
+        db.session.query(Message).filter(Message.message_id.in_(ids)).delete(
+            synchronize_session=False
+        )
+        db.session.commit()
+
+    def test_censored_message(self):
+        recipient = User()
+        recipient.firstname = "censor"
+        recipient.lastname = "censor"
+        recipient.email = "censor@test.com"
+        recipient.content_filter = True
+        db.session.add(recipient)
+        db.session.commit()
+
+        msg = Message()
+        msg.sender = 1
+        msg.recipient = recipient.id
+        msg.text = "what the shit"
+        msg.is_draft = False
+        msg.is_delivered = True
+        msg.delivery_date = datetime.now()
+        db.session.add(msg)
+        db.session.commit()
+
+        censor_cache.clear()
+        for _ in range(3):
+            censored = get_received_message(recipient.id, msg.message_id)
+            assert censored.text == "what the ****"
+        # the text has been censored once, the original one is untouched
+        assert censor_cache.stats()["misses"] == 1
+        assert msg.text == "what the shit"
+        db.session.commit()
+        db.session.expire_all()
+        assert db.session.query(Message).get(msg.message_id).text == "what the shit"
+
+        message_id = msg.message_id
+        db.session.delete(db.session.query(Message).get(message_id))
+        db.session.commit()
+
+        # a new message given the id of the deleted one is censored again
+        msg = Message()
+        msg.message_id = message_id
+        msg.sender = 1
+        msg.recipient = recipient.id
+        msg.text = "oh shit, again"
+        msg.is_draft = False
+        msg.is_delivered = True
+        msg.delivery_date = datetime.now()
+        db.session.add(msg)
+        db.session.commit()
+        censored = get_received_message(recipient.id, message_id)
+        assert censored.text == "oh ****, again"
+
+    def test_send_message_bulk(self):
+        recipients = []
+        for i in range(3):
+            user = User()
+            user.firstname = "bulk"
+            user.lastname = str(i)
+            user.email = "bulk" + str(i) + "@test.com"
+            db.session.add(user)
+            recipients.append(user)
+        db.session.commit()
+        recipients = {u.id: u.email for u in recipients}
+
+        reply = self.client.post(
+            "/login",
+            data=dict(email="example@example.com", password="admin"),
+            follow_redirects=True,
+        )
+        assert reply.status_code == 200
+
+        reply = self.client.post(
+            "/api/message/",
+            data={
+                "recipient": list(recipients),
+                "text": "Hello everybody!",
+                "delivery_date": datetime.now() + timedelta(days=1),
+                "draft_id": "",
+                "attachment": (io.BytesIO(b"A shared JPG"), "bulk.jpg"),
+            },
+            content_type="multipart/form-data",
+        )
+        assert reply.status_code == 200
+
+        messages = (
+            db.session.query(Message)
+            .filter(Message.recipient.in_(recipients), Message.sender == 1)
+            .all()
+        )
+        ids = [m.message_id for m in messages]
+        assert len(ids) == 3
+        assert {m.recipient for m in messages} == set(recipients)
+        # the attachment has been stored once for all the recipients
+        assert len({m.media for m in messages}) == 1
+        assert not any(m.is_draft or m.is_delivered for m in messages)
+
+        # delivering the batch twice has no effect
+        now = datetime.now() + timedelta(days=2)
+        assert sorted(row.message_id for row in claim_messages(ids, now)) == sorted(ids)
+        assert claim_messages(ids, now) == []
+        self.client.get("/logout")
+
+        db.session.query(Message).filter(Message.message_id.in_(ids)).delete(
+            synchronize_session=False
+        )
+        db.session.commit()
+
+    def test_shared_attachment(self):
+        reply = self.client.post(
+            "/login",
+            data=dict(email="example@example.com", password="admin"),
+            follow_redirects=True,
+        )
+        assert reply.status_code == 200
+
+        contents = b"A JPG uploaded twice"
+        ids = []
+        for _ in range(2):
+            reply = self.client.post(
+                "/api/message/draft",
+                data={
+                    "text": "A draft with an attachment",
+                    "draft_id": "",
+                    "delivery_date": "",
+                    "attachment": (io.BytesIO(contents), "twice.jpg"),
+                },
+                content_type="multipart/form-data",
+            )
+            assert reply.status_code == 200
+            ids.append(reply.get_json()["message_id"])
+
+        # the same contents are stored once, named after their hash
+        drafts = [db.session.query(Message).get(id) for id in ids]
+        media = drafts[0].media
+        assert drafts[1].media == media
+        path = os.path.join(self.app.config["UPLOAD_FOLDER"], media)
+        assert os.path.exists(path)
+        # readable by a front-end server running as another user
+        assert stat.S_IMODE(os.stat(path).st_mode) == FILE_MODE
+        assert db.session.query(Attachment).get(media).refcount == 2
+
+        # the second draft is sent to 3 recipients
+        reply = self.client.post(
+            "/api/message/",
+            data={
+                "recipient": [1, 1, 1],
+                "text": "Sent to many",
+                "delivery_date": datetime.now() + timedelta(days=1),
+                "draft_id": ids[1],
+            },
+        )
+        assert reply.status_code == 200
+        q = db.session.query(Message.message_id).filter(Message.text == "Sent to many")
+        sent = [id for id, in q]
+        assert len(sent) == 3
+        assert ids[1] in sent
+        assert db.session.query(Attachment).get(media).refcount == 4
+
+        # the file is removed with the last message referencing it
+        for id in [ids[0]] + sent:
+            assert os.path.exists(path)
+            delete_user_message(1, id)
+        assert not os.path.exists(path)
+        assert db.session.query(Attachment).get(media) is None
+        self.client.get("/logout")
+
+    def test_attachment_too_large(self):
+        reply = self.client.post(
+            "/login",
+            data=dict(email="example@example.com", password="admin"),
+            follow_redirects=True,
+        )
+        assert reply.status_code == 200
+
+        folder = self.app.config["UPLOAD_FOLDER"]
+        self.app.config["MAX_ATTACHMENT_SIZE"] = 1024
+        replies = []
+        for size, status in [(1024, 200), (1025, 413)]:
+            reply = self.client.post(
+                "/api/message/draft",
+                data={
+                    "text": "A draft with a big attachment",
+                    "draft_id": "",
+                    "delivery_date": "",
+                    "attachment": (io.BytesIO(b"\xff" * size), "big.png"),
+                },
+                content_type="multipart/form-data",
+            )
+            assert reply.status_code == status
+            replies.append(reply)
+            # the temporary files never outlive the request
+            assert [f for f in os.listdir(folder) if f.startswith(".upload-")] == []
+
+        draft = db.session.query(Message).get(replies[0].get_json()["message_id"])
+        assert os.path.getsize(os.path.join(folder, draft.media)) == 1024
+        delete_user_message(1, draft.message_id)
+        self.client.get("/logout")
+
+    def test_get_media(self):
+        reply = self.client.get("/api/media/missing.jpg")
+        assert reply.status_code == 401
+
+        reply = self.client.post(
+            "/login",
+            data=dict(email="example@example.com", password="admin"),
+            follow_redirects=True,
+        )
+        assert reply.status_code == 200
+
+        contents = b"0123456789 a downloaded attachment"
+        reply = self.client.post(
+            "/api/message/draft",
+            data={
+                "text": "A draft with an attachment",
+                "draft_id": "",
+                "delivery_date": "",
+                "attachment": (io.BytesIO(contents), "download.gif"),
+            },
+            content_type="multipart/form-data",
+        )
+        assert reply.status_code == 200
+        draft = db.session.query(Message).get(reply.get_json()["message_id"])
+        url = "/api/media/" + draft.media
+
+        reply = self.client.get(url)
+        assert reply.status_code == 200
+        assert reply.data == contents
+        assert reply.mimetype == "image/gif"
+        etag = reply.headers["ETag"]
+        assert etag == '"%s"' % draft.media.split(".")[0]
+        assert "immutable" in reply.headers["Cache-Control"]
+        assert reply.expires > datetime.now(reply.expires.tzinfo) + timedelta(days=300)
+
+        # conditional and range requests
+        reply = self.client.get(url, headers={"If-None-Match": etag})
+        assert reply.status_code == 304
+        reply = self.client.get(url, headers={"Range": "bytes=0-9"})
+        assert reply.status_code == 206
+        assert reply.data == b"0123456789"
+
+        # the web server can send the file
+        self.app.config["MEDIA_ACCEL_REDIRECT"] = "/protected/"
+        reply = self.client.get(url)
+        assert reply.status_code == 200
+        assert reply.headers["X-Accel-Redirect"] == "/protected/" + draft.media
+        assert reply.data == b""
+        self.app.config["MEDIA_ACCEL_REDIRECT"] = ""
+        self.app.config["USE_X_SENDFILE"] = True
+        reply = self.client.get(url, headers={"Range": "bytes=0-9"})
+        assert reply.status_code == 200
+        assert "X-Sendfile" in reply.headers
+        assert "Accept-Ranges" not in reply.headers
+        self.app.config["USE_X_SENDFILE"] = False
+
+        # the files are not public
+        self.client.get("/logout")
+        assert self.client.get("/static/user_uploads/" + draft.media).status_code == 404
+        assert self.client.get(url).status_code == 401
+        reply = self.client.post(
+            "/login",
+            data=dict(email="example@example.com", password="admin"),
+            follow_redirects=True,
+        )
+        assert reply.status_code == 200
+
+        # only the messages of the user give access to their files
+        delete_user_message(1, draft.message_id)
+        assert self.client.get(url).status_code == 404
+        assert self.client.get("/api/media/..%2Fapp.py").status_code == 404
+        self.client.get("/logout")
+
+    def test_move_uploads(self):
+        source = tempfile.mkdtemp()
+        folder = tempfile.mkdtemp()
+        for name, contents in [("a.jpg", b"moved"), ("b.jpg", b"stored")]:
+            with open(os.path.join(source, name), "wb") as f:
+                f.write(contents)
+            os.chmod(os.path.join(source, name), 0o600)
+        with open(os.path.join(folder, "b.jpg"), "wb") as f:
+            f.write(b"stored")
+        with open(os.path.join(source, ".upload-interrupted"), "wb") as f:
+            f.write(b"partial")
+
+        # the files are moved to the new folder and readable by the web server
+        assert sorted(move_uploads(source, folder)) == ["a.jpg", "b.jpg"]
+        assert not os.path.exists(source)
+        assert sorted(os.listdir(folder)) == ["a.jpg", "b.jpg"]
+        path = os.path.join(folder, "a.jpg")
+        assert stat.S_IMODE(os.stat(path).st_mode) == FILE_MODE
+        with open(path, "rb") as f:
+            assert f.read() == b"moved"
+
+        # once
+        assert move_uploads(source, folder) == []
+
+    def test_attachment_references(self):
+        def refcount():
+            db.session.expire_all()
+            attachment = db.session.query(Attachment).get(name)
+            return None if attachment is None else attachment.refcount
+
+        # the references are taken with the file
+        name = store(FileStorage(io.BytesIO(b"referenced"), "refs.png"), 2)
+        db.session.commit()
+        path = os.path.join(self.app.config["UPLOAD_FOLDER"], name)
+        assert os.path.exists(path)
+        assert refcount() == 2
+
+        # a file referenced again before it is collected is kept
+        release(name, 2)
+        acquire(name)
+        db.session.commit()
+        assert collect(name) == []
+        assert os.path.exists(path)
+
+        release(name)
+        db.session.commit()
+        assert collect(name) == [name]
+        assert not os.path.exists(path)
+        assert refcount() is None
+
+        # first references to a file inserted once
+        acquire(name)
+        acquire(name, 2)
+        db.session.commit()
+        assert refcount() == 3
+        release(name, 3)
+        db.session.commit()
+        collect(name)
+        assert refcount() is None
+
+    def test_lottery_delete(self):
+        now = datetime.now()
+        ids = []
+        for delivery_date in [now + timedelta(days=1), now - timedelta(days=1)]:
+            msg = Message()
+            msg.text = "A scheduled message"
+            msg.sender = 1
+            msg.recipient = 1
+            msg.delivery_date = delivery_date
+            msg.is_draft = False
+            msg.is_delivered = False
+            ids.append(save_message(msg))
+
+        user = db.session.query(User).get(1)
+        user.points = 59
+        db.session.commit()
+
+        # not enough points, nothing changes
+        assert not set_message_is_deleted_lottery(ids[0])
+        assert db.session.query(Message).get(ids[0]) is not None
+        assert db.session.query(User.points).filter(User.id == 1).scalar() == 59
+
+        # the message is deleted and the points spent together
+        add_points(1, 1)
+        assert not set_message_is_deleted_lottery(ids[1])
+        assert set_message_is_deleted_lottery(ids[0])
+        assert db.session.query(Message).get(ids[0]) is None
+        assert db.session.query(User.points).filter(User.id == 1).scalar() == 0
+        assert not set_message_is_deleted_lottery(ids[0])
+        db.session.query(Message).filter(Message.message_id == ids[1]).delete()
+        db.session.commit()
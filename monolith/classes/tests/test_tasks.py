@@ -1,12 +1,39 @@
 import json
 import random
+import smtplib
+import sys
 import unittest
+from email.message import EmailMessage
+from unittest import mock
 from datetime import datetime, timedelta
 
+from kombu.serialization import dumps, loads
+
 from monolith.app import create_test_app
-from monolith.background import check_messages, lottery, send_notification_task
-from monolith.database import Message, User, db
-from monolith.notifications import EmailConfig, send_notification
+import monolith.background
+import monolith.user_query
+from monolith.background import (
+    LOTTERY_WON,
+    MESSAGE_READ,
+    MESSAGE_RECEIVED,
+    PAYLOAD_VERSION,
+    SYSTEM_SENDER,
+    build_payload,
+    flush_notifications,
+    lottery,
+    relay_outbox,
+    run_scheduler,
+    send_notification_task,
+)
+from monolith import outbox
+from monolith.database import Message, OutboxTask, PendingNotification, User, db
+from monolith.digest import (
+    DIGEST_SENDER,
+    claim_pending_notifications,
+    get_due_recipients,
+)
+from monolith.notifications import EmailConfig, SMTPPool, send_notification
+from monolith.outbox import RELAY_BACKOFF, relay
 
 
 class TestTasks(unittest.TestCase):
@@ -16,23 +43,38 @@ class TestTasks(unittest.TestCase):
         self._ctx = self.app.test_request_context()
         self._ctx.push()
 
-    def test_check_messages(self):
+    def tearDown(self):
+        self._ctx.pop()
+
+    def test_run_scheduler(self):
         now = datetime.now()
         with self.app.app_context():
+            # deliver whatever the previous tests left behind
+            run_scheduler(True)
+            db.session.query(OutboxTask).delete()
+            db.session.commit()
+
             # add messages that should have been already delivered
             for i in range(1, 6):
                 msg = Message()
                 msg.sender = 1
-                msg.recipient = 2
+                msg.recipient = 1
                 msg.is_draft = False
                 msg.text = "Hello how are you? " + str(i)
                 msg.delivery_date = now - timedelta(days=random.randint(1, 30))
                 db.session.add(msg)
-                
             db.session.commit()
-            # expect success state and number of messages sent equal to 5
-            expected_result = (True, 5)
-            assert check_messages(True) == expected_result
+
+            # expect 5 messages delivered and their recipients notified
+            assert run_scheduler(True) == 5
+            assert run_scheduler(True) == 0
+            # with a single task carrying only the ids of the users
+            task = db.session.query(OutboxTask).one()
+            assert task.name == send_notification_task.name
+            payload = json.loads(task.payload)[0]
+            assert payload == [PAYLOAD_VERSION, True, [[MESSAGE_RECEIVED, 1, 1]] * 5]
+            db.session.delete(task)
+            db.session.commit()
 
     def test_send_notification_task(self):
         print()
@@ -59,6 +101,36 @@ class TestTasks(unittest.TestCase):
         )
         assert send_notification_task(json_message)
 
+    def test_notification_payload(self):
+        monolith.user_query.change_user_notification_mode(1, "immediate")
+        payload = build_payload(
+            [(MESSAGE_READ, 1, 1), (LOTTERY_WON, 1, None), (MESSAGE_RECEIVED, -1, 1)],
+            True,
+        )
+        # the payload survives the serializers of the broker
+        for serializer in ["json", "msgpack"]:
+            content_type, encoding, data = dumps(payload, serializer)
+            assert loads(data, content_type, encoding, accept=[content_type]) == payload
+        assert len(dumps(payload, "msgpack")[2]) < len(dumps(payload, "json")[2])
+
+        with mock.patch("monolith.background.send_notification") as send:
+            # the recipient not found is not notified
+            with mock.patch(
+                "monolith.background.get_users_notification_settings",
+                wraps=monolith.user_query.get_users_notification_settings,
+            ) as lookup:
+                assert send_notification_task(payload) == 2
+            assert lookup.call_count == 1
+        email = "example@example.com"
+        assert [c.args for c in send.call_args_list] == [
+            (email, email, email + " has just read the message"),
+            (SYSTEM_SENDER, email, "You have just won 20 points!"),
+        ]
+
+        payload[0] = PAYLOAD_VERSION + 1
+        self.assertRaises(ValueError, send_notification_task, payload)
+        monolith.user_query.change_user_notification_mode(1, "digest")
+
     def test_email_login_fail(self):
         print("Waiting for socket timeout, go grab a coffee...", end=" ", flush=True)
         self.assertRaises(
@@ -73,8 +145,180 @@ class TestTasks(unittest.TestCase):
         )
 
     def test_lottery(self):
+        points = dict(db.session.query(User.id, User.points))
         result = lottery(True)
         assert result[0]
+        assert len(result[1]) == 1
         # check if the winner record has been updated
-        winner = db.session.query(User).filter(User.id == result[1]).first()
-        assert winner.points == 20
+        winner = db.session.query(User).filter(User.id == result[1][0]).first()
+        assert winner.points == points[winner.id] + 20
+        # and the winner notified once the points are committed
+        task = db.session.query(OutboxTask).order_by(OutboxTask.id.desc()).first()
+        assert json.loads(task.payload)[0][2] == [[LOTTERY_WON, winner.id, None]]
+
+    def test_relay_outbox(self):
+        db.session.query(OutboxTask).delete()
+        db.session.commit()
+        payloads = [build_payload([(LOTTERY_WON, 1, None)], True) for _ in range(5)]
+        for payload in payloads:
+            outbox.add(send_notification_task, [payload], "notification")
+        # nothing is sent if the transaction is rolled back
+        db.session.rollback()
+        assert relay(mock.Mock()) == 0
+        for payload in payloads:
+            outbox.add(send_notification_task, [payload], "notification")
+        db.session.commit()
+
+        # the broker fails on the third task
+        now = datetime.now()
+        publish = mock.Mock(side_effect=[None, None, OSError("unreachable")])
+        assert relay(publish, batch_size=2, now=now) == 2
+        name, args, queue = publish.call_args.args
+        assert (name, args, queue) == (
+            send_notification_task.name,
+            [payloads[2]],
+            "notification",
+        )
+        tasks = db.session.query(OutboxTask).order_by(OutboxTask.id).all()
+        assert [t.attempts for t in tasks] == [1, 0, 0]
+        assert tasks[0].next_attempt == now + RELAY_BACKOFF
+        assert all(t.next_attempt <= now for t in tasks[1:])
+
+        # the others are sent while the failed one waits
+        publish = mock.Mock()
+        assert relay(publish, now=now) == 2
+        assert relay(publish, now=now + RELAY_BACKOFF) == 1
+        sent = [c.args[1][0] for c in publish.call_args_list]
+        assert sent == [payloads[3], payloads[4], payloads[2]]
+        assert db.session.query(OutboxTask).count() == 0
+
+        # the task is published as it was added
+        with mock.patch.object(monolith.background.celery, "send_task") as send:
+            outbox.add(send_notification_task, [payloads[0]], "notification")
+            db.session.commit()
+            assert relay_outbox(True) == 1
+        send.assert_called_once_with(
+            send_notification_task.name,
+            args=[payloads[0]],
+            queue="notification",
+            routing_key="notification",
+        )
+
+    def test_get_app(self):
+        # tasks called in an app context run in that app
+        assert monolith.background._get_app(True) is self.app
+
+        # otherwise the app of the worker is created once and reused
+        self._ctx.pop()
+        try:
+            app = monolith.background._get_app(True)
+            assert app is not self.app
+            assert monolith.background._get_app(True) is app
+
+            # with an app of its own for each operating mode
+            # monolith.app is also the name of the app created by the package
+            app_module = sys.modules["monolith.app"]
+            with mock.patch.object(app_module, "create_app") as create_app:
+                other = monolith.background._get_app(False)
+                assert monolith.background._get_app(False) is other
+                assert monolith.background._get_app(True) is app
+            create_app.assert_called_once_with(False, worker=True)
+        finally:
+            monolith.background._APPS.clear()
+            self._ctx.push()
+
+    def test_smtp_pool(self):
+        relays = [EmailConfig("relay%d" % i, 25, "noreply@mmiab", "") for i in range(2)]
+        mail = EmailMessage()
+        mail.set_content("pooled email")
+
+        with mock.patch("monolith.notifications.smtplib.SMTP") as smtp:
+            smtp.side_effect = lambda host, port, timeout: mock.MagicMock(host=host)
+            pool = SMTPPool(relays, check_after=60)
+
+            # one session per relay, reused by the next emails in turn
+            for _ in range(4):
+                pool.send("example@example.com", mail)
+            assert smtp.call_count == 2
+            sessions = [server for idle in pool._idle for server, _ in idle]
+            assert [s.host for s in sessions] == ["relay0", "relay1"]
+            assert [s.sendmail.call_count for s in sessions] == [2, 2]
+
+            # a session closed by the server is replaced, the email sent again
+            sessions[0].sendmail.side_effect = smtplib.SMTPServerDisconnected()
+            pool.send("example@example.com", mail)
+            assert smtp.call_count == 3
+            assert pool._idle[0][0][0].sendmail.call_count == 1
+
+            # idle sessions are checked with NOOP, then recycled
+            pool.check_after = 0
+            pool._idle[1][0][0].noop.return_value = (421, b"closing")
+            pool.send("example@example.com", mail)
+            assert smtp.call_count == 4
+            pool._idle[0][0][0].noop.return_value = (250, b"ok")
+            pool.send("example@example.com", mail)
+            assert smtp.call_count == 4
+            pool.idle_timeout = 0
+            pool.send("example@example.com", mail)
+            assert smtp.call_count == 5
+
+            pool.close()
+            assert list(map(len, pool._idle)) == [0, 0]
+
+    def test_notification_digest(self):
+        email = "example@example.com"
+        pending = db.session.query(PendingNotification).filter(
+            PendingNotification.recipient == email
+        )
+        pending.delete()
+        db.session.commit()
+        json_message = json.dumps(
+            {
+                "sender": "squad 8",
+                "recipient": email,
+                "body": "a notification",
+                "TESTING": True,
+            }
+        )
+
+        with mock.patch("monolith.background.send_notification") as send:
+            # notifications are buffered in digest mode
+            monolith.user_query.change_user_notification_mode(1, "digest")
+            for _ in range(3):
+                assert send_notification_task(json_message)
+            assert send.call_count == 0
+            assert pending.count() == 3
+
+            # and sent together once the window is over
+            window = timedelta(seconds=self.app.config["NOTIFICATION_DIGEST_WINDOW"])
+            assert email not in get_due_recipients(window, timedelta(hours=1))
+            assert email in get_due_recipients(timedelta(0), timedelta(hours=1))
+            assert email in get_due_recipients(window, timedelta(0))
+            self.app.config["NOTIFICATION_DIGEST_WINDOW"] = 0
+            # kept if the digest cannot be sent
+            send.side_effect = smtplib.SMTPException("unreachable")
+            flush_notifications(True)
+            assert pending.count() == 3
+            send.side_effect = None
+            assert flush_notifications(True) >= 1
+            sender, recipient, body = send.call_args_list[-1].args
+            assert (sender, recipient) == (DIGEST_SENDER, email)
+            assert body.startswith("You have 3 new notifications")
+            assert pending.count() == 0
+            # each notification is claimed by a single flush
+            assert claim_pending_notifications(email) == []
+
+            # or right away in immediate mode, or never
+            send.reset_mock()
+            monolith.user_query.change_user_notification_mode(1, "immediate")
+            assert send_notification_task(json_message)
+            send.assert_called_once_with("squad 8", email, "a notification")
+            monolith.user_query.change_user_notification_mode(1, "off")
+            assert not send_notification_task(json_message)
+            assert send.call_count == 1
+            assert pending.count() == 0
+
+        self.assertRaises(
+            ValueError, monolith.user_query.change_user_notification_mode, 1, "x"
+        )
+        monolith.user_query.change_user_notification_mode(1, "digest")
@@ -1,11 +1,20 @@
+import contextlib
+import io
 import unittest
 import datetime
 import json
+import random
+import time
+from unittest import mock
 
+import monolith.auth
 import monolith.user_query
 from monolith.app import create_test_app
+from monolith.classes.tests import delete_users_after, last_user_id
 from monolith.database import User, db
+from monolith.streaming import stream_json
 from monolith.auth import current_user
+from monolith.cache import LOCAL_TTL, LRUCache, RedisBackend, get_stats, log_stats
 
 
 class TestApp(unittest.TestCase):
@@ -14,6 +23,11 @@ class TestApp(unittest.TestCase):
         self.client = self.app.test_client()
         self._ctx = self.app.test_request_context()
         self._ctx.push()
+        self._last_user = last_user_id()
+
+    def tearDown(self):
+        delete_users_after(self._last_user)
+        self._ctx.pop()
 
     def test_wrong_login(self):
         # test email does not exist
@@ -481,14 +495,69 @@ class TestApp(unittest.TestCase):
     def test_get_users_list(self):
         # try getting all the users registered to the service
         reply = self.client.get("/api/users/list")
+        assert reply.is_streamed
         data = reply.get_json()
-        users = db.session.query(User).filter(User.is_active)
+        users = db.session.query(User).filter(User.is_active).order_by(User.id)
         userlist = [
-            {"email": u.email, "firstname": u.firstname, "lastname": u.lastname}
+            {
+                "id": u.id,
+                "email": u.email,
+                "firstname": u.firstname,
+                "lastname": u.lastname,
+            }
             for u in users
         ]
         assert userlist == data
 
+        # walk the list a page at a time
+        pages = []
+        after = 0
+        while True:
+            reply = self.client.get("/api/users/list?after=%d&limit=2" % after)
+            page = reply.get_json()
+            if page == []:
+                break
+            assert len(page) <= 2
+            pages += page
+            after = page[-1]["id"]
+        assert pages == userlist
+
+        reply = self.client.get("/users")
+        assert reply.is_streamed
+        assert b"example@example.com" in reply.data
+
+    def test_stream_users_list(self):
+        for i in range(5):
+            user = User()
+            user.firstname = "streamed"
+            user.lastname = str(i)
+            user.email = "streamed" + str(i) + "@test.com"
+            db.session.add(user)
+        db.session.commit()
+        users = monolith.user_query.get_all_users(self._last_user)
+        ids = [u.id for u in users]
+        assert len(ids) == 5
+
+        # sent a chunk per batch, in the order of the keyset
+        response = stream_json(users, lambda u: u.id, batch_size=2)
+        chunks = list(response.response)
+        assert chunks == [
+            "[",
+            "%d,%d" % tuple(ids[:2]),
+            ",%d,%d" % tuple(ids[2:4]),
+            ",%d]" % ids[4],
+        ]
+        assert json.loads("".join(chunks)) == ids
+        reply = self.client.get("/api/users/list?after=%d" % self._last_user)
+        assert [u["id"] for u in reply.get_json()] == ids
+
+        # an empty list is still valid JSON
+        response = stream_json(monolith.user_query.get_all_users(ids[-1]), id)
+        assert "".join(response.response) == "[]"
+        reply = self.client.get("/api/users/list?after=%d" % ids[-1])
+        assert reply.data == b"[]"
+        assert reply.get_json() == []
+
     def test_exception_user_query(self):
         print()
         # assert errors in some user_query functions
@@ -496,3 +565,232 @@ class TestApp(unittest.TestCase):
         assert not monolith.user_query.remove_from_blacklist(None, None)
         assert not monolith.user_query.add_points(0, None)
         assert monolith.user_query.get_user_mail(None) == ""
+
+    def test_blacklist_cache(self):
+        cache = monolith.user_query.blacklist_cache
+        cache.clear()
+
+        # the first read loads the blacklist, the next ones hit the cache
+        assert monolith.user_query.get_blacklisted(1) == frozenset()
+        assert monolith.user_query.get_blacklisted(1) == frozenset()
+        assert cache.stats()["misses"] == 1
+        assert cache.stats()["hits"] == 1
+
+        # changes to the blacklist are visible right away
+        assert monolith.user_query.add_to_blacklist(1, [2])
+        assert monolith.user_query.get_blacklisted(1) == frozenset([2])
+        recipients = [u.id for u in monolith.user_query.get_recipients(1)]
+        assert 2 not in recipients
+        assert monolith.user_query.remove_from_blacklist(1, [2])
+        assert monolith.user_query.get_blacklisted(1) == frozenset()
+
+        assert get_stats()["blacklist"]["misses"] == 3
+        # and logged from time to time
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            log_stats(0)
+            assert not log_stats(3600)
+        assert "Stats of cache blacklist: {'hits'" in out.getvalue()
+
+    def test_shared_cache(self):
+        class FakeRedis(dict):
+            def set(self, key, value, ex=None, nx=False):
+                if nx and key in self:
+                    return None
+                self[key] = value.encode() if isinstance(value, str) else value
+                return True
+
+        with mock.patch("redis.Redis.from_url", return_value=FakeRedis()):
+            backend = RedisBackend(
+                "redis://cache",
+                "blacklist:",
+                monolith.user_query.dump_blacklist,
+                monolith.user_query.load_blacklist,
+            )
+        # the caches of two processes
+        first = LRUCache("shared_first", ttl=300, backend=backend)
+        second = LRUCache("shared_second", ttl=300, backend=backend)
+        assert first.get_or_load(1, lambda: frozenset([2])) == frozenset([2])
+        assert second.get(1) == frozenset([2])
+
+        # an invalidation is seen by the other process within local_ttl
+        first.delete(1)
+        assert first.get(1) is None
+        assert second.get(1) == frozenset([2])
+        later = time.monotonic() + LOCAL_TTL
+        with mock.patch("time.monotonic", return_value=later):
+            assert second.get(1) is None
+
+        # a value loaded before an invalidation is not cached
+        def load():
+            second.delete(1)
+            return frozenset([2])
+
+        assert first.get_or_load(1, load) == frozenset([2])
+        assert first.get(1) is None
+        assert second.get(1) is None
+
+        def reload():
+            first.delete(1)
+            return frozenset([3])
+
+        assert first.get_or_load(1, reload) == frozenset([3])
+        assert first.get(1) is None
+
+        # until the invalidation expires
+        del backend.client["blacklist:1"]
+        assert first.get_or_load(1, lambda: frozenset([3])) == frozenset([3])
+        assert second.get(1) == frozenset([3])
+
+    def test_search_recipients(self):
+        reply = self.client.get("/api/user/recipients/search?q=zq")
+        assert reply.status_code == 401
+
+        ids = []
+        for i, active in [(1, True), (2, True), (3, False)]:
+            email = "zq.search%d@example.com" % i
+            user = monolith.user_query.get_user_by_email(email)
+            if user is None:
+                user = User()
+                user.email = email
+                user.firstname = "Quintus%d" % i
+                user.lastname = "Searched"
+                user.is_active = active
+                user.set_password("search")
+                db.session.add(user)
+                db.session.commit()
+            ids.append(user.id)
+        monolith.user_query.recipient_search_cache.clear()
+
+        # by email, first name or last name, excluding the inactive users
+        search = monolith.user_query.search_recipients
+        expected = [
+            (ids[0], "zq.search1@example.com"),
+            (ids[1], "zq.search2@example.com"),
+        ]
+        assert search(1, "ZQ.") == expected
+        assert search(1, "quintus") == expected
+        assert search(1, "quintus2") == expected[1:]
+        assert search(1, "zq.", 1) == expected[:1]
+        assert search(1, " ") == []
+
+        # the common prefixes are cached, the blacklist is still applied
+        assert monolith.user_query.recipient_search_cache.stats()["hits"] == 1
+        assert monolith.user_query.add_to_blacklist(1, [ids[0]])
+        assert search(1, "zq.") == expected[1:]
+        assert monolith.user_query.remove_from_blacklist(1, [ids[0]])
+
+        reply = self.client.post(
+            "/login",
+            data=dict(email="example@example.com", password="admin"),
+            follow_redirects=True,
+        )
+        assert reply.status_code == 200
+        reply = self.client.get("/api/user/recipients/search?q=zq.s&limit=1")
+        assert reply.get_json() == [{"id": ids[0], "email": "zq.search1@example.com"}]
+        self.client.get("/logout")
+
+    def test_user_cache(self):
+        cache = monolith.auth.user_cache
+        reply = self.client.post(
+            "/login",
+            data=dict(email="example@example.com", password="admin"),
+            follow_redirects=True,
+        )
+        assert reply.status_code == 200
+
+        # the logged in user is loaded once, then reused by the next requests
+        cache.clear()
+        for _ in range(3):
+            reply = self.client.get("/api/user/recipients/search?q=example")
+            assert reply.status_code == 200
+        assert cache.stats()["misses"] == 1
+        assert cache.stats()["hits"] == 2
+
+        # a change to the user replaces the cached copy
+        assert not monolith.auth.load_user(1).content_filter
+        reply = self.client.post("/api/content_filter/", data=dict(filter="1"))
+        assert reply.status_code == 200
+        assert monolith.auth.load_user(1).content_filter
+        reply = self.client.post("/api/content_filter/", data=dict(filter="0"))
+        assert not monolith.auth.load_user(1).content_filter
+        self.client.get("/logout")
+
+    def test_add_points(self):
+        points = db.session.query(User.points).filter(User.id == 1).scalar()
+
+        assert monolith.user_query.add_points(10, 1) == points + 10
+        # the user cannot be left with less than min_points
+        assert monolith.user_query.add_points(-points - 11, 1, 0) is None
+        assert monolith.user_query.add_points(-points - 10, 1, 0) == 0
+        assert monolith.user_query.add_points(points, 1) == points
+        assert monolith.user_query.add_points(10, 999999) is None
+
+    def test_draw_lottery_winners(self):
+        for i in range(2):
+            email = "lottery%d@example.com" % i
+            if monolith.user_query.get_user_by_email(email) is None:
+                user = User()
+                user.email = email
+                user.firstname = "Lottery"
+                user.lastname = "Participant"
+                user.set_password("lottery")
+                db.session.add(user)
+                db.session.commit()
+
+        draw = monolith.user_query.draw_lottery_winners
+        active = dict(db.session.query(User.id, User.email).filter(User.is_active))
+        rng = random.Random(8)
+
+        for weighted in [False, True]:
+            winners = draw(2, weighted, rng)
+            assert len(winners) == 2
+            assert len(set(winners)) == 2
+            for id, email in winners:
+                assert active[id] == email
+
+            # everybody wins if there are not enough participants
+            winners = draw(len(active) + 1, weighted, rng)
+            assert sorted(winners) == sorted(active.items())
+
+        # users deactivated between the count and the draw are skipped
+        class Deactivating(random.Random):
+            def sample(self, population, k):
+                db.session.query(User).filter(User.email == email).update(
+                    {User.is_active: False}
+                )
+                db.session.commit()
+                return [len(population) - 1]
+
+        winners = draw(1, False, Deactivating())
+        assert winners == []
+        db.session.query(User).filter(User.email == email).update(
+            {User.is_active: True}
+        )
+        db.session.commit()
+
+        # the chance of winning grows with the points
+        points = db.session.query(User.points).filter(User.id == 1).scalar()
+        monolith.user_query.add_points(1000000, 1)
+        assert [draw(1, True, rng)[0][0] for _ in range(10)] == [1] * 10
+        monolith.user_query.add_points(-1000000, 1)
+        assert db.session.query(User.points).filter(User.id == 1).scalar() == points
+
+    def test_set_notification_mode(self):
+        reply = self.client.post("/api/notification_mode/", data=dict(mode="off"))
+        assert reply.status_code == 401
+
+        reply = self.client.post(
+            "/login",
+            data=dict(email="example@example.com", password="admin"),
+            follow_redirects=True,
+        )
+        assert reply.status_code == 200
+
+        reply = self.client.post("/api/notification_mode/", data=dict(mode="weekly"))
+        assert reply.status_code == 400
+        for mode in ["off", "immediate", "digest"]:
+            reply = self.client.post("/api/notification_mode/", data=dict(mode=mode))
+            assert reply.status_code == 200
+            assert monolith.auth.load_user(1).notification_mode == mode
+        self.client.get("/logout")
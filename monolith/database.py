@@ -1,10 +1,28 @@
+import time
 from datetime import datetime
 from dataclasses import dataclass
+import flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy.sql.schema import ForeignKey
 from werkzeug.security import check_password_hash, generate_password_hash
 
 db = SQLAlchemy()
+# pragmas of the SQLite connections, see set_sqlite_pragmas: readers do not
+# block the writer, writers wait for each other instead of failing, and
+# pages are cached and memory mapped
+SQLITE_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": 5000,
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,
+    "temp_store": "memory",
+}
+# bind of the read replica, see read_session
+REPLICA_BIND = "replica"
 
 
 class User(db.Model):
@@ -22,6 +40,19 @@ class User(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     points = db.Column(db.Integer, default=0)
     content_filter = db.Column(db.Boolean, default=False)
+    # how notifications are emailed: immediate, digest or off
+    notification_mode = db.Column(
+        db.String(16), default="digest", server_default="digest"
+    )
+
+    __table_args__ = (
+        # login, registration and reports look users up by email
+        db.Index("ix_user_email", email, unique=True),
+        # case insensitive prefix search of recipients
+        db.Index("ix_user_email_lower", db.func.lower(email)),
+        db.Index("ix_user_firstname_lower", db.func.lower(firstname)),
+        db.Index("ix_user_lastname_lower", db.func.lower(lastname)),
+    )
 
     def __init__(self, *args, **kw):
         super(User, self).__init__(*args, **kw)
@@ -99,6 +130,31 @@ class Message(db.Model):
     is_read = db.Column(db.Boolean, default=False)
     # to take into account only to received message
     is_deleted = db.Column(db.Boolean, default=False)
+    # last change, for the delivery scheduler to read only the changed messages
+    updated = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+    __table_args__ = (
+        # mailbox of a recipient
+        db.Index("ix_message_inbox", recipient, is_delivered, is_draft, is_deleted),
+        # sent messages, drafts and calendar of a sender
+        db.Index("ix_message_outbox", sender, is_draft, delivery_date),
+        # messages waiting to be delivered
+        db.Index(
+            "ix_message_pending",
+            delivery_date,
+            sqlite_where=(is_delivered == False) & (is_draft == False),
+            postgresql_where=(is_delivered == False) & (is_draft == False),
+        ),
+        # messages waiting to be delivered changed since the last read
+        db.Index(
+            "ix_message_pending_updated",
+            updated,
+            sqlite_where=(is_delivered == False) & (is_draft == False),
+            postgresql_where=(is_delivered == False) & (is_draft == False),
+        ),
+        # messages sharing an attachment, to authorize its download
+        db.Index("ix_message_media", media),
+    )
 
     def __init__(self, *args, **kw):
         super(Message, self).__init__(*args, **kw)
@@ -119,3 +175,233 @@ class BlackList(db.Model):
     # one blacklist per user
     owner = db.Column(db.Integer, ForeignKey(User.id), primary_key=True)
     member = db.Column(db.Integer, ForeignKey(User.id), primary_key=True)
+
+
+@dataclass
+class Attachment(db.Model):
+    """A stored attachment, named after the hash of its contents and
+    shared by all the messages and drafts referencing it"""
+
+    __tablename__ = "attachment"
+
+    filename: str
+    refcount: int
+
+    filename = db.Column(db.String(255), primary_key=True)
+    refcount = db.Column(db.Integer, default=0, nullable=False)
+
+
+@dataclass
+class PendingNotification(db.Model):
+    """A notification waiting to be emailed to its recipient in a digest"""
+
+    __tablename__ = "pending_notification"
+
+    id: int
+    recipient: str
+    sender: str
+    body: str
+    created: datetime
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    recipient = db.Column(db.Unicode(128), nullable=False)
+    sender = db.Column(db.Unicode(128))
+    body = db.Column(db.String())
+    created = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        # notifications of a recipient, oldest first
+        db.Index("ix_pending_notification_recipient", recipient, created),
+    )
+
+
+@dataclass
+class OutboxTask(db.Model):
+    """A Celery task to be sent to the broker, written in the same
+    transaction as the changes it follows"""
+
+    __tablename__ = "outbox_task"
+
+    id: int
+    name: str
+    payload: str
+    queue: str
+    created: datetime
+    attempts: int
+    next_attempt: datetime
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    name = db.Column(db.String(128), nullable=False)
+    # the arguments of the task, in JSON
+    payload = db.Column(db.Text, nullable=False)
+    queue = db.Column(db.String(64))
+    created = db.Column(db.DateTime, nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        # tasks to be sent, oldest first
+        db.Index("ix_outbox_task_next_attempt", next_attempt, id),
+    )
+
+
+def set_sqlite_pragmas(engine, pragmas=SQLITE_PRAGMAS):
+    """Sets pragmas on every connection opened by an SQLite engine, to be
+    called before the first one is opened. Does nothing on other databases
+
+    :param engine: the engine
+    :type engine: Engine
+    :param pragmas: values by pragma name, defaults to SQLITE_PRAGMAS
+    :type pragmas: dict[str, Any], optional
+    :returns: True if the engine is an SQLite one, False otherwise
+    :rtype: bool
+    """
+
+    if engine.dialect.name != "sqlite":
+        return False
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+        cursor.close()
+
+    return True
+
+
+def init_replica(app):
+    """Routes the queries of read_session to the read replica of an app,
+    if it has one in SQLALCHEMY_BINDS. A request that writes to the primary
+    reads it for the rest of the request, and its client does so for the
+    next DATABASE_REPLICA_LAG seconds, so that it always reads its own writes
+
+    :param app: the app, once db is initialized
+    :type app: Flask
+    :returns: True if the app has a read replica, False otherwise
+    :rtype: bool
+    """
+
+    if REPLICA_BIND not in (app.config.get("SQLALCHEMY_BINDS") or {}):
+        return False
+
+    set_sqlite_pragmas(
+        db.get_engine(app, REPLICA_BIND),
+        app.config.get("SQLITE_PRAGMAS", SQLITE_PRAGMAS),
+    )
+
+    @event.listens_for(db.get_engine(app), "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, *args):
+        # anything but a read, to err on the side of the primary
+        if flask.has_app_context() and statement.lstrip()[:6].upper() != "SELECT":
+            flask.g.wrote_primary = True
+
+    @app.after_request
+    def stick_to_primary(response):
+        if flask.g.get("wrote_primary"):
+            flask.session["primary_until"] = (
+                time.time() + app.config["DATABASE_REPLICA_LAG"]
+            )
+        return response
+
+    @app.teardown_appcontext
+    def close_replica_session(exception):
+        session = flask.g.pop("replica_session", None)
+        if session is not None:
+            session.close()
+
+    return True
+
+
+def read_session():
+    """Returns the session of the read-only queries: one on the read replica
+    if the app has one, unless the current request, or a recent one of the
+    same client, wrote to the primary, see init_replica
+
+    :returns: the session to read with
+    :rtype: Session
+    """
+
+    if not flask.has_app_context():
+        return db.session
+    app = flask.current_app
+    if REPLICA_BIND not in (app.config.get("SQLALCHEMY_BINDS") or {}):
+        return db.session
+    if flask.g.get("wrote_primary"):
+        return db.session
+    if (
+        flask.has_request_context()
+        and flask.session.get("primary_until", 0) > time.time()
+    ):
+        return db.session
+
+    if "replica_session" not in flask.g:
+        # every table on the replica, whatever their bind
+        options = {"bind": db.get_engine(app, REPLICA_BIND), "binds": {}}
+        flask.g.replica_session = db.create_session(options)()
+    return flask.g.replica_session
+
+
+def upgrade_schema():
+    """Brings an existing database up to date with the models, adding the
+    columns and indexes that db.create_all does not add to tables that
+    already exist. Safe to be run at every start, must be called inside an
+    app context.
+
+    :returns: the names of the columns (as table.column) and of the indexes
+        that have been created
+    :rtype: list[str]
+    """
+
+    created = []
+    for table in db.metadata.sorted_tables:
+        columns = {c["name"] for c in inspect(db.engine).get_columns(table.name)}
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            try:
+                db.session.execute(
+                    "ALTER TABLE %s ADD COLUMN %s"
+                    % (
+                        db.engine.dialect.identifier_preparer.format_table(table),
+                        CreateColumn(column).compile(dialect=db.engine.dialect),
+                    )
+                )
+                db.session.commit()
+                created.append(table.name + "." + column.name)
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                print("Exception in upgrade_schema:", e)
+
+        existing = _existing_indexes(table.name)
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            try:
+                index.create(bind=db.engine)
+                created.append(index.name)
+            except SQLAlchemyError as e:
+                # e.g. duplicated emails prevent the creation of the unique index
+                print("Exception in upgrade_schema:", e)
+
+    return created
+
+
+def _existing_indexes(table_name):
+    """Returns the names of the indexes of a table in the database
+
+    :param table_name: name of the table
+    :type table_name: str
+    :returns: names of the indexes
+    :rtype: set[str]
+    """
+
+    if db.engine.dialect.name == "sqlite":
+        # the inspector skips the indexes on expressions, e.g. lower(email)
+        q = db.session.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :t",
+            {"t": table_name},
+        )
+        return {row[0] for row in q}
+
+    return {i["name"] for i in inspect(db.engine).get_indexes(table_name)}
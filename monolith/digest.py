@@ -0,0 +1,150 @@
+from datetime import datetime
+
+from sqlalchemy import delete, func, or_
+
+from monolith.database import PendingNotification, db
+
+# how the notifications of an user are emailed
+NOTIFICATION_MODES = ("immediate", "digest", "off")
+# sender of the digests
+DIGEST_SENDER = "Message in a bottle"
+
+
+def buffer_notification(recipient, sender, body):
+    """Keeps a notification to be emailed in the next digest of its recipient
+
+    :param recipient: recipient email address
+    :type recipient: str
+    :param sender: sender of the notification
+    :type sender: str
+    :param body: contents of the notification
+    :type body: str
+    """
+
+    db.session.add(
+        PendingNotification(
+            recipient=recipient, sender=sender, body=body, created=datetime.now()
+        )
+    )
+    db.session.commit()
+
+
+def get_due_recipients(window, max_latency, now=None):
+    """Returns the recipients whose digest is due: those who got no new
+    notification for window, or whose oldest notification waits since
+    max_latency, so that a steady stream of notifications cannot delay
+    a digest forever
+
+    :param window: quiet time after which a digest is sent
+    :type window: timedelta
+    :param max_latency: maximum time a notification waits
+    :type max_latency: timedelta
+    :param now: the current time, defaults to None (datetime.now())
+    :type now: datetime, optional
+    :returns: the email addresses of the recipients
+    :rtype: list[str]
+    """
+
+    if now is None:
+        now = datetime.now()
+
+    q = (
+        db.session.query(PendingNotification.recipient)
+        .group_by(PendingNotification.recipient)
+        .having(
+            or_(
+                func.max(PendingNotification.created) <= now - window,
+                func.min(PendingNotification.created) <= now - max_latency,
+            )
+        )
+    )
+    return [recipient for recipient, in q]
+
+
+def claim_pending_notifications(recipient):
+    """Removes the notifications waiting for a recipient, to be sent in a
+    digest, with a single DELETE. The ones removed in the meanwhile by a
+    concurrent flush are not returned, so that a notification is sent once
+
+    :param recipient: recipient email address
+    :type recipient: str
+    :returns: the sender, body and creation time of the notifications,
+        oldest first, none if a concurrent flush claimed some of them
+    :rtype: list[Row]
+    """
+
+    pending = PendingNotification.recipient == recipient
+    columns = (
+        PendingNotification.id,
+        PendingNotification.sender,
+        PendingNotification.body,
+        PendingNotification.created,
+    )
+    statement = delete(PendingNotification)
+
+    result = []
+    try:
+        if db.engine.dialect.full_returning:
+            result = db.session.execute(
+                statement.where(pending).returning(*columns)
+            ).all()
+            result.sort(key=lambda n: n.id)
+        else:
+            result = (
+                db.session.query(*columns)
+                .filter(pending)
+                .order_by(PendingNotification.id)
+                .all()
+            )
+            claimed = [n.id for n in result]
+            if result and db.session.execute(
+                statement.where(PendingNotification.id.in_(claimed))
+            ).rowcount != len(result):
+                # some were claimed by a concurrent flush, which sends them
+                db.session.rollback()
+                return []
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print("Exception in claim_pending_notifications:", e)
+        result = []
+    return result
+
+
+def release_notifications(recipient, notifications):
+    """Puts back claimed notifications that could not be sent, to be sent in
+    the next digest of their recipient
+
+    :param recipient: recipient email address
+    :type recipient: str
+    :param notifications: the notifications returned by
+        claim_pending_notifications
+    :type notifications: list[Row]
+    """
+
+    db.session.add_all(
+        PendingNotification(
+            recipient=recipient, sender=n.sender, body=n.body, created=n.created
+        )
+        for n in notifications
+    )
+    db.session.commit()
+
+
+def build_digest(notifications):
+    """Builds the email summarizing some notifications. A single notification
+    is sent unchanged
+
+    :param notifications: the notifications, oldest first
+    :type notifications: list[Row]
+    :returns: the sender and the body of the email
+    :rtype: tuple(str, str)
+    """
+
+    if len(notifications) == 1:
+        return notifications[0].sender, notifications[0].body
+
+    lines = ["You have %d new notifications:" % len(notifications), ""]
+    for n in notifications:
+        lines.append("- %s: %s" % (n.sender, n.body))
+    return DIGEST_SENDER, "\n".join(lines)
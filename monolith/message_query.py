@@ -1,15 +1,25 @@
+import hashlib
 import json
-import os
-import json
+from dataclasses import fields
 from datetime import datetime
 
 from better_profanity import profanity
-from flask.globals import current_app
+from sqlalchemy import and_, extract, func, or_, update
+from sqlalchemy.orm import aliased
 
-from monolith.database import Message, db, User, BlackList
-from monolith.user_query import add_points
+from monolith.database import Message, db, User
+from monolith.user_query import add_points, get_blacklisted
+from monolith.attachments import collect, release
 from monolith.auth import current_user
-from monolith.database import Message, User, db
+from monolith.cache import LRUCache
+from monolith.database import Message, User, db, read_session
+
+# lottery points spent to delete a scheduled message
+LOTTERY_DELETION_COST = 60
+# to be increased whenever the profanity word list changes
+CENSOR_WORDLIST_VERSION = 1
+# censored texts, by message id and word list version
+censor_cache = LRUCache("censor", maxsize=1024, ttl=24 * 60 * 60)
 
 
 def save_message(message):
@@ -25,6 +35,16 @@ def save_message(message):
     return message.message_id
 
 
+def save_messages(messages):
+    """Insert a batch of messages in the db with a single transaction
+
+    :param messages: the messages to add to the db
+    :type messages: list[Message]
+    """
+    db.session.add_all(messages)
+    db.session.commit()
+
+
 def get_user_drafts(user_id):
     """Get all the drafts for a user
 
@@ -101,17 +121,15 @@ def delete_draft_attachment(user_id, message_id):
     """
 
     draft = get_user_draft(user_id, message_id)
-    if draft.media == "":
+    if draft.media is None or draft.media == "":
         # no attachment to remove
         return False
 
-    try:
-        os.unlink(os.path.join(current_app.config["UPLOAD_FOLDER"], draft.media))
-        draft.media = ""
-        db.session.commit()
-    except FileNotFoundError:  # pragma: no cover
-        # This will only happen in case of a FS issue
-        return False
+    media = draft.media
+    release(media)
+    draft.media = ""
+    db.session.commit()
+    collect(media)
 
     return True
 
@@ -132,55 +150,73 @@ def delete_user_message(user_id, message_id):
     if message is None:
         raise KeyError()
 
+    media = message.media
+    release(media)
     db.session.delete(message)
     db.session.commit()
+    collect(media)
 
 
-def get_received_messages_metadata(user_id):
-    """Retrieves metadata for all messages received by an user
+def get_received_messages_metadata(user_id, after=None, limit=None):
+    """Retrieves metadata for the messages received by an user,
+    ordered by message id and paginated with a keyset cursor
 
     :param user_id: id of the user
     :type user_id: int
+    :param after: only return messages with an id greater than this one, defaults to None
+    :type after: int, optional
+    :param limit: maximum number of messages to return, defaults to None (no limit)
+    :type limit: int, optional
     :returns: a list of message metadata
     :rtype: list[json]
     """
 
-    # retrieve all received messages for user_id
-    q = db.session.query(Message).filter(
-        Message.recipient == user_id,
-        Message.is_draft == False,
-        Message.is_delivered == True,
-        Message.is_deleted == False,
-        Message.sender.not_in(
-            db.session.query(BlackList.member).filter(BlackList.owner == user_id)
-        ),
+    # retrieve the received messages for user_id along with their sender
+    q = (
+        read_session()
+        .query(
+            Message.message_id,
+            Message.media,
+            User.id,
+            User.firstname,
+            User.lastname,
+            User.email,
+        )
+        .join(User, User.id == Message.sender)
+        .filter(
+            Message.recipient == user_id,
+            Message.is_draft == False,
+            Message.is_delivered == True,
+            Message.is_deleted == False,
+            User.reports < 3,  # do not show message if sender is banned
+            Message.sender.not_in(get_blacklisted(user_id)),
+        )
+        .order_by(Message.message_id)
     )
+    if after is not None:
+        q = q.filter(Message.message_id > after)
+    if limit is not None:
+        q = q.limit(limit)
+
     list = []
-    for msg in q:
-        # retrieve the name of the sender
-        sender = (
-            db.session.query(User)  # do not show message if sender is banned
-            .filter(User.id == msg.sender, User.reports < 3)
-            .first()
+    for row in q:
+        json_msg = json.dumps(
+            {
+                "sender_id": row.id,
+                "firstname": row.firstname,
+                "lastname": row.lastname,
+                "id_message": row.message_id,
+                "email": row.email,
+                "media": row.media,
+            }
         )
-        if sender is not None:
-            json_msg = json.dumps(
-                {
-                    "sender_id": sender.id,
-                    "firstname": sender.firstname,
-                    "lastname": sender.lastname,
-                    "id_message": msg.message_id,
-                    "email": sender.email,
-                    "media": msg.media,
-                }
-            )
 
-            list.append(json_msg)
+        list.append(json_msg)
 
     return list
 
 
-def get_received_message(user_id, message_id):
+def get_received_message(user_id, message_id, content_filter=None):
     """Returns a specific message received by a user.
     Does not retrieve drafts or pending messages.
 
@@ -188,6 +224,9 @@ def get_received_message(user_id, message_id):
     :type user_id: int
     :param message_id: id of the received message
     :type message_id: int
+    :param content_filter: whether the user has the content filter active,
+        defaults to None (read from the database)
+    :type content_filter: bool, optional
     :raises KeyError: if no such message was received
     :returns: the received message
     :rtype: Message
@@ -199,9 +238,7 @@ def get_received_message(user_id, message_id):
         Message.is_draft == False,
         Message.is_delivered == True,
         Message.is_deleted == False,
-        Message.sender.not_in(
-            db.session.query(BlackList.member).filter(BlackList.owner == user_id)
-        ),
+        Message.sender.not_in(get_blacklisted(user_id)),
     )
 
     message = q.first()
@@ -209,15 +246,39 @@ def get_received_message(user_id, message_id):
         raise KeyError
 
     # censor a message if the content filter is activated
-    user = db.session.query(User).filter(User.id == user_id).first()
-    if user.content_filter:
-        message_copy = message
-        message_copy.text = profanity.censor(message.text)
-        return message_copy
+    if content_filter is None:
+        content_filter = (
+            db.session.query(User.content_filter).filter(User.id == user_id).scalar()
+        )
+    if content_filter:
+        return _censored_copy(message)
 
     return message
 
 
+def _censored_copy(message):
+    """Returns a copy of a message with its text censored, leaving the message untouched.
+    Censored texts are cached, so that each message is censored once
+
+    :param message: the message to censor
+    :type message: Message
+    :returns: a transient copy of the message
+    :rtype: Message
+    """
+
+    # the id of a deleted message can be given to a new one
+    digest = hashlib.sha1(message.text.encode()).hexdigest()
+    text = censor_cache.get_or_load(
+        (message.message_id, digest, CENSOR_WORDLIST_VERSION),
+        lambda: profanity.censor(message.text),
+    )
+    message_copy = Message(
+        **{f.name: getattr(message, f.name) for f in fields(Message)}
+    )
+    message_copy.text = text
+    return message_copy
+
+
 def get_sent_message(user_id, message_id):
     """Returns a specific message sent by a user
 
@@ -243,34 +304,83 @@ def get_sent_message(user_id, message_id):
     return message
 
 
-def get_sent_messages_metadata(user_id):
-    """Retrieves metadata for all messages sent by an user
+def can_access_media(user_id, filename):
+    """Checks if a user can download an attachment, that is if they wrote or
+    received a message with it
+
+    :param user_id: user id
+    :type user_id: int
+    :param filename: the name of the stored file
+    :type filename: str
+    :returns: True if the user can download the file, False otherwise
+    :rtype: bool
+    """
+
+    q = db.session.query(Message.message_id).filter(
+        Message.media == filename,
+        or_(
+            Message.sender == user_id,
+            and_(
+                Message.recipient == user_id,
+                Message.is_delivered == True,
+                Message.is_deleted == False,
+            ),
+        ),
+    )
+    return db.session.query(q.exists()).scalar()
+
+
+def get_sent_messages_metadata(user_id, after=None, limit=None, since=None):
+    """Retrieves metadata for the messages sent by an user,
+    ordered by message id and paginated with a keyset cursor
 
     :param user_id: id of the user
     :type user_id: int
+    :param after: only return messages with an id greater than this one, defaults to None
+    :type after: int, optional
+    :param limit: maximum number of messages to return, defaults to None (no limit)
+    :type limit: int, optional
+    :param since: only return messages delivered from this date on, defaults to None
+    :type since: datetime, optional
     :returns: a list of sent message metadata
     :rtype: list[dict]
     """
 
-    # retrieve of all messages for user_id
-    q = db.session.query(Message).filter(
-        Message.sender == user_id,
-        Message.is_draft == False,
-        Message.is_delivered == True,
+    # retrieve the sent messages for user_id along with their recipient
+    q = (
+        read_session()
+        .query(
+            Message.message_id,
+            Message.media,
+            User.id,
+            User.firstname,
+            User.lastname,
+            User.email,
+        )
+        .join(User, User.id == Message.recipient)
+        .filter(
+            Message.sender == user_id,
+            Message.is_draft == False,
+            Message.is_delivered == True,
+        )
+        .order_by(Message.message_id)
     )
+    if after is not None:
+        q = q.filter(Message.message_id > after)
+    if since is not None:
+        q = q.filter(Message.delivery_date >= since)
+    if limit is not None:
+        q = q.limit(limit)
+
     list = []
-    for msg in q:
-        # retrieve the name of the sender
-        recipient = (
-            db.session.query(User).filter(User.id == msg.get_recipient()).first()
-        )
+    for row in q:
         json_msg = {
-            "recipient_id": recipient.get_id(),
-            "firstname": recipient.get_firstname(),
-            "lastname": recipient.get_lastname(),
-            "id_message": msg.message_id,
-            "email": recipient.email,
-            "media": msg.media,
+            "recipient_id": row.id,
+            "firstname": row.firstname,
+            "lastname": row.lastname,
+            "id_message": row.message_id,
+            "email": row.email,
+            "media": row.media,
         }
 
         list.append(json_msg)
@@ -307,7 +417,8 @@ def set_message_is_deleted(message_id):
 
 
 def set_message_is_deleted_lottery(message_id):
-    """Delete a scheduled message if the user has at least 20 60 points
+    """Delete a scheduled message if its sender has at least 60 points,
+    spending them in the same transaction
 
     :param message_id: the id of the message to delete
     :type message_id: int
@@ -316,13 +427,39 @@ def set_message_is_deleted_lottery(message_id):
     """
 
     try:
-        msg = db.session.query(Message).filter(Message.message_id == message_id).first()
-        if msg.delivery_date > datetime.now():
-            db.session.query(Message).filter(Message.message_id == message_id).delete()
-            add_points(-60, msg.sender)
-            db.session.commit()
-            return True
-        return False
+        msg = (
+            db.session.query(Message.sender, Message.media)
+            .filter(
+                Message.message_id == message_id,
+                Message.delivery_date > datetime.now(),
+            )
+            .first()
+        )
+        if msg is None:
+            return False
+
+        # the check on the points and their deduction are a single statement
+        if add_points(-LOTTERY_DELETION_COST, msg.sender, 0, commit=False) is None:
+            db.session.rollback()
+            return False
+
+        # the message could have been delivered or deleted in the meanwhile
+        deleted = (
+            db.session.query(Message)
+            .filter(
+                Message.message_id == message_id,
+                Message.delivery_date > datetime.now(),
+            )
+            .delete(synchronize_session=False)
+        )
+        if deleted == 0:
+            db.session.rollback()
+            return False
+
+        release(msg.media)
+        db.session.commit()
+        collect(msg.media)
+        return True
     except Exception:
         db.session.rollback()
         return False
@@ -368,26 +505,123 @@ def update_message_state(message_id, attr, state):
     return result
 
 
-def check_message_to_send():
-    """Check if all the messages have been correctly sent.
-    If an error is occurred (with Celery), set the messages in the past to delivered.
+def get_pending_messages(until, limit=None, changed_since=None):
+    """Returns the messages waiting to be delivered by a certain time,
+    in order of delivery date
+
+    :param until: the latest delivery date
+    :type until: datetime
+    :param limit: maximum number of messages, defaults to None (all)
+    :type limit: int, optional
+    :param changed_since: only the messages saved or rescheduled since then,
+        defaults to None (all)
+    :type changed_since: datetime, optional
+    :returns: the id, delivery date and last change of the messages
+    :rtype: list[Row]
     """
-    ids = []
-    # looking for messages that have not been sent but they should have been
-    messages = (
-        db.session.query(Message)
-        .filter(Message.is_delivered == 0)
-        .filter(Message.delivery_date < datetime.now())
-        .filter(Message.is_draft == 0)
-        .all()
+
+    q = db.session.query(
+        Message.message_id, Message.delivery_date, Message.updated
+    ).filter(
+        Message.is_delivered == False,
+        Message.is_draft == False,
+        Message.delivery_date <= until,
     )
-    # updating state
-    for msg in messages:
-        ids.append((msg.sender, msg.recipient))
-        setattr(msg, "is_delivered", 1)
+    if changed_since is not None:
+        q = q.filter(Message.updated >= changed_since)
+    q = q.order_by(Message.delivery_date)
+    if limit is not None:
+        q = q.limit(limit)
+    return q.all()
 
-    db.session.commit()
-    return ids
+
+def reschedule_message(sender_id, message_id, delivery_date):
+    """Moves the delivery of a scheduled message of a sender, with a single
+    UPDATE skipping it if it has been delivered or is due in the meanwhile.
+    The UPDATE stamps the message as changed, so that the delivery scheduler
+    picks the new date up at its next tick
+
+    :param sender_id: the id of the sender
+    :type sender_id: int
+    :param message_id: the id of the message
+    :type message_id: int
+    :param delivery_date: the new delivery date
+    :type delivery_date: datetime
+    :returns: True if the message has been rescheduled, False otherwise
+    :rtype: bool
+    """
+
+    result = False
+    try:
+        updated = (
+            db.session.query(Message)
+            .filter(
+                Message.message_id == message_id,
+                Message.sender == sender_id,
+                Message.is_draft == False,
+                Message.is_delivered == False,
+                Message.delivery_date > datetime.now(),
+            )
+            .update(
+                {Message.delivery_date: delivery_date, Message.updated: datetime.now()},
+                synchronize_session=False,
+            )
+        )
+        db.session.commit()
+        result = updated == 1
+    except Exception as e:
+        db.session.rollback()
+        print("Exception in reschedule_message:", e)
+    return result
+
+
+def claim_messages(message_ids, now, before_commit=None):
+    """Marks as delivered a batch of messages that are due, with a single
+    UPDATE. Messages already delivered, deleted or rescheduled later than now
+    are skipped, so that a message is claimed only once
+
+    :param message_ids: the ids of the messages to deliver
+    :type message_ids: list[int]
+    :param now: the current time
+    :type now: datetime
+    :param before_commit: called with the claimed messages in the same
+        transaction, e.g. to add the tasks notifying them, defaults to None
+    :type before_commit: Callable[[list[Row]], None], optional
+    :returns: the id, sender and recipient of the claimed messages
+    :rtype: list[Row]
+    """
+
+    due = and_(
+        Message.message_id.in_(message_ids),
+        Message.is_delivered == False,
+        Message.is_draft == False,
+        Message.delivery_date <= now,
+    )
+    columns = (Message.message_id, Message.sender, Message.recipient)
+    statement = update(Message).where(due).values(is_delivered=True)
+
+    result = []
+    try:
+        if db.engine.dialect.full_returning:
+            result = db.session.execute(statement.returning(*columns)).all()
+        else:
+            result = db.session.query(*columns).filter(due).all()
+            claimed = [row.message_id for row in result]
+            if result and db.session.execute(
+                statement.where(Message.message_id.in_(claimed))
+            ).rowcount != len(result):
+                # some were claimed by another scheduler in the meanwhile,
+                # the others are claimed again at the next refill
+                db.session.rollback()
+                return []
+        if result and before_commit is not None:
+            before_commit(result)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print("Exception in claim_messages:", e)
+        result = []
+    return result
 
 
 def get_day_message(userid, baseDate, upperDate):
@@ -403,33 +637,78 @@ def get_day_message(userid, baseDate, upperDate):
     :rtype: list[dict]
     """
 
-    q = db.session.query(Message).filter(
-        Message.sender == userid,
-        Message.delivery_date >= baseDate,
-        Message.delivery_date < upperDate,
-        Message.is_draft == False,
+    recipient = aliased(User)
+    sender = aliased(User)
+    q = (
+        read_session()
+        .query(
+            Message.message_id,
+            Message.text,
+            Message.delivery_date,
+            recipient.firstname,
+            recipient.email,
+            sender.points,
+        )
+        .join(recipient, recipient.id == Message.recipient)
+        .join(sender, sender.id == Message.sender)
+        .filter(
+            Message.sender == userid,
+            Message.delivery_date >= baseDate,
+            Message.delivery_date < upperDate,
+            Message.is_draft == False,
+        )
+        .order_by(Message.delivery_date, Message.message_id)
     )
 
     list = []
+    now = datetime.now()
+    enough_points = None
 
     for msg in q:
-        recipient = db.session.query(User).filter(User.id == msg.recipient).first()
-        sender = db.session.query(User).filter(User.id == msg.sender).first()
-        delivery_date = msg.delivery_date
-        now = datetime.now()
-
-        canDelete = delivery_date > now and sender.points >= 60
-        future = delivery_date > now
-        msg = {
-            "message_id": msg.message_id,
-            "firstname": recipient.firstname,
-            "email": recipient.email,
-            "text": msg.text,
-            "delivered": delivery_date,
-            "candelete": canDelete,
-            "future": future,
-        }
-
-        list.append(msg)
+        # every message has the same sender, check its points just once
+        if enough_points is None:
+            enough_points = msg.points >= LOTTERY_DELETION_COST
+
+        future = msg.delivery_date > now
+        list.append(
+            {
+                "message_id": msg.message_id,
+                "firstname": msg.firstname,
+                "email": msg.email,
+                "text": msg.text,
+                "delivered": msg.delivery_date,
+                "candelete": future and enough_points,
+                "future": future,
+            }
+        )
 
     return list
+
+
+def get_month_summary(userid, baseDate, upperDate):
+    """Counts the outgoing messages of a user for each day of a time interval
+
+    :param userid: user id
+    :type userid: int
+    :param baseDate: start date
+    :type baseDate: datetime
+    :param upperDate: end date
+    :type upperDate: datetime
+    :returns: the number of messages for each day with at least one message
+    :rtype: list[dict]
+    """
+
+    day = extract("day", Message.delivery_date)
+    q = (
+        db.session.query(day.label("day"), func.count(Message.message_id))
+        .filter(
+            Message.sender == userid,
+            Message.delivery_date >= baseDate,
+            Message.delivery_date < upperDate,
+            Message.is_draft == False,
+        )
+        .group_by(day)
+        .order_by(day)
+    )
+
+    return [{"day": int(d), "count": count} for d, count in q]
@@ -1,8 +1,10 @@
 import os
 import smtplib
+import threading
+import time
 from email.message import EmailMessage
 import socket
-from collections import namedtuple
+from collections import deque, namedtuple
 
 
 EmailConfig = namedtuple("EmailConfig", ["server", "port", "email", "password"])
@@ -14,8 +16,233 @@ DefaultEmailConfig = EmailConfig(
 )
 
 
-def send_notification(msg_sender, receiver, msg_body, config=DefaultEmailConfig):
-    """Sends an email from a specific sender to a certain recipient.
+def _relays_from_env():
+    """Reads the relays to spread the emails on from SMTP_RELAYS, a comma
+    separated list of host:port sharing the address and password of
+    DefaultEmailConfig. Defaults to DefaultEmailConfig alone
+
+    :returns: the configurations of the relays
+    :rtype: tuple[EmailConfig]
+    """
+
+    relays = os.environ.get("SMTP_RELAYS", "")
+    if relays == "":
+        return (DefaultEmailConfig,)
+
+    configs = []
+    for relay in relays.split(","):
+        host, port = relay.strip().rsplit(":", 1)
+        configs.append(DefaultEmailConfig._replace(server=host, port=int(port)))
+    return tuple(configs)
+
+
+DefaultRelays = _relays_from_env()
+# idle connections kept open per relay
+SMTP_POOL_SIZE = int(os.environ.get("SMTP_POOL_SIZE", "4"))
+# seconds after which an idle connection is closed
+SMTP_IDLE_TIMEOUT = float(os.environ.get("SMTP_IDLE_TIMEOUT", "60"))
+# seconds after which an idle connection is checked with NOOP before reuse
+SMTP_CHECK_AFTER = float(os.environ.get("SMTP_CHECK_AFTER", "5"))
+
+
+class SMTPPool:
+    """Pool of persistent SMTP sessions, spreading the emails on one or more
+    relays in turn. Idle sessions are checked with NOOP before being reused
+    and closed when idle for too long; a session dropped by the server is
+    replaced and the email sent again. Sessions are per process.
+    """
+
+    def __init__(
+        self,
+        relays,
+        size=SMTP_POOL_SIZE,
+        idle_timeout=SMTP_IDLE_TIMEOUT,
+        check_after=SMTP_CHECK_AFTER,
+        timeout=10,
+    ):
+        """Creates an empty pool
+
+        :param relays: the configurations of the relays
+        :type relays: tuple[EmailConfig]
+        :param size: idle sessions kept open per relay, defaults to SMTP_POOL_SIZE
+        :type size: int, optional
+        :param idle_timeout: seconds after which an idle session is closed,
+            defaults to SMTP_IDLE_TIMEOUT
+        :type idle_timeout: float, optional
+        :param check_after: seconds after which an idle session is checked
+            with NOOP, defaults to SMTP_CHECK_AFTER
+        :type check_after: float, optional
+        :param timeout: socket timeout in seconds, defaults to 10
+        :type timeout: float, optional
+        """
+
+        self.relays = tuple(relays)
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._idle = [deque() for _ in self.relays]
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def send(self, receiver, mail):
+        """Sends an email through the next relay
+
+        :param receiver: recipient email address
+        :type receiver: str
+        :param mail: the email
+        :type mail: EmailMessage
+        :raises Exception: if no relay can be reached or the email is refused
+        """
+
+        index, server = self._acquire()
+        config = self.relays[index]
+        try:
+            server.sendmail(config.email, receiver, mail.as_string())
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # the server closed an idle session, send again on a new one
+            self._discard(server)
+            server = self._connect(config)
+            try:
+                server.sendmail(config.email, receiver, mail.as_string())
+            except Exception:
+                self._discard(server)
+                raise
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            # the email was refused, the session is still usable
+            self._release(index, server)
+            raise
+        except Exception:
+            self._discard(server)
+            raise
+        self._release(index, server)
+
+    def close(self):
+        """Closes all the idle sessions"""
+
+        with self._lock:
+            servers = [server for idle in self._idle for server, _ in idle]
+            for idle in self._idle:
+                idle.clear()
+        for server in servers:
+            self._discard(server)
+
+    def _acquire(self):
+        """Returns an open session, trying each relay in turn
+
+        :raises Exception: the error of the last relay if none can be reached
+        :returns: the index of the relay and its session
+        :rtype: tuple(int, SMTP)
+        """
+
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.relays)
+
+        error = None
+        for i in range(len(self.relays)):
+            index = (start + i) % len(self.relays)
+            server = self._reuse(index)
+            if server is not None:
+                return index, server
+            try:
+                return index, self._connect(self.relays[index])
+            except Exception as e:
+                print("Exception in SMTPPool._acquire:", e)
+                error = e
+        raise error
+
+    def _reuse(self, index):
+        """Returns a healthy idle session of a relay, if any
+
+        :param index: the index of the relay
+        :type index: int
+        :returns: the session, None if there are none
+        :rtype: SMTP
+        """
+
+        while True:
+            with self._lock:
+                if not self._idle[index]:
+                    return None
+                server, since = self._idle[index].pop()
+
+            idle = time.monotonic() - since
+            if idle > self.idle_timeout:
+                self._discard(server)
+                continue
+            if idle > self.check_after:
+                try:
+                    healthy = server.noop()[0] == 250
+                except (smtplib.SMTPException, OSError):
+                    healthy = False
+                if not healthy:
+                    self._discard(server)
+                    continue
+            return server
+
+    def _connect(self, config):
+        server = smtplib.SMTP(config.server, config.port, timeout=self.timeout)
+        try:
+            if config.password != "":
+                server.starttls()
+                server.login(config.email, config.password)
+        except Exception:
+            self._discard(server)
+            raise
+        return server
+
+    def _release(self, index, server):
+        with self._lock:
+            if len(self._idle[index]) < self.size:
+                self._idle[index].append((server, time.monotonic()))
+                return
+        self._discard(server)
+
+    def _discard(self, server):
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+
+# pools of the process, by relays
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(relays=DefaultRelays):
+    """Returns the pool of SMTP sessions of the current process for some relays
+
+    :param relays: the configurations of the relays, defaults to DefaultRelays
+    :type relays: tuple[EmailConfig], optional
+    :returns: the pool
+    :rtype: SMTPPool
+    """
+
+    relays = tuple(relays)
+    with _pools_lock:
+        pool = _pools.get(relays)
+        # sessions cannot be shared with a forked process
+        if pool is None or pool.pid != os.getpid():
+            pool = _pools[relays] = SMTPPool(relays)
+        return pool
+
+
+def close_pools():
+    """Closes the idle SMTP sessions of the process, e.g. at its shutdown"""
+
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def send_notification(msg_sender, receiver, msg_body, config=None):
+    """Sends an email from a specific sender to a certain recipient,
+    on a pooled SMTP session.
 
     :param msg_sender: sender email address
     :type msg_sender: str
@@ -23,22 +250,19 @@ def send_notification(msg_sender, receiver, msg_body, config=DefaultEmailConfig)
     :type receiver: str
     :param msg_body: contents of the message
     :type msg_body: str
-    :param config: email configuration settings, defaults to DefaultEmailConfig
+    :param config: email configuration settings, defaults to the relays of
+        DefaultRelays
     :type config: EmailConfig, optional
     :raises e: if SMTP connection times out
     """
 
     try:
-        with smtplib.SMTP(config.server, config.port, timeout=10) as server:
-            if config.password != "":
-                server.starttls()
-                server.login(config.email, config.password)
-
-            mail = EmailMessage()
-            mail["Subject"] = "MMIAB - Message from " + msg_sender
-            mail.set_content(msg_body)
+        mail = EmailMessage()
+        mail["Subject"] = "MMIAB - Message from " + msg_sender
+        mail.set_content(msg_body)
 
-            server.sendmail(config.email, receiver, mail.as_string())
+        pool = get_pool() if config is None else get_pool((config,))
+        pool.send(receiver, mail)
     except socket.timeout as e:  # pragma: no cover
         print(str(e))
         raise e
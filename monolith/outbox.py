@@ -0,0 +1,133 @@
+import json
+from datetime import datetime, timedelta
+
+from monolith.database import OutboxTask, db
+
+# tasks sent to the broker per transaction
+RELAY_BATCH_SIZE = 100
+# time a relay has to send the tasks it took before others can take them
+RELAY_LEASE = timedelta(minutes=1)
+# wait before sending again a task the broker refused, doubled at every attempt
+RELAY_BACKOFF = timedelta(seconds=1)
+# maximum wait before sending again a task
+RELAY_MAX_BACKOFF = timedelta(minutes=5)
+
+
+def add(task, args, queue=None):
+    """Adds a task to the outbox, in the current transaction. Once committed,
+    the task is sent to the broker by relay, and it is never sent if the
+    transaction is rolled back
+
+    :param task: the task to send
+    :type task: Task
+    :param args: the arguments of the task, JSON serializable
+    :type args: list
+    :param queue: the queue to send the task to, defaults to None (its route)
+    :type queue: str, optional
+    """
+
+    now = datetime.now()
+    db.session.add(
+        OutboxTask(
+            name=task.name,
+            payload=json.dumps(args),
+            queue=queue,
+            created=now,
+            attempts=0,
+            next_attempt=now,
+        )
+    )
+
+
+def relay(
+    publish,
+    batch_size=RELAY_BATCH_SIZE,
+    lease=RELAY_LEASE,
+    max_backoff=RELAY_MAX_BACKOFF,
+    now=None,
+):
+    """Sends the tasks of the outbox to the broker, oldest first, in batches.
+    A task is deleted once sent, so it is sent at least once; if the broker
+    fails, the task is sent again after an exponential backoff and the rest
+    of the outbox waits for the next relay
+
+    :param publish: sends a task given its name, arguments and queue
+    :type publish: Callable[[str, list, str], None]
+    :param batch_size: tasks sent per transaction, defaults to RELAY_BATCH_SIZE
+    :type batch_size: int, optional
+    :param lease: time to send a batch before another relay can take it,
+        defaults to RELAY_LEASE
+    :type lease: timedelta, optional
+    :param max_backoff: maximum wait before sending again a task,
+        defaults to RELAY_MAX_BACKOFF
+    :type max_backoff: timedelta, optional
+    :param now: the current time, defaults to None (datetime.now())
+    :type now: datetime, optional
+    :returns: the number of tasks sent
+    :rtype: int
+    """
+
+    if now is None:
+        now = datetime.now()
+
+    sent = 0
+    while True:
+        tasks = _lease(batch_size, now, now + lease)
+        done = []
+        failed = None
+        for task in tasks:
+            try:
+                publish(task.name, json.loads(task.payload), task.queue)
+            except Exception as e:
+                print("Exception in relay:", e)
+                failed = task
+                break
+            done.append(task.id)
+
+        db.session.query(OutboxTask).filter(OutboxTask.id.in_(done)).delete(
+            synchronize_session=False
+        )
+        sent += len(done)
+        if failed is not None:
+            backoff = min(RELAY_BACKOFF * 2**failed.attempts, max_backoff)
+            failed.attempts += 1
+            failed.next_attempt = now + backoff
+            # the ones after it are given back
+            rest = [task.id for task in tasks[len(done) + 1 :]]
+            db.session.query(OutboxTask).filter(OutboxTask.id.in_(rest)).update(
+                {OutboxTask.next_attempt: now}, synchronize_session=False
+            )
+        db.session.commit()
+
+        if failed is not None or len(tasks) < batch_size:
+            return sent
+
+
+def _lease(batch_size, now, until):
+    """Takes the tasks to send until a time, so that a concurrent relay does
+    not send them too
+
+    :returns: the tasks taken, oldest first
+    :rtype: list[OutboxTask]
+    """
+
+    ids = [
+        id
+        for id, in db.session.query(OutboxTask.id)
+        .filter(OutboxTask.next_attempt <= now)
+        .order_by(OutboxTask.next_attempt, OutboxTask.id)
+        .limit(batch_size)
+    ]
+    if not ids:
+        return []
+
+    db.session.query(OutboxTask).filter(
+        OutboxTask.id.in_(ids), OutboxTask.next_attempt <= now
+    ).update({OutboxTask.next_attempt: until}, synchronize_session=False)
+    db.session.commit()
+    return (
+        db.session.query(OutboxTask)
+        .filter(OutboxTask.id.in_(ids), OutboxTask.next_attempt == until)
+        .order_by(OutboxTask.id)
+        .all()
+    )
@@ -0,0 +1,244 @@
+import math
+from datetime import datetime, timedelta
+
+from monolith.message_query import claim_messages, get_pending_messages
+
+# how far ahead the scheduled messages are kept in memory
+SCHEDULER_HORIZON = timedelta(minutes=5)
+# how often the whole horizon is read again from the database
+SCHEDULER_REFILL_INTERVAL = timedelta(minutes=1)
+# maximum number of messages kept in memory
+SCHEDULER_CAPACITY = 10000
+# messages delivered per UPDATE
+SCHEDULER_BATCH_SIZE = 500
+# how long a change may take to be committed, the messages changed that long
+# before the last change read are read again
+SCHEDULER_COMMIT_LAG = timedelta(seconds=5)
+
+
+class TimingWheel:
+    """Hierarchical timing wheel: keys are added in O(1) to a slot of the
+    lowest level covering their due time, and the slots of a level are
+    cascaded to the level below once per revolution of that level.
+    With the defaults the wheel spans an hour with a resolution of a second.
+    """
+
+    def __init__(self, start, tick=1.0, slots=60, levels=2):
+        """Creates an empty wheel
+
+        :param start: the current time
+        :type start: datetime
+        :param tick: seconds per slot of the lowest level, defaults to 1.0
+        :type tick: float, optional
+        :param slots: slots per level, defaults to 60
+        :type slots: int, optional
+        :param levels: number of levels, defaults to 2
+        :type levels: int, optional
+        """
+
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self._wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self._current = math.floor(start.timestamp() / tick)
+        self._ready = []
+        self._pending = 0
+
+    def __len__(self):
+        return self._pending + len(self._ready)
+
+    def add(self, key, when):
+        """Adds a key, returned by advance once its due time is reached
+
+        :param key: the key to add
+        :type key: Hashable
+        :param when: the due time
+        :type when: datetime
+        """
+
+        # a key is never returned before its due time
+        self._insert(key, math.ceil(when.timestamp() / self.tick))
+
+    def advance(self, now):
+        """Moves the wheel to the current time
+
+        :param now: the current time
+        :type now: datetime
+        :returns: the keys that are due
+        :rtype: list[Hashable]
+        """
+
+        target = math.floor(now.timestamp() / self.tick)
+        while self._current < target:
+            if self._pending == 0:
+                # nothing to cascade, skip straight to the target
+                self._current = target
+                break
+            self._current += 1
+            for level in range(self.levels - 1, 0, -1):
+                if self._current % self.slots**level == 0:
+                    self._cascade(level)
+            self._cascade(0)
+
+        ready, self._ready = self._ready, []
+        return ready
+
+    def _insert(self, key, due):
+        delta = due - self._current
+        if delta <= 0:
+            self._ready.append(key)
+            return
+
+        level = 0
+        while level < self.levels - 1 and delta >= self.slots ** (level + 1):
+            level += 1
+        slot = (due // self.slots**level) % self.slots
+        self._wheels[level][slot].append((key, due))
+        self._pending += 1
+
+    def _cascade(self, level):
+        slot = (self._current // self.slots**level) % self.slots
+        entries = self._wheels[level][slot]
+        if not entries:
+            return
+        self._wheels[level][slot] = []
+        self._pending -= len(entries)
+        for key, due in entries:
+            self._insert(key, due)
+
+
+class DeliveryScheduler:
+    """Delivers the scheduled messages when they are due. Only the messages
+    due within the horizon are kept in memory, in a timing wheel fed by an
+    indexed query on their delivery date, so that the memory used does not
+    depend on how far ahead messages are scheduled.
+    The whole horizon is read again every refill interval, and in between
+    only the messages saved or rescheduled since the last change read that are
+    due before the next read, so that they are never late: a message already
+    in the wheel that is rescheduled earlier is added again. Messages deleted or
+    rescheduled are dropped when their old time comes, at no cost.
+    Messages that were due while the scheduler was not running are delivered
+    by its first tick.
+    """
+
+    def __init__(
+        self,
+        horizon=SCHEDULER_HORIZON,
+        refill_interval=SCHEDULER_REFILL_INTERVAL,
+        capacity=SCHEDULER_CAPACITY,
+        batch_size=SCHEDULER_BATCH_SIZE,
+        on_delivered=None,
+        now=None,
+    ):
+        """Creates a scheduler, reading the messages at its first tick
+
+        :param horizon: how far ahead messages are kept in memory,
+            defaults to SCHEDULER_HORIZON
+        :type horizon: timedelta, optional
+        :param refill_interval: how often the horizon is read again, at most
+            horizon, defaults to SCHEDULER_REFILL_INTERVAL
+        :type refill_interval: timedelta, optional
+        :param capacity: maximum number of messages kept in memory,
+            defaults to SCHEDULER_CAPACITY
+        :type capacity: int, optional
+        :param batch_size: messages delivered per UPDATE,
+            defaults to SCHEDULER_BATCH_SIZE
+        :type batch_size: int, optional
+        :param on_delivered: called with each batch of delivered messages
+            before it is committed, defaults to None
+        :type on_delivered: Callable[[list[Row]], None], optional
+        :param now: the current time, defaults to None (datetime.now())
+        :type now: datetime, optional
+        """
+
+        self.horizon = horizon
+        self.refill_interval = min(refill_interval, horizon)
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.on_delivered = on_delivered
+        self.wheel = TimingWheel(now or datetime.now())
+        # delivery date of the messages in the wheel, by id
+        self._scheduled = {}
+        self._refilled = None
+        # the last change read
+        self._changed = None
+
+    def __len__(self):
+        return len(self._scheduled)
+
+    def refill(self, now, until=None, changed_since=None):
+        """Adds to the wheel the messages due by a time it does not hold yet
+
+        :param now: the current time
+        :type now: datetime
+        :param until: the latest delivery date, defaults to None (the horizon)
+        :type until: datetime, optional
+        :param changed_since: only the messages changed since then,
+            defaults to None (all)
+        :type changed_since: datetime, optional
+        :returns: the number of messages added
+        :rtype: int
+        """
+
+        if len(self._scheduled) >= self.capacity:
+            return 0
+
+        rows = get_pending_messages(
+            until or now + self.horizon,
+            limit=self.capacity,
+            changed_since=changed_since,
+        )
+        added = 0
+        for id, delivery_date, updated in rows:
+            if updated is not None and (
+                self._changed is None or updated > self._changed
+            ):
+                self._changed = updated
+            scheduled = self._scheduled.get(id)
+            if scheduled is None:
+                if len(self._scheduled) >= self.capacity:
+                    continue
+            elif delivery_date >= scheduled:
+                continue
+            # added again if rescheduled earlier, the later entry is skipped
+            # by the claim when its time comes
+            self._scheduled[id] = delivery_date
+            self.wheel.add(id, delivery_date)
+            added += 1
+        return added
+
+    def tick(self, now=None):
+        """Delivers the messages that are due
+
+        :param now: the current time, defaults to None (datetime.now())
+        :type now: datetime, optional
+        :returns: the id, sender and recipient of the delivered messages
+        :rtype: list[Row]
+        """
+
+        if now is None:
+            now = datetime.now()
+
+        if self._refilled is None or now - self._refilled >= self.refill_interval:
+            self.refill(now)
+            self._refilled = now
+        else:
+            self.refill(
+                now,
+                self._refilled + self.refill_interval,
+                self._changed and self._changed - SCHEDULER_COMMIT_LAG,
+            )
+
+        due = self.wheel.advance(now)
+        delivered = []
+        for i in range(0, len(due), self.batch_size):
+            batch = due[i : i + self.batch_size]
+            # messages rescheduled or deleted in the meanwhile are skipped,
+            # the next refill reads them again if they are still pending
+            delivered.extend(claim_messages(batch, now, self.on_delivered))
+            for id in batch:
+                # unless it is a stale entry of a message rescheduled earlier
+                # and then later, whose current entry is still in the wheel
+                if self._scheduled.get(id, now) <= now:
+                    self._scheduled.pop(id, None)
+        return delivered
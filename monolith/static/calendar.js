@@ -122,9 +122,9 @@ const renderCalendar = () => {
       i === new Date().getDate() &&
       date.getMonth() === new Date().getMonth()
     ) {
-      days += `<div class="today"><button class="btn btn-outline-white" id="myBtn" onclick="get_day_message('${i}', '${date.getMonth()}', '${date.getFullYear()}')">${i}</button></div>`;
+      days += `<div class="today"><button class="btn btn-outline-white" id="day-${i}" onclick="get_day_message('${i}', '${date.getMonth()}', '${date.getFullYear()}')">${i}</button></div>`;
     } else {
-      days += `<div><button class="btn btn-outline-primary" onclick="get_day_message('${i}', '${date.getMonth()}', '${date.getFullYear()}')">${i}</button></div>`;
+      days += `<div><button class="btn btn-outline-primary" id="day-${i}" onclick="get_day_message('${i}', '${date.getMonth()}', '${date.getFullYear()}')">${i}</button></div>`;
     }
   }
 
@@ -132,8 +132,28 @@ const renderCalendar = () => {
     days += `<div class="next-date">${j}</div>`;
     monthDays.innerHTML = days;
   }
+
+  get_month_summary(date.getMonth(), date.getFullYear());
 };
 
+function get_month_summary(month, year) {
+  // highlight the days with at least one message
+  $.get('/api/calendar/' + month + "/" + year + "/summary", function (data) {
+    if (month != date.getMonth() || year != date.getFullYear()) {
+      // the user moved to another month in the meantime
+      return;
+    }
+    for (var i = 0; i < data.length; i++) {
+      var button = document.getElementById("day-" + data[i].day);
+      if (button) {
+        button.classList.remove("btn-outline-primary", "btn-outline-white");
+        button.classList.add("btn-primary");
+        button.title = data[i].count + (data[i].count == 1 ? " message" : " messages");
+      }
+    }
+  });
+}
+
 document.querySelector(".prev").addEventListener("click", () => {
   date.setMonth(date.getMonth() - 1);
   renderCalendar();
@@ -1,3 +1,8 @@
+var PAGE_SIZE = 50;
+var MAX_PAGE_SIZE = 500;
+// keyset cursor of the last message shown and number of rows shown, per table
+var cursors = { received: null, sent: null };
+var shown = { received: 0, sent: 0 };
 
 function buildTableReceived(data) {
     var table = document.getElementById('received');
@@ -11,7 +16,13 @@ function buildTableReceived(data) {
         <th class="text-center" scope="col">Delete message for me</th>
     </tr>
 </thead>`
-    
+    cursors.received = null;
+    shown.received = 0;
+    appendRowsReceived(data);
+}
+
+function appendRowsReceived(data) {
+    var table = document.getElementById('received');
     for (var i = 0; i < data.length; i++) {
         msg = JSON.parse(data[i]);
         var row = `<tr>
@@ -24,7 +35,10 @@ function buildTableReceived(data) {
 							
 					  </tr>`;
         table.innerHTML += row;
+        cursors.received = msg.id_message;
     }
+    shown.received += data.length;
+    $('#received_more').toggle(data.length == PAGE_SIZE);
 }
 
 function buildTableSent(data) {
@@ -37,6 +51,13 @@ function buildTableSent(data) {
     <th class="text-center">Forward message</th>
     </tr>
 </thead>`
+    cursors.sent = null;
+    shown.sent = 0;
+    appendRowsSent(data);
+}
+
+function appendRowsSent(data) {
+    var table = document.getElementById('sent');
     for (var i = 0; i < data.length; i++) {
         msg = data[i];
         var row = `<tr>
@@ -46,7 +67,27 @@ function buildTableSent(data) {
 								<td style="text-align:center"><button onclick="forward_message('${msg.email}','${msg.id_message}', true)" class="btn btn-primary">Forward</button></td>
 						</tr>`;
         table.innerHTML += row;
+        cursors.sent = msg.id_message;
     }
+    shown.sent += data.length;
+    $('#sent_more').toggle(data.length == PAGE_SIZE);
+}
+
+function loadMore(url, table) {
+    // fetch only the page following the last message shown
+    var args = { limit: PAGE_SIZE };
+    if (cursors[table] !== null) {
+        args.after = cursors[table];
+    }
+    var append = table == 'received' ? appendRowsReceived : appendRowsSent;
+    $.get(url, args, function (data) { append(data); });
+}
+
+function refreshTable(url, table) {
+    // reload the rows currently shown, messages delivered late may have a lower id
+    var limit = Math.min(Math.max(shown[table], PAGE_SIZE), MAX_PAGE_SIZE);
+    var build = table == 'received' ? buildTableReceived : buildTableSent;
+    $.get(url, { limit: limit }, function (data) { build(data); });
 }
 
 function open_message_received(msg_id) {
@@ -157,8 +198,6 @@ function reply_message(msg_email, recipient_id) {
     modal_reply_content.textContent = msg_email;
     modal_reply_content.value = recipient_id;
 
-    $('#recipient').empty()
-    get_recipient();
     modal_reply.style.display = "block";
 
     //Close modal
@@ -181,7 +220,7 @@ function forward_message(msg_email, msg_id, forwarding_sent = false) {
     CKEDITOR.instances.fwd_text.setData("<b>Loading message contents...</b>");
 
     $('#recipient').empty()
-    get_recipient();
+    $('#recipient_search').val('')
     modal_forward.style.display = "block";
 
     // Get the message contents
@@ -224,28 +263,6 @@ function delete_message(msg_id) {
     });
 }
 
-function get_recipient() {
-    $.ajax({
-        url: "/api/user/recipients",
-        contentType: "application/json",
-        dataType: "json",
-        success: function (data, status) {
-            console.log("status " + status);
-            items = data;
-            $.each(items, function (i, item) {
-                $('#recipient').append($('<option>', {
-                    value: item.id,
-                    text: item.email
-                }));
-            });
-            loaded = true;
-        },
-        error: function (a, b, c) {
-            console.log(a + " " + b + " " + c)
-        }
-    });
-}
-
 function send_msg_reply_forward(form_id, forwarding = false) {
     let inputform = $('#' + form_id)
     let request_data = new FormData(inputform[0]);
@@ -0,0 +1,48 @@
+// Recipient typeahead: the users matching the text typed in #recipient_search
+// are searched on the server and listed in #recipient, next to the recipients
+// already chosen.
+var SEARCH_LIMIT = 20
+var search_timer = null
+
+function search_recipients() {
+    var prefix = $.trim($('#recipient_search').val())
+
+    // keep the recipients already chosen, replace the other results
+    $('#recipient option:not(:selected)').remove()
+    if (prefix.length === 0) {
+        return
+    }
+
+    $.ajax({
+        url: "/api/user/recipients/search",
+        data: { q: prefix, limit: SEARCH_LIMIT },
+        dataType: "json",
+        success: function (data) {
+            $.each(data, function (i, item) {
+                add_recipient(item.id, item.email, false)
+            });
+        },
+        error: function (a, b, c) {
+            console.log(a + " " + b + " " + c)
+        }
+    });
+}
+
+function add_recipient(id, email, selected) {
+    var option = $('#recipient option[value="' + id + '"]')
+    if (option.length === 0) {
+        option = $('<option>', { value: id, text: email })
+        $('#recipient').append(option)
+    }
+    if (selected) {
+        option.prop('selected', true)
+    }
+}
+
+$(document).ready(function () {
+    $('#recipient_search').on('input', function () {
+        // wait for the user to stop typing before searching
+        clearTimeout(search_timer)
+        search_timer = setTimeout(search_recipients, 200)
+    });
+});
@@ -1,27 +1,4 @@
-function get_recipient() {
-    $.ajax({
-        url: "/api/user/recipients",
-        contentType: "application/json",
-        dataType: "json",
-        success: function (data, status) {
-            console.log("status " + status);
-            items = data;
-            $.each(items, function (i, item) {
-                $('#recipient').append($('<option>', {
-                    value: item.id,
-                    text: item.email
-                }));
-            });
-            loaded = true;
-        },
-        error: function (a, b, c) {
-            console.log(a + " " + b + " " + c)
-        }
-    });
-}
-
 $(document).ready(function () {
-    get_recipient();
     $.get('/api/message/draft/all', buildTable)
 });
 
@@ -113,7 +90,12 @@ function editDraft(draft_id) {
             var draft_hidden_field = document.getElementById('draft_id')
 
             CKEDITOR.instances.text.setData(response.text);
-            recipient.value = response.recipient
+            $('#recipient option').prop('selected', false)
+            if (response.recipient) {
+                $.get('/api/user/' + response.recipient, function (user) {
+                    add_recipient(response.recipient, user.email, true)
+                })
+            }
             draft_hidden_field.value = draft_id
         }
     })
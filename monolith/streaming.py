@@ -0,0 +1,57 @@
+import json
+
+from flask import current_app, stream_with_context
+
+# rows fetched from the database cursor at a time
+BATCH_SIZE = 500
+# characters rendered by a streamed template before they are sent
+TEMPLATE_BUFFER_SIZE = 64
+
+
+def stream_json(query, serialize, batch_size=BATCH_SIZE):
+    """Returns a response sending the rows of a query as a JSON array,
+    encoded while they are fetched in batches from a server-side cursor,
+    so that the memory used does not depend on the number of rows
+
+    :param query: the query of the rows to send
+    :type query: Query
+    :param serialize: converts a row to a JSON serializable object
+    :type serialize: Callable[[Row], Any]
+    :param batch_size: rows fetched and sent at a time, defaults to BATCH_SIZE
+    :type batch_size: int, optional
+    :returns: the streamed response
+    :rtype: Response
+    """
+
+    def generate():
+        yield "["
+        separator = ""
+        chunk = []
+        for row in query.yield_per(batch_size):
+            chunk.append(separator + json.dumps(serialize(row)))
+            separator = ","
+            if len(chunk) == batch_size:
+                yield "".join(chunk)
+                chunk = []
+        yield "".join(chunk) + "]"
+
+    return current_app.response_class(
+        stream_with_context(generate()), mimetype="application/json"
+    )
+
+
+def stream_template(template_name, **context):
+    """Returns a response rendering a template while it is sent, so that the
+    rows of a query passed in the context are never all in memory
+
+    :param template_name: the name of the template to render
+    :type template_name: str
+    :returns: the streamed response
+    :rtype: Response
+    """
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(TEMPLATE_BUFFER_SIZE)
+    return app.response_class(stream_with_context(stream))
@@ -1,4 +1,66 @@
-from monolith.database import User, db, BlackList
+import heapq
+import json
+import random
+
+from sqlalchemy import and_, case, func, or_, update
+
+from monolith.auth import invalidate_user
+from monolith.cache import LRUCache
+from monolith.database import User, db, BlackList, read_session
+from monolith.digest import NOTIFICATION_MODES
+
+# members of the blacklist of each owner, kept current by add/remove_from_blacklist
+blacklist_cache = LRUCache("blacklist", maxsize=4096, ttl=300)
+# participants streamed at a time by a weighted lottery draw
+LOTTERY_BATCH_SIZE = 1000
+# reports after which an user is banned
+BAN_THRESHOLD = 3
+# users matching the shortest, most common, search prefixes for every sender
+recipient_search_cache = LRUCache("recipient_search", maxsize=1024, ttl=60)
+# prefixes up to this length are cached
+SEARCH_CACHE_PREFIX_LENGTH = 3
+# users cached per prefix, to fill a page once the blacklist is filtered out
+SEARCH_CACHE_ROWS = 200
+
+
+def dump_blacklist(members):
+    """Serializes a cached blacklist for a shared cache backend
+
+    :param members: the ids of the blocked users
+    :type members: frozenset[int]
+    :returns: the serialized blacklist
+    :rtype: str
+    """
+
+    return json.dumps(sorted(members))
+
+
+def load_blacklist(data):
+    """Deserializes a blacklist read from a shared cache backend
+
+    :param data: the serialized blacklist
+    :type data: bytes
+    :returns: the ids of the blocked users
+    :rtype: frozenset[int]
+    """
+
+    return frozenset(json.loads(data))
+
+
+def get_blacklisted(owner_id):
+    """Returns the ids of the users in a blacklist, using the blacklist cache
+
+    :param owner_id: user id for the blacklist owner
+    :type owner_id: int
+    :returns: the ids of the blocked users
+    :rtype: frozenset[int]
+    """
+
+    def load():
+        q = db.session.query(BlackList.member).filter(BlackList.owner == owner_id)
+        return frozenset(member for member, in q)
+
+    return blacklist_cache.get_or_load(int(owner_id), load)
 
 
 def get_recipients(sender_id):
@@ -12,18 +74,80 @@ def get_recipients(sender_id):
     """
 
     result = (
-        db.session.query(User.id, User.email)
+        read_session()
+        .query(User.id, User.email)
         .filter(User.id != sender_id)
         .filter(User.is_active)
-        .filter(
-            User.id.not_in(
-                db.session.query(BlackList.member).filter(BlackList.owner == sender_id)
-            )
-        )
+        .filter(User.id.not_in(get_blacklisted(sender_id)))
     )
     return result
 
 
+def search_recipients(sender_id, prefix, limit=20):
+    """Searches the possible recipients for a specific user whose email,
+    first name or last name starts with a prefix, accounting for the blacklist
+
+    :param sender_id: user id of the sender
+    :type sender_id: int
+    :param prefix: the beginning of the email or name, case insensitive
+    :type prefix: str
+    :param limit: maximum number of recipients returned, defaults to 20
+    :type limit: int, optional
+    :returns: the ids and emails of the recipients, ordered by email
+    :rtype: list[tuple(int, str)]
+    """
+
+    prefix = prefix.strip().lower()
+    if prefix == "":
+        return []
+
+    excluded = get_blacklisted(sender_id) | {int(sender_id)}
+    if len(prefix) <= SEARCH_CACHE_PREFIX_LENGTH:
+        candidates = recipient_search_cache.get_or_load(
+            prefix, lambda: _search_users(prefix, SEARCH_CACHE_ROWS)
+        )
+        result = [c for c in candidates if c[0] not in excluded][:limit]
+        # the cached users are enough unless the blacklist hid too many
+        if len(result) == limit or len(candidates) < SEARCH_CACHE_ROWS:
+            return result
+
+    return _search_users(prefix, limit, excluded)
+
+
+def _search_users(prefix, limit, excluded=frozenset()):
+    """Searches the active users by prefix, as a range scan of the lower(...)
+    indexes of email, first name and last name
+
+    :param prefix: the lowercase beginning of the email or name
+    :type prefix: str
+    :param limit: maximum number of users returned
+    :type limit: int
+    :param excluded: ids of the users to leave out, defaults to none
+    :type excluded: frozenset[int], optional
+    :returns: the ids and emails of the users, ordered by email
+    :rtype: list[tuple(int, str)]
+    """
+
+    # smallest string greater than every string starting with prefix
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    columns = [
+        func.lower(User.email),
+        func.lower(User.firstname),
+        func.lower(User.lastname),
+    ]
+
+    q = db.session.query(User.id, User.email).filter(
+        User.is_active == True,
+        or_(*[and_(column >= prefix, column < upper) for column in columns]),
+    )
+    if excluded:
+        q = q.filter(User.id.not_in(excluded))
+
+    return [
+        (id, email) for id, email in q.order_by(func.lower(User.email)).limit(limit)
+    ]
+
+
 def get_blacklist(owner_id):
     """Retrieves the blacklist owned by a specific user
 
@@ -65,6 +189,8 @@ def add_to_blacklist(owner_id, members_id):
     except Exception as e:
         db.session.rollback()
         print("Exception in add_user_to_black_list:", e)
+    finally:
+        _invalidate_blacklist(owner_id)
 
     return result
 
@@ -79,13 +205,10 @@ def get_blacklist_candidates(owner_id):
     """
 
     result = (
-        db.session.query(User.id, User.email)
+        read_session()
+        .query(User.id, User.email)
         .filter(User.id != owner_id, User.reports < 3, User.is_active)
-        .filter(
-            User.id.not_in(
-                db.session.query(BlackList.member).filter(BlackList.owner == owner_id)
-            )
-        )
+        .filter(User.id.not_in(get_blacklisted(owner_id)))
         .all()
     )
     result = [(usr.id, usr.email) for usr in result]
@@ -116,10 +239,26 @@ def remove_from_blacklist(owner_id, members_id):
     except Exception as e:
         db.session.rollback()
         print("Exception in delete_user_black_list:", e)
+    finally:
+        _invalidate_blacklist(owner_id)
 
     return result
 
 
+def _invalidate_blacklist(owner_id):
+    """Drops the cached blacklist of an owner after it has been changed
+
+    :param owner_id: the user id of the blacklist owner
+    :type owner_id: int
+    """
+
+    try:
+        blacklist_cache.delete(int(owner_id))
+    except (TypeError, ValueError):
+        # not a valid owner, nothing has been cached for it
+        pass
+
+
 def get_user_mail(user_id):
     """Retrieves the email address for a specific user
 
@@ -139,6 +278,26 @@ def get_user_mail(user_id):
     return result
 
 
+def get_users_notification_settings(user_ids):
+    """Retrieves what is needed to notify a set of users with a single query
+
+    :param user_ids: the ids of the users
+    :type user_ids: iterable[int]
+    :returns: the email address, active status and notification mode of each
+        user found, by user id
+    :rtype: dict[int, Row]
+    """
+
+    user_ids = set(user_ids)
+    if not user_ids:
+        return {}
+
+    q = db.session.query(
+        User.id, User.email, User.is_active, User.notification_mode
+    ).filter(User.id.in_(user_ids))
+    return {user.id: user for user in q}
+
+
 def get_user_by_email(user_email):
     """Checks if a user with the specified email already exists
 
@@ -152,47 +311,164 @@ def get_user_by_email(user_email):
     return user
 
 
-def get_lottery_participants():
-    """Returns all participants to monthly lottery
-
-    :param: no pramars
-    :returns: empty list in case an exception occurs otherwise users list
-    :rtype: Users []
+def draw_lottery_winners(count=1, weighted=False, rng=random):
+    """Draws the winners of the monthly lottery among the active users,
+    without loading the users table
+
+    Unweighted draws count the participants and read the users at random
+    offsets of the id index. Weighted draws give each user a chance
+    proportional to their points + 1, with a weighted reservoir sample
+    (Efraimidis-Spirakis) over a streamed cursor of (id, email, points).
+    In both cases memory is proportional to count only.
+
+    :param count: how many distinct winners to draw, defaults to 1
+    :type count: int, optional
+    :param weighted: weight the users by their points, defaults to False
+    :type weighted: bool, optional
+    :param rng: source of randomness, defaults to the random module
+    :type rng: random.Random, optional
+    :returns: the ids and emails of the winners, fewer than count if there
+        are not enough participants or some were deactivated meanwhile
+    :rtype: list[tuple(int, str)]
     """
 
-    result = db.session.query(User).filter(User.is_active).all()
-
-    return result
-
-
-def add_points(points, usr_id):
-    """Adds lottery points to an user
-
-    :param points: how many points to add
+    participants = db.session.query(User.id, User.email).filter(User.is_active)
+
+    if not weighted:
+        total = participants.count()
+        offsets = rng.sample(range(total), min(count, total))
+        winners = []
+        for offset in offsets:
+            row = participants.order_by(User.id).offset(offset).limit(1).first()
+            # users deactivated since the count shift the ones after them,
+            # past the end or onto a winner already drawn
+            if row is not None and tuple(row) not in winners:
+                winners.append(tuple(row))
+        return winners
+
+    # keep the count users with the highest random key u ** (1 / weight)
+    reservoir = []
+    q = participants.add_columns(User.points).yield_per(LOTTERY_BATCH_SIZE)
+    for id, email, points in q:
+        key = rng.random() ** (1.0 / (max(points or 0, 0) + 1))
+        if len(reservoir) < count:
+            heapq.heappush(reservoir, (key, id, email))
+        elif key > reservoir[0][0]:
+            heapq.heapreplace(reservoir, (key, id, email))
+
+    return [(id, email) for _, id, email in sorted(reservoir, reverse=True)]
+
+
+def add_points(points, usr_id, min_points=None, commit=True):
+    """Adds lottery points to an user, with a single atomic UPDATE
+
+    :param points: how many points to add, negative to spend them
     :param usr_id: id of the user
-    :returns: True on success, False otherwise
-    :rtype: bool
+    :param min_points: points the user must be left with, defaults to None (no check)
+    :type min_points: int, optional
+    :param commit: commit the change, otherwise leave it to the current
+        transaction, defaults to True
+    :type commit: bool, optional
+    :returns: the new points of the user, None if the user does not exist,
+        would be left with less than min_points or on error
+    :rtype: int
     """
-    result = False
+    result = None
     try:
-        usr = db.session.query(User).filter(User.id == usr_id).first()
-        setattr(usr, "points", usr.points + points)
-        db.session.commit()
-        result = True
+        condition = User.id == usr_id
+        if min_points is not None:
+            condition = and_(condition, User.points + points >= min_points)
+        row = _update_returning(
+            update(User).where(condition).values(points=User.points + points),
+            User.id == usr_id,
+            User.points,
+        )
+        if commit:
+            db.session.commit()
+        if row is not None:
+            result = row.points
     except Exception as e:
         db.session.rollback()
         print("Exception in add_points:", e)
     return result
 
 
-def get_all_users():
-    """Returns all the users registered to the service
+def report_user(email, ban_threshold=BAN_THRESHOLD):
+    """Adds a report to an user, banning (deactivating) them when they reach
+    the threshold, with a single atomic UPDATE
+
+    :param email: the email of the reported user
+    :type email: str
+    :param ban_threshold: reports that ban an user, defaults to BAN_THRESHOLD
+    :type ban_threshold: int, optional
+    :returns: the id, new reports and active status of the user,
+        None if no user has that email
+    :rtype: Row
+    """
+
+    reports = User.reports + 1
+    row = _update_returning(
+        update(User)
+        .where(User.email == email)
+        .values(
+            reports=reports,
+            is_active=case((reports >= ban_threshold, False), else_=User.is_active),
+        ),
+        User.email == email,
+        User.id,
+        User.reports,
+        User.is_active,
+    )
+    db.session.commit()
+    if row is not None:
+        invalidate_user(row.id)
+    return row
+
+
+def _update_returning(statement, where, *columns):
+    """Executes an UPDATE, returning columns of the updated row. It is a single
+    UPDATE ... RETURNING where supported, otherwise the row is read back
+    within the transaction, which keeps it locked since the UPDATE
+
+    :param statement: the UPDATE of a single row
+    :type statement: Update
+    :param where: the condition identifying the row after the UPDATE
+    :param columns: the columns to return
+    :returns: the updated row, None if no row was updated
+    :rtype: Row
+    """
+
+    if db.engine.dialect.full_returning:
+        return db.session.execute(statement.returning(*columns)).first()
+
+    if db.session.execute(statement).rowcount == 0:
+        return None
+    return db.session.query(*columns).filter(where).first()
+
+
+def get_all_users(after=None, limit=None):
+    """Returns the users registered to the service, ordered by id
+    and paginated with a keyset cursor
 
-    :returns: the list of all the users registered
-    :rtype: list
+    :param after: only return users with an id greater than this one, defaults to None
+    :type after: int, optional
+    :param limit: maximum number of users to return, defaults to None (no limit)
+    :type limit: int, optional
+    :returns: the query of the users registered
+    :rtype: Query
     """
 
-    return db.session.query(User).filter(User.is_active)
+    q = (
+        db.session.query(User.id, User.email, User.firstname, User.lastname)
+        .filter(User.is_active)
+        .order_by(User.id)
+    )
+    if after is not None:
+        q = q.filter(User.id > after)
+    if limit is not None:
+        q = q.limit(limit)
+
+    return q
 
 
 def change_user_content_filter(user_id, activate):
@@ -210,4 +486,30 @@ def change_user_content_filter(user_id, activate):
         raise Exception("User not found")
     setattr(user, "content_filter", activate)
     db.session.commit()
+    invalidate_user(user_id)
     return getattr(user, "content_filter")
+
+
+def change_user_notification_mode(user_id, mode):
+    """Changes how the notifications of an user are emailed
+
+    :param user_id: the id of the user
+    :type user_id: int
+    :param mode: immediate, digest or off
+    :type mode: str
+    :raises ValueError: if the mode does not exist
+    :returns: True if the mode has been changed, False if the user does not exist
+    :rtype: bool
+    """
+
+    if mode not in NOTIFICATION_MODES:
+        raise ValueError("Unknown notification mode " + str(mode))
+
+    updated = (
+        db.session.query(User)
+        .filter(User.id == user_id)
+        .update({User.notification_mode: mode})
+    )
+    db.session.commit()
+    invalidate_user(user_id)
+    return updated == 1
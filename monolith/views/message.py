@@ -1,10 +1,6 @@
 import json
-import os
 from datetime import date, datetime
-import hashlib
 import pathlib
-import time
-import pytz
 
 from celery.utils.log import get_logger
 from flask import Blueprint, abort, url_for, session
@@ -12,18 +8,23 @@ from flask import current_app as app
 from flask import jsonify, render_template, request
 from werkzeug.utils import redirect
 
+import monolith.attachments
 import monolith.message_query
+import monolith.outbox
 from monolith.auth import check_authenticated, current_user
-from monolith.user_query import get_user_mail
 from monolith.forms import MessageForm
 from monolith.database import Message
 from monolith.background import (
-    send_message as put_message_in_queue,
+    MESSAGE_READ,
+    build_payload,
     send_notification_task as put_email_in_queue,
 )
 
 msg = Blueprint("message", __name__)
 ERROR_PAGE = "error_page"
+# default and maximum number of entries returned by a paginated endpoint
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
 logger = get_logger(__name__)
 
 
@@ -72,33 +73,6 @@ def _extension_allowed(filename):
     }
 
 
-def _generate_filename(file):
-    """Generates a filename for an uploaded file
-
-    :param file: file handle
-    :type file: file
-    :returns: a filename suited for storage
-    :rtype: str
-    """
-
-    # To avoid clashes, generate a filename by hashing
-    # the file's contents, the sender and the time
-    sha1 = hashlib.sha1()
-    while True:
-        # Read in chunks of 64kb to contain memory usage
-        data = file.read(65536)
-        if not data:
-            break
-        sha1.update(data)
-    sha1.update(getattr(current_user, "email").encode("utf-8"))
-    sha1.update(str(int(time.time())).encode("utf-8"))
-
-    # Seek back to the origin of the file (otherwise save will fail)
-    file.seek(0)
-
-    return sha1.hexdigest() + pathlib.Path(file.filename).suffix.lower()
-
-
 @msg.route("/api/message/draft", methods=["POST"])
 def save_draft_message():
     """Saves a message as draft
@@ -130,6 +104,7 @@ def save_draft_message():
         else:
             message = Message()
 
+        old_media = None
         date = request.form["delivery_date"]
         message.delivery_date = (
             datetime.fromisoformat(date) if not _not_valid_string(date) else None
@@ -146,22 +121,11 @@ def save_draft_message():
             file = request.files["attachment"]
 
             if _extension_allowed(file.filename):
-                filename = _generate_filename(file)
-
-                # if the draft already has a file, delete it
-                if message.media is not None and message.media != "":
-                    try:  # pragma: no cover
-                        # very unlikely, ignore in coverage
-                        os.unlink(
-                            os.path.join(app.config["UPLOAD_FOLDER"], message.media)
-                        )
-                    except:  # pragma: no cover
-                        # if we failed to delete the file from the disk then something is wrong
-                        return _get_result(
-                            None, ERROR_PAGE, True, 500, "Internal server error"
-                        )
-
-                file.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
+                filename = monolith.attachments.store(file)
+
+                # the draft no longer references its previous file
+                old_media = message.media
+                monolith.attachments.release(old_media)
                 message.media = filename
             else:
                 return _get_result(
@@ -169,6 +133,7 @@ def save_draft_message():
                 )
 
         monolith.message_query.save_message(message)
+        monolith.attachments.collect(old_media)
 
         return _get_result(
             jsonify({"message_id": message.message_id}), "message._send_message"
@@ -199,6 +164,25 @@ def get_user_draft(id):
         return _get_result(None, ERROR_PAGE, True, 404, "Draft not found")
 
 
+@msg.route("/api/media/<filename>")
+def get_media(filename):
+    """Sends an attachment to a user who wrote or received it
+
+    :param filename: the name of the stored file
+    :type filename: str
+    :returns: the contents of the file
+    :rtype: Response
+    """
+
+    check_authenticated()
+    if not monolith.message_query.can_access_media(
+        getattr(current_user, "id"), filename
+    ):
+        abort(404, "Attachment not found")
+
+    return monolith.attachments.send(filename)
+
+
 @msg.route("/api/message/draft/<id>/attachment", methods=["DELETE"])
 def get_user_draft_attachment(id):
     """Delete the attachment of the draft #<id> from the current user
@@ -259,79 +243,68 @@ def send_message():
             None, "/send_message", True, 400, "Message needs at least one recipient"
         )
 
-    for recipient in recipients:
-        try:
-            # attempt to retrieve the draft, if present
-            msg = monolith.message_query.unmark_draft(
-                getattr(current_user, "id"),
-                int(
-                    -1
-                    if _not_valid_string(request.form["draft_id"])
-                    else request.form["draft_id"]
-                ),
+    sender_id = int(getattr(current_user, "id"))
+    try:
+        # attempt to retrieve the draft, if present
+        draft = monolith.message_query.get_user_draft(
+            sender_id,
+            int(
+                -1
+                if _not_valid_string(request.form["draft_id"])
+                else request.form["draft_id"]
+            ),
+        )
+    except KeyError:
+        draft = None
+
+    # the attachment is stored once and shared by all the recipients
+    media = draft.media if draft is not None else None
+    # a draft already holds a reference to its attachment
+    references = len(recipients) - (1 if draft is not None else 0)
+    old_media = None
+    if "attachment" in request.files and not _not_valid_string(
+        request.files["attachment"].filename
+    ):
+        file = request.files["attachment"]
+
+        if _extension_allowed(file.filename):
+            # stored with a reference for each recipient
+            filename = monolith.attachments.store(file, len(recipients))
+
+            # the draft no longer references its previous file
+            old_media = media
+            monolith.attachments.release(old_media)
+            media = filename
+            references = 0
+        else:
+            return _get_result(
+                None, ERROR_PAGE, True, 400, "File extension not allowed"
             )
-        except KeyError:
+    monolith.attachments.acquire(media, references)
+
+    messages = []
+    for recipient in recipients:
+        if draft is not None and messages == []:
+            # the draft becomes the message for the first recipient
+            msg = draft
+        else:
             # otherwise build the message from scratch
             msg = Message()
-            msg.is_draft = False
             msg.is_delivered = False
             msg.is_read = False
 
+        msg.is_draft = False
         msg.delivery_date = delivery_date
         msg.text = request.form["text"]
-        msg.sender = int(getattr(current_user, "id"))
+        msg.sender = sender_id
         msg.recipient = int(recipient)
+        msg.media = media
+        messages.append(msg)
 
-        if "attachment" in request.files and not _not_valid_string(
-            request.files["attachment"].filename
-        ):
-            file = request.files["attachment"]
-
-            if _extension_allowed(file.filename):
-                filename = _generate_filename(file)
-
-                # if the draft already has a file, delete it
-                if msg.media is not None and msg.media != "":
-                    try:  # pragma: no cover
-                        # unlikely to ever happen, don't include in coverage
-                        os.unlink(os.path.join(app.config["UPLOAD_FOLDER"], msg.media))
-                    except:
-                        # if we failed to delete the file from the disk then something is wrong
-                        return _get_result(
-                            None, ERROR_PAGE, True, 500, "Internal server error"
-                        )
-
-                file.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
-                msg.media = filename
-            else:
-                return _get_result(
-                    None, ERROR_PAGE, True, 400, "File extension not allowed"
-                )
-
-        # send message via celery
-        try:
-            id = monolith.message_query.save_message(msg)
-            email_r = get_user_mail(msg.recipient)
-            email_s = get_user_mail(msg.sender)
-            put_message_in_queue.apply_async(
-                args=[
-                    json.dumps(
-                        {
-                            "id": id,
-                            "TESTING": app.config["TESTING"],
-                            "body": "You have just received a massage",
-                            "recipient": email_r,
-                            "sender": email_s,
-                        }
-                    )
-                ],  #  convert to utc
-                eta=delivery_date.astimezone(pytz.utc),  # task execution time
-                routing_key="message",  # to specify the queue
-                queue="message",
-            )
-        except put_message_in_queue.OperationalError as e:
-            logger.exception("Send message task raised: %r", e)
-
+    # save all the messages in a single transaction,
+    # they are delivered by the scheduler when they are due
+    monolith.message_query.save_messages(messages)
+    monolith.attachments.collect(old_media)
     return _get_result(
         jsonify({"message sent": True}),
         "message._send_message",
@@ -372,17 +345,33 @@ def _not_valid_string(text):
     return text is None or text == "" or text.isspace()
 
 
+def _get_page_args():
+    """Reads the keyset pagination arguments (?after=<id>&limit=N) of the request
+
+    :returns: the cursor (None for the first page) and the page size
+    :rtype: tuple(int, int)
+    """
+
+    after = request.args.get("after", None, type=int)
+    limit = request.args.get("limit", PAGE_SIZE, type=int)
+    if limit is None or limit <= 0:
+        limit = PAGE_SIZE
+    return after, min(limit, MAX_PAGE_SIZE)
+
+
 @msg.route("/api/message/received/metadata", methods=["GET"])
 def _get_received_messages_metadata():
-    """Get all the messages received by the current user
+    """Get a page of the messages received by the current user.
+    Accepts ?after=<message_id>&limit=N to move the cursor
 
-    :returns: json of all the messages, 404 page if an exception happened
+    :returns: json of the messages in the page, 404 page if an exception happened
     :rtype: json
     """
     check_authenticated()
 
+    after, limit = _get_page_args()
     messages = monolith.message_query.get_received_messages_metadata(
-        getattr(current_user, "id")
+        getattr(current_user, "id"), after, limit
     )
     return jsonify(messages)
 
@@ -400,7 +389,9 @@ def _get_received_message(message_id):
 
     try:
         message = monolith.message_query.get_received_message(
-            getattr(current_user, "id"), message_id
+            getattr(current_user, "id"),
+            message_id,
+            getattr(current_user, "content_filter"),
         )
         return jsonify(message)
 
@@ -410,15 +401,25 @@ def _get_received_message(message_id):
 
 @msg.route("/api/message/sent/metadata", methods=["GET"])
 def _get_sent_messages_metadata():
-    """Get all the messages sent by the current user
+    """Get a page of the messages sent by the current user.
+    Accepts ?after=<message_id>&limit=N to move the cursor and
+    ?since=<ISO date> to skip the messages delivered before that date
 
-    :returns: json of all the messages, 404 page if an exception happened
+    :returns: json of the messages in the page, 400 page if the date is invalid
     :rtype: json
     """
     check_authenticated()
 
+    after, limit = _get_page_args()
+    since = request.args.get("since", None)
+    if since is not None:
+        try:
+            since = datetime.fromisoformat(since)
+        except ValueError:
+            return _get_result(None, ERROR_PAGE, True, 400, "Invalid date")
+
     messages = monolith.message_query.get_sent_messages_metadata(
-        getattr(current_user, "id")
+        getattr(current_user, "id"), after, limit, since
     )
     return jsonify(messages)
 
@@ -460,6 +461,36 @@ def delete_msg(message_id):
         return _get_result(None, ERROR_PAGE, True, 404, "Message not found")
 
 
+@msg.route("/api/message/<int:message_id>/delivery_date", methods=["PATCH"])
+def reschedule_msg(message_id):
+    """Move the delivery of a scheduled message of id = <id> to the date
+    in the delivery_date field, without creating a new message
+
+    :param message_id: the id of the message to be rescheduled
+    :type message_id: int
+    :returns: json of the message id and its new delivery date, 400 page if
+        the date is not valid, 404 page if the message is not scheduled
+    :rtype: json
+    """
+    check_authenticated()
+    s_date = request.form.get("delivery_date")
+    try:
+        delivery_date = datetime.fromisoformat(s_date)
+    except (TypeError, ValueError):
+        return _get_result(None, ERROR_PAGE, True, 400, "Delivery date not valid")
+    if delivery_date < datetime.now():
+        return _get_result(None, ERROR_PAGE, True, 400, "Delivery date in the past")
+
+    if monolith.message_query.reschedule_message(
+        getattr(current_user, "id"), message_id, delivery_date
+    ):
+        return jsonify(
+            {"message_id": message_id, "delivery_date": delivery_date.isoformat()}
+        )
+    else:
+        return _get_result(None, ERROR_PAGE, True, 404, "Message not found")
+
+
 @msg.route("/api/lottery/message/<message_id>", methods=["DELETE"])
 def lottery_delete_msg(message_id):
     """Delete a scheduled message of id = <id>
@@ -494,25 +525,14 @@ def read_msg(id):
 
     if not msg.is_read:
 
-        # updata msg.is_read
-        monolith.message_query.update_message_state(msg.message_id, "is_read", True)
-
-        # retrieve email of receiver and sender
-        email_r = get_user_mail(msg.sender)
-        email_s = get_user_mail(msg.recipient)
-        json_message = json.dumps(
-            {
-                "TESTING": app.config["TESTING"],
-                "body": str(email_s) + " has just read the message",
-                "recipient": email_r,
-                "sender": email_s,
-            }
-        )
-        put_email_in_queue.apply_async(
-            args=[json_message],
-            routing_key="notification",
-            queue="notification",
+        # notify the sender, the worker looks their addresses up
+        payload = build_payload(
+            [(MESSAGE_READ, msg.sender, msg.recipient)], app.config["TESTING"]
         )
+        monolith.outbox.add(put_email_in_queue, [payload], "notification")
+
+        # updata msg.is_read, committed with the notification
+        monolith.message_query.update_message_state(msg.message_id, "is_read", True)
 
     return jsonify({"msg_read": True})
 
@@ -546,3 +566,30 @@ def sent_messages_by_day(day, month, year):
 
         messages = monolith.message_query.get_day_message(userid, basedate, upperdate)
         return jsonify(messages)
+
+
+@msg.route("/api/calendar/<int:month>/<int:year>/summary")
+def sent_messages_by_month(month, year):
+    """Get the number of messages for each day of a month
+
+    :param month: month
+    :type month: int
+    :param year: year
+    :type year: int
+    :returns: json of the days with messages and their count, 400 page if the date is invalid
+    :rtype: json
+    """
+    check_authenticated()
+    try:
+        basedate = datetime(year, month + 1, 1)
+        if month + 1 == 12:
+            upperdate = datetime(year + 1, 1, 1)
+        else:
+            upperdate = datetime(year, month + 2, 1)
+    except ValueError:
+        # month out of 0-11 or year out of the supported range
+        return _get_result(None, ERROR_PAGE, True, 400, "Invalid date")
+    userid = getattr(current_user, "id")
+
+    summary = monolith.message_query.get_month_summary(userid, basedate, upperdate)
+    return jsonify(summary)
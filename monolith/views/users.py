@@ -11,18 +11,23 @@ from flask import (
 )
 from flask_login import logout_user
 
-from monolith.database import User, db
+from monolith.database import User, db, read_session
 from monolith.forms import BlackListForm, UserForm, ChangePassForm
-from monolith.auth import check_authenticated, current_user
+from monolith.auth import check_authenticated, current_user, invalidate_user
+from monolith.streaming import BATCH_SIZE, stream_json, stream_template
 import monolith.user_query
 
 users = Blueprint("users", __name__)
 
+# recipients returned by a search
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
 
 @users.route("/users")
 def _users():  # pragma: no cover
-    _users = db.session.query(User)
-    return render_template("users.html", users=_users)
+    _users = db.session.query(User.firstname, User.lastname, User.email)
+    return stream_template("users.html", users=_users.yield_per(BATCH_SIZE))
 
 
 @users.route("/content_filter")
@@ -30,6 +35,14 @@ def content_filter():  # pragma: no cover
     return render_template("content_filter.html", feedback="")
 
 
+@users.route("/notifications")
+def notifications():  # pragma: no cover
+    check_authenticated()
+    return render_template(
+        "notifications.html", mode=current_user.notification_mode, feedback=""
+    )
+
+
 @users.route("/search_user")
 def _search_user():  # pragma: no cover
     return render_template("search_user.html")
@@ -100,6 +113,27 @@ def get_recipients():
     return jsonify(l)
 
 
+@users.route("/api/user/recipients/search", methods=["GET"])
+def search_recipients():
+    """Search the possible message recipients for the current user
+    whose email or name starts with ?q=<prefix>, at most ?limit=N of them
+
+    :returns: the json of the matching recipients
+    :rtype: json
+    """
+
+    check_authenticated()
+    prefix = request.args.get("q", "")
+    limit = request.args.get("limit", SEARCH_LIMIT, type=int)
+    if limit is None or limit <= 0:
+        limit = SEARCH_LIMIT
+
+    result = monolith.user_query.search_recipients(
+        getattr(current_user, "id"), prefix, min(limit, MAX_SEARCH_LIMIT)
+    )
+    return jsonify([{"id": id, "email": email} for id, email in result])
+
+
 @users.route("/user/unregister")
 def unregister():
     """Unregister the current user from the service
@@ -110,9 +144,9 @@ def unregister():
     check_authenticated()
     userid = getattr(current_user, "id")
     logout_user()
-    user = User.query.filter(User.id == userid).first()
-    user.is_active = False
+    User.query.filter(User.id == userid).update({User.is_active: False})
     db.session.commit()
+    invalidate_user(userid)
     return redirect("/")
 
 
@@ -152,15 +186,19 @@ def change_data_user():
 
         # update the user data
         userid = getattr(current_user, "id")
-        user = User.query.filter(User.id == userid).first()
-        user.firstname = request.form["textfirstname"]
-        user.lastname = request.form["textlastname"]
-        user.email = request.form["textemail"]
         data = request.form["textbirth"]
         date_as_datetime = datetime.datetime.strptime(data, "%Y-%m-%d")
-        user.dateofbirth = date_as_datetime
+        User.query.filter(User.id == userid).update(
+            {
+                User.firstname: request.form["textfirstname"],
+                User.lastname: request.form["textlastname"],
+                User.email: request.form["textemail"],
+                User.dateofbirth: date_as_datetime,
+            }
+        )
 
         db.session.commit()
+        invalidate_user(userid)
         return redirect("/user/account")
     elif request.method == "GET":  # pragma: no cover
         return render_template("edit_profile.html", form=form, user=current_user)
@@ -178,6 +216,7 @@ def change_pass_user():
     stringError = ""
 
     if request.method == "POST":
+        # the password is not part of the cached user, it is read when needed
         userid = getattr(current_user, "id")
         user = User.query.filter(User.id == userid).first()
         current_password = form.currentpassword.data
@@ -198,6 +237,7 @@ def change_pass_user():
             return render_template("reset_password.html", form=form, error=stringError)
 
         db.session.commit()
+        invalidate_user(userid)
         return render_template(
             "reset_password.html", form=form, success="Password updated!"
         )
@@ -219,20 +259,19 @@ def report():
         # get the mail of the user to be reported and report it
         mail = str(request.form["useremail"])
         if mail is not None and not mail.isspace():
-            user = User.query.filter(User.email == mail).first()
+            user = monolith.user_query.report_user(mail)
             if user is None:
                 return render_template(
                     "report_user.html",
                     error=mail + " does not exist.",
                     reported="",
                 )
-            user.reports += 1
-            banned = ""
-            # if the user has 3 or more reports ban the account deactivating it
-            if user.reports >= 3:
-                user.is_active = False
-                banned = " and banned"
-            db.session.commit()
+            # with 3 or more reports the account has been banned (deactivated)
+            banned = (
+                " and banned"
+                if user.reports >= monolith.user_query.BAN_THRESHOLD
+                else ""
+            )
             return render_template(
                 "report_user.html",
                 error="",
@@ -307,7 +346,7 @@ def get_user_details(user_id):
     """
     check_authenticated()
 
-    q = db.session.query(User).filter(User.id == user_id)
+    q = read_session().query(User).filter(User.id == user_id)
     user = q.first()
 
     if user is not None:
@@ -324,17 +363,27 @@ def get_user_details(user_id):
 
 @users.route("/api/users/list")
 def get_users_list_json():
-    """Get all the users registered to the service
+    """Get the users registered to the service, all of them or a page
+    if ?after=<user_id>&limit=N are given. The list is streamed
 
     :returns: the json of the users
     :rtype: json
     """
-    users = monolith.user_query.get_all_users()
-    userlist = [
-        {"email": u.email, "firstname": u.firstname, "lastname": u.lastname}
-        for u in users
-    ]
-    return jsonify(userlist)
+    after = request.args.get("after", None, type=int)
+    limit = request.args.get("limit", None, type=int)
+    if limit is not None and limit <= 0:
+        limit = None
+
+    users = monolith.user_query.get_all_users(after, limit)
+    return stream_json(
+        users,
+        lambda u: {
+            "id": u.id,
+            "email": u.email,
+            "firstname": u.firstname,
+            "lastname": u.lastname,
+        },
+    )
 
 
 @users.route("/api/content_filter/", methods=["POST"])
@@ -354,3 +403,23 @@ def set_content_filter():
     else:
         feedback = "Your content filter is disabled"
     return render_template("content_filter.html", feedback=feedback)
+
+
+@users.route("/api/notification_mode/", methods=["POST"])
+def set_notification_mode():
+    """Set how the notifications of the current user are emailed to the value
+    read from the form (immediate, digest or off)
+
+    :returns: the rendered template of the page, 400 if the mode does not exist
+    :rtype: text
+    """
+    check_authenticated()
+    mode = request.form.get("mode", "")
+    try:
+        monolith.user_query.change_user_notification_mode(current_user.id, mode)
+    except ValueError:
+        abort(400, "Unknown notification mode")
+
+    return render_template(
+        "notifications.html", mode=mode, feedback="Your notification settings are saved"
+    )
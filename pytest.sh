@@ -9,10 +9,11 @@ python3.9 -m smtpd -c DebuggingServer -n localhost:1025 &
 PYTHON_PID=$!
 redis-server &
 REDIS_PID=$!
-celery -A monolith.background worker -l INFO -Q message --detach
-CELERY_PID=$!
+export CELERY_TEST_MODE=1 # periodic tasks on the test database
+celery -A monolith.background worker -l INFO -Q message,notification,celery --detach --pidfile=celery-worker.pid
+celery -A monolith.background beat -l INFO --detach --pidfile=celery-beat.pid
 rm -rf mmiab-test.db
 pytest -s -v --cov monolith monolith/classes/tests
 kill -9 $PYTHON_PID
 kill -9 $REDIS_PID
-kill -9 $CELERY_PID
+kill -9 $(cat celery-worker.pid) $(cat celery-beat.pid)
@@ -1,5 +1,7 @@
 python3 -m smtpd -c DebuggingServer -n localhost:1025 &
-celery -A monolith.background worker -l INFO -Q message --detach #for test send message by celery
+export CELERY_TEST_MODE=1 # periodic tasks on the test database
+celery -A monolith.background worker -l INFO -Q message,notification,celery --detach #for test send message by celery
+celery -A monolith.background beat -l INFO --detach # for the delivery of the scheduled messages
 rm -rf mmiab-test.db
 pytest -s -v --cov monolith monolith/classes/tests --cov-report term-missing
 #coveralls